@@ -1,202 +1,446 @@
 import asyncio
+import contextvars
 import logging
 import os
+import queue
 import random
-from typing import Dict, List, Tuple
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
 
 import gradio as gr
 import yaml
 
-from src.elevenlabs import (Speaker, check_voice_exists, get_make_voice,
-                            play_history, save_history, set_elevenlabs_key)
-from src.openailib import top_response, speech_to_text, set_openai_key
-from src.tube import extract_audio
+from src import metrics
+from src.audio import EXPORT_FORMATS, ClipWriter, warm_up as warm_up_audio
+from src.conversation import ConversationState, load_characters
+from src.elevenlabs import (SpeechStream, check_voice_exists, get_make_voice, get_user, play_history, save_history,
+                            set_elevenlabs_key)
+from src.openailib import top_response, speech_to_text_stream, set_openai_key, stream_response_lines
+from src.sessions import Session, SessionStore
+from src.speculation import SPECULATIVE_TURNS
+from src.store import ConversationStore
+from src.tube import REFERENCE_DIR, ingest_video, plan_references, video_id
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Everything the UI needs comes from the characters file, so it can be built without any network calls
+CHARACTERS_YAML, CHARACTERS_DICT = load_characters(ConversationState.YAML_FILEPATH)
+DEFAULT_NAMES: list = random.choices(list(CHARACTERS_DICT.keys()), k=2)
+DEFAULT_IAM: str = random.choice(DEFAULT_NAMES)
+# Set once the app is launched, see start_background
+_WARM_UP: threading.Thread = None
 
-class ConversationState:
-    COLORS: list = ['#FFA07A', '#F08080', '#AFEEEE', '#B0E0E6', '#DDA0DD',
-                    '#FFFFE0', '#F0E68C', '#90EE90', '#87CEFA', '#FFB6C1']
-    YAML_FILEPATH: str = os.path.join(os.path.dirname(__file__), 'voices.yaml')
-    AUDIO_SAVEDIR: str = os.path.join(
-        os.path.dirname(__file__), 'audio_export')
-
-    def __init__(self,
-                 names: list = None,
-                 iam: str = None,
-                 model: str = "gpt-3.5-turbo",
-                 max_tokens: int = 30,
-                 temperature: float = 0.5,
-                 history: list = None):
-        self.model = model
-        self.max_tokens = max_tokens
-        self.temperature = temperature
-        # Make sure save dir exists, make any necessary directories
-        os.makedirs(self.AUDIO_SAVEDIR, exist_ok=True)
-        self.audio_savepath = os.path.join(
-            self.AUDIO_SAVEDIR, 'conversation.wav')
-        log.info(f"Resetting conversation")
-        with open(self.YAML_FILEPATH, 'r') as file:
-            self.characters_yaml = file.read()
-            file.seek(0)
-            self.characters_dict = yaml.safe_load(file)
-            self.all_characters = [
-                name for name in self.characters_dict.keys()]
-        self.names = names or random.choices(self.all_characters, k=2)
-        self.iam = iam or random.choice(self.names)
-        assert self.iam in self.names, f"{self.iam} not in {self.names}"
-        log.info(f"Loading voices")
-        self.speakers: Dict[str, Speaker] = {}
-        self.speakers_descriptions: str = ''
-        for i, name in enumerate(self.names):
-            if check_voice_exists(name) is None:
-                log.warning(f"Voice {name} does not exist")
-                continue
-            _speaker = Speaker(
-                name=name,
-                voice=get_make_voice(name),
-                color=self.COLORS[i % len(self.COLORS)],
-                description=self.characters_dict[name].get(
-                    "description", None),
-            )
-            self.speakers[name] = _speaker
-            if _speaker.description is not None:
-                self.speakers_descriptions += f"{_speaker.name}: {_speaker.description}.\n"
-        # System is fed into OpenAI to condition the prompt
-        self.system = f"You create funny conversation dialogues."
-        self.system += f"This conversation is between {', '.join(self.names)}."
-        self.system += "Do not introduce new characters."
-        self.system += "Descriptions for each of the characters are:\n"
-        for speaker in self.speakers.values():
-            self.system += f"{speaker.name}: {speaker.description}\n"
-        self.system += "Only return one person's response at a time."
-        self.system += "Each response must start with the character name, then a colon, then their response in a single line."
-        self.system += "Keep the responses short and witty."
-        self.system += "Make sure the responses are only one sentence long."
-        self.system += "Do not continue a previous response. Always start a new response."
-        # History is fed in at every step
-        self.step = 0
-        if history is None:
-            self.history: List[Tuple[Speaker, str]] = []
-
-    def add_to_history(self, text: str, speaker: Speaker = None):
-        if speaker is None:
-            speaker = self.speakers[self.iam]
-        self.history.append((speaker, text))
-
-    def history_to_prompt(self) -> str:
-        prompt: str = ''
-        for speaker, text in self.history:
-            prompt += f"{speaker.name}:{text}\n"
-        return prompt
-
-    def html_history(self) -> str:
-        history_html: str = ''
-        for speaker, text in self.history:
-            _bubble = f"<div style='background-color: {speaker.color}; border-radius: 5px; padding: 5px; margin: 5px;'>{speaker.name}: {text}</div>"
-            history_html += _bubble
-        return history_html
-
-
-# Storing state in the global scope like this is bad, but
-# perfect is the enemy of good enough and gradio is kind of shit
-STATE = ConversationState()
-
-
-def reset(names, iam, model, max_tokens, temperature):
-    # Push new global state to the global scope
-    global STATE
-    STATE = ConversationState(
-        names=names,
-        iam=iam,
-        model=model,
-        max_tokens=max_tokens,
-        temperature=temperature,
-    )
-    return STATE.html_history()
+
+def warm_up():
+    # Creates the API clients, fills the voice registry and loads the resampler in the background
+    try:
+        ConversationState(names=DEFAULT_NAMES, iam=DEFAULT_IAM)
+        warm_up_audio()
+    except Exception as e:
+        log.warning(f"Warm-up failed: {e}")
+
+
+def new_state(session_id: str) -> ConversationState:
+    if _WARM_UP is not None:
+        _WARM_UP.join()
+    return ConversationState(names=DEFAULT_NAMES, iam=DEFAULT_IAM, session_id=session_id, store=STORE)
+
+
+def remove_exports(session: Session):
+    session.state.speculator.cancel()
+    # Only the in-memory index goes, the conversation itself stays in the store and can be resumed
+    STORE.close(session.state.conversation_id)
+    shutil.rmtree(session.state.export_dir, ignore_errors=True)
+
+
+# Conversations on disk, resumable after a restart, see src/store.py
+STORE = ConversationStore()
+STORE_SWEEP_SECONDS: float = float(os.environ.get("CONVERSATION_STORE_SWEEP_SECONDS", 3600))
+
+
+def sweep_store():
+    # Retention and compaction, at startup and then periodically
+    while True:
+        try:
+            STORE.sweep()
+        except Exception as e:
+            log.warning(f"Conversation store sweep failed: {e}")
+        time.sleep(STORE_SWEEP_SECONDS)
 
 
-def step_mic(audio):
-    global STATE
+# Each browser session gets its own conversation, kept in a bounded store
+SESSIONS = SessionStore(
+    factory=new_state,
+    max_sessions=int(os.environ.get("MAX_SESSIONS", 64)),
+    idle_timeout=float(os.environ.get("SESSION_IDLE_TIMEOUT", 3600)),
+    max_bytes=int(os.environ.get("SESSION_MAX_BYTES", 64 * 1024 * 1024)),
+    sizeof=lambda state: state.approx_bytes(),
+    on_evict=remove_exports,
+)
+
+metrics.METRICS.register_gauge("sessions", lambda: {"active": len(SESSIONS), **SESSIONS.stats})
+metrics.METRICS.register_gauge("conversation_store", lambda: dict(STORE.stats))
+
+
+def start_background():
+    # Only for the launched app: scripts importing this module (bench/) get neither thread
+    global _WARM_UP
+    _WARM_UP = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    _WARM_UP.start()
+    threading.Thread(target=sweep_store, name="store-sweep", daemon=True).start()
+
+# Bounded concurrency for the New Characters tab
+INGEST_WORKERS: int = int(os.environ.get("INGEST_WORKERS", 4))
+CLONE_WORKERS: int = int(os.environ.get("CLONE_WORKERS", 3))
+# Recordings longer than this are split at pauses and the pieces transcribed concurrently
+STT_CHUNK_SECONDS: float = float(os.environ.get("STT_CHUNK_SECONDS", 30))
+STT_WORKERS: int = int(os.environ.get("STT_WORKERS", 4))
+# wav, or a compressed format that reaches the browser while it is still being encoded
+EXPORT_FORMAT: str = os.environ.get("EXPORT_FORMAT", "wav")
+# Seconds between partial files handed to the browser during a compressed export
+EXPORT_PROGRESS_SECONDS: float = float(os.environ.get("EXPORT_PROGRESS_SECONDS", 1.0))
+
+
+def reset(names, iam, model, max_tokens, temperature, session_id=None):
+    session = SESSIONS.get(session_id)
+    with session.lock:
+        # The speculator is kept, so its waste budget covers the whole session, not one conversation
+        speculator = session.state.speculator
+        speculator.cancel()
+        previous_id = session.state.conversation_id
+        session.state = ConversationState(
+            names=names,
+            iam=iam,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            session_id=session.id,
+            store=STORE,
+        )
+        session.state.speculator = speculator
+        # Only its index goes, a conversation without turns was never written and is dropped altogether
+        STORE.close(previous_id)
+        return session.state.html_history(), session.id, session.state.conversation_id
+
+
+def resume(conversation_id: str, session_id=None):
+    session = SESSIONS.get(session_id)
+    with session.lock:
+        # Every turn and clip comes from the store, nothing is generated or synthesized again
+        state = ConversationState.resume(STORE, conversation_id.strip(), session_id=session.id)
+        if state is not None:
+            session.state.speculator.cancel()
+            state.speculator = session.state.speculator
+            if session.state.conversation_id != state.conversation_id:
+                STORE.close(session.state.conversation_id)
+            session.state = state
+        return session.state.html_history(), session.id, session.state.conversation_id
+
+
+def step_mic(audio, session_id=None):
+    session = SESSIONS.get(session_id)
+    # The session lock is only held between yields: a generator abandoned by a disconnected client would
+    # otherwise keep it until garbage collected, and every later request of the session would hang
+    with session.lock:
+        state = session.state
+        # Whatever was prepared in the background continued the conversation without this input
+        state.speculator.cancel()
+    # Started, not entered: gradio may resume this generator on another thread
+    turn = metrics.start_span("turn.mic")
     try:
-        request = speech_to_text(audio)
-        STATE.add_to_history(request)
+        # Long recordings are transcribed in concurrent chunks, partial text shows up as it lands
+        with metrics.activate(turn):
+            transcripts = speech_to_text_stream(audio,
+                                                max_chunk_seconds=STT_CHUNK_SECONDS,
+                                                max_workers=STT_WORKERS)
+        request = ''
+        for request in transcripts:
+            yield state.html_history(pending=request), session.id
+        with session.lock:
+            # A reset while transcribing started another conversation, this input belonged to the old one
+            if session.state is state:
+                state.add_to_history(request)
+                state.speculate_next_turn()
     except TypeError as e:
         log.warning(e)
         pass
-    return STATE.html_history()
-
-
-def step_continue():
-    global STATE
-    response = top_response(STATE.history_to_prompt(),
-                            system=STATE.system,
-                            model=STATE.model,
-                            max_tokens=STATE.max_tokens,
-                            temperature=STATE.temperature,
-                            )
-    for line in response.splitlines():
+    finally:
+        turn.end()
+    yield session.state.html_history(), session.id
+
+
+def step_continue(session_id=None):
+    session = SESSIONS.get(session_id)
+    with session.lock, metrics.span("turn.continue"):
+        state = session.state
+        speculative = state.speculator.take(state.history_signature())
+        if speculative is not None:
+            for speaker, text, future in speculative:
+                state.add_to_history(text, speaker=speaker)
+                state.keep_audio(len(state.history) - 1, future)
+        else:
+            response = top_response(state.history_to_prompt(),
+                                    system=state.system,
+                                    model=state.model,
+                                    max_tokens=state.max_tokens,
+                                    temperature=state.temperature,
+                                    )
+            for line in response.splitlines():
+                parsed = state.parse_line(line)
+                if parsed is not None:
+                    state.add_to_history(parsed[1], speaker=parsed[0])
+        state.speculate_next_turn()
+        return state.html_history(), session.id
+
+
+def step_continue_stream(speak: bool = False, session_id=None):
+    # Lines are added, sent to TTS and (optionally) spoken as soon as the LLM finishes each one
+    session = SESSIONS.get(session_id)
+    # Only held between yields, see step_mic
+    with session.lock:
+        state = session.state
+        # Only activated between yields, gradio may resume this generator on another thread
+        turn = metrics.start_span("turn.continue")
+        with metrics.activate(turn):
+            speech = SpeechStream(play=speak)
+            speculative = state.speculator.take(state.history_signature())
+            if speculative is not None:
+                # Prepared while the last turn played: the lines are known and their audio is (mostly) ready
+                turn.attrs = {"speculative": True}
+                for speaker, text, future in speculative:
+                    state.add_to_history(text, speaker=speaker)
+                    state.keep_audio(len(state.history) - 1, speech.add(text, speaker, future=future))
+            else:
+                prompt = state.history_to_prompt()
+    try:
+        if speculative is not None:
+            yield state.html_history(), session.id
+        else:
+            with metrics.activate(turn):
+                lines = stream_response_lines(prompt,
+                                              system=state.system,
+                                              model=state.model,
+                                              max_tokens=state.max_tokens,
+                                              temperature=state.temperature,
+                                              )
+            for line in lines:
+                with session.lock, metrics.activate(turn):
+                    # Reset while the LLM was answering, the rest of the answer continues a conversation that is gone
+                    if session.state is not state:
+                        break
+                    parsed = state.parse_line(line)
+                    if parsed is None:
+                        continue
+                    speaker, text = parsed
+                    state.add_to_history(text, speaker=speaker)
+                    state.keep_audio(len(state.history) - 1, speech.add(text, speaker))
+                yield state.html_history(), session.id
+        with session.lock:
+            # Starts before playback finishes, so the next turn is prepared while this one is heard
+            if session.state is state:
+                state.speculate_next_turn()
+    finally:
+        speech.close()
+        turn.end()
+    yield session.state.html_history(), session.id
+
+
+def save_audio(export_format: str = EXPORT_FORMAT, session_id=None):
+    session = SESSIONS.get(session_id)
+    if export_format != "wav":
+        yield from save_audio_progressive(session, export_format)
+        return
+    with session.lock, metrics.span("turn.export"):
+        state = session.state
+        log.info(f"Saving audio")
+        history, append = state.pending_export()
+        if not append and os.path.exists(state.audio_savepath):
+            # A rebuild of an empty history writes nothing, the export of an older history must not pass for it
+            os.remove(state.audio_savepath)
+        if history or not append:
+            log.info(f"Rendering {len(history)} turns, {'appending' if append else 'full rebuild'}")
+            try:
+                asyncio.run(save_history(history, state.audio_savepath,
+                            gap_seconds=state.export_gap_seconds, append=append,
+                            clips=state.stored_clips(len(state.history) - len(history))))
+            except Exception:
+                # Some clips may already be in the file, the next export rebuilds it instead of appending them twice
+                state.exported_history = []
+                raise
+        state.exported_history = state.history_signature()
+        path = state.audio_savepath if os.path.exists(state.audio_savepath) else None
+    yield path, session.id, state.conversation_id
+
+
+def save_audio_progressive(session: Session, export_format: str):
+    # The file is encoded clip by clip on a background thread and handed to the browser while it grows,
+    # so playback and download start after the first clip instead of after the whole conversation.
+    # The session lock is only held to snapshot the history and to record the export, see step_mic
+    with session.lock:
+        state = session.state
+        path = os.path.join(state.export_dir, f"conversation.{export_format}")
+        signature = state.history_signature()
+        history = list(state.history)
+        clips = state.stored_clips()
+        cached = state.compressed_exports.get(export_format) == signature and os.path.exists(path)
+    if cached:
+        yield path, session.id, state.conversation_id
+        return
+    # Started, not entered: gradio may resume this generator on another thread
+    turn = metrics.start_span("turn.export", format=export_format)
+    progress: queue.Queue = queue.Queue()
+
+    def on_clip(writer: ClipWriter):
+        # Nothing is handed out before the encoder wrote audio, a file of headers alone does not play
+        if writer.playable:
+            progress.put(writer.clips_written)
+
+    def export():
         try:
-            # TODO: Add any filters here as assertion errors
-            if not line:
-                continue
-            assert ":" in line, f"Line {line} does not have a colon"
-            name, text = line.split(":")
-            assert name in STATE.all_characters, f"Name {name} is not in {STATE.all_characters}"
-            speaker = STATE.speakers[name]
-            assert len(text) > 0, f"Text {text} is empty"
-            STATE.add_to_history(text, speaker=speaker)
-        except AssertionError as e:
-            log.warning(e)
-            continue
-    return STATE.html_history()
-
-
-def save_audio():
-    global STATE
-    log.info(f"Saving audio")
-    asyncio.run(save_history(STATE.history, STATE.audio_savepath))
-    return STATE.audio_savepath
-
-
-def play_audio():
-    global STATE
-    log.info(f"Playing audio")
-    asyncio.run(play_history(STATE.history))
-    return STATE.html_history()
-
-
-def make_voices(voices_yaml: str):
-    global STATE
+            # Held by this thread, which always finishes, so two exports never write the same file at once
+            with state.export_lock:
+                # Same as the wav export: nothing written must not leave an older export in place
+                if os.path.exists(path):
+                    os.remove(path)
+                asyncio.run(save_history(history, path, gap_seconds=state.export_gap_seconds,
+                                         clips=clips, export_format=export_format, on_clip=on_clip))
+            progress.put(None)
+        except Exception as e:
+            progress.put(e)
+
+    with metrics.activate(turn):
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(export,), name="export", daemon=True)
+    thread.start()
+    last_update = None
     try:
-        STATE.characters_dict = yaml.safe_load(voices_yaml)
-        for name, metadata in STATE.characters_dict.items():
-            videos = metadata['references']
+        while True:
+            item = progress.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                break
+            now = time.monotonic()
+            if last_update is None:
+                log.info(f"First {export_format} audio after {turn.duration:.2f} seconds")
+                metrics.METRICS.observe("export.first_audio", turn.duration)
+            if last_update is None or now - last_update >= EXPORT_PROGRESS_SECONDS:
+                last_update = now
+                yield path, session.id, state.conversation_id
+    finally:
+        thread.join()
+        turn.end()
+    with session.lock:
+        state.compressed_exports[export_format] = signature
+    if not os.path.exists(path):
+        yield None, session.id, state.conversation_id
+        return
+    log.info(f"Exported {len(signature)} turns to {path}, {os.path.getsize(path) / 1024:.0f} kB")
+    yield path, session.id, state.conversation_id
+
+
+def set_speculative(enabled: bool, session_id=None):
+    session = SESSIONS.get(session_id)
+    with session.lock:
+        state = session.state
+        state.speculator.enabled = enabled
+        if enabled:
+            state.speculate_next_turn()
+        else:
+            state.speculator.cancel()
+        return session.id
+
+
+def play_audio(session_id=None):
+    session = SESSIONS.get(session_id)
+    with session.lock, metrics.span("turn.playback"):
+        log.info(f"Playing audio")
+        asyncio.run(play_history(session.state.history, clips=session.state.stored_clips()))
+        return session.id
+
+
+def make_voices(voices_yaml: str, session_id=None):
+    # Generator, so the character creation log updates live while voices are cloned
+    session = SESSIONS.get(session_id)
+    logs: List[str] = []
+
+    def report(message: str):
+        log.info(message)
+        logs.append(message)
+        return "\n".join(logs), session.id
+
+    # Nothing here reads the conversation, the session lock is only taken to record the characters, see step_mic
+    try:
+        characters = yaml.safe_load(voices_yaml)
+        assert isinstance(characters, dict), f"Expected names mapped to characters, got {type(characters).__name__}"
+        missing: Dict[str, list] = {}
+        for name, metadata in characters.items():
             assert isinstance(name, str), f"Name {name} is not a string"
+            assert isinstance(metadata, dict), f"Character {name} is not a dict"
+            assert 'references' in metadata, f"Character {name} does not have references"
+            videos = metadata['references']
             assert isinstance(videos, list), f"Videos {videos} is not a list"
             if check_voice_exists(name):
+                # Also how a partially completed batch resumes: finished characters are skipped
+                yield report(f"{name}: voice already exists")
                 continue
-            audio_paths = []
-            for i, video in enumerate(videos):
+            for video in videos:
                 assert isinstance(video, Dict), f"Video {video} is not a dict"
                 assert 'url' in video, f"Video {video} does not have a url"
-                url = video['url']
-                start_minute = video.get('start_minute', 0)
-                duration = video.get('duration_seconds', 120)
-                label = os.path.join(STATE.AUDIO_SAVEDIR, f"audio.{name}.{i}")
-                output_path = extract_audio(url, label, start_minute, duration)
-                audio_paths.append(output_path)
-            get_make_voice(name, audio_paths)
-    except Exception as e:
-        raise e
-        # return f"Error: {e}"
-    return "Success"
+            missing[name] = videos
+    except (AssertionError, yaml.YAMLError) as e:
+        yield report(f"Error: {e}")
+        return
+    with session.lock:
+        session.state.characters_dict = characters
+    if not missing:
+        yield report("Success")
+        return
+    # Cloning needs the account, there is no point fetching the reference audio without one
+    if get_user() is None:
+        yield report("Error: no ElevenLabs account, set the ElevenLabs API key first")
+        return
+    yield report(f"Fetching reference audio and cloning {', '.join(missing)}...")
+    urls, by_video, audio_paths = plan_references(missing, REFERENCE_DIR)
+    failures = 0
+    # Separate pools: clone jobs wait on video jobs, sharing one pool could deadlock
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as ingest_pool, \
+            ThreadPoolExecutor(max_workers=CLONE_WORKERS) as clone_pool:
+        # Each distinct video is fetched once, even when several characters reference it
+        videos = {_id: ingest_pool.submit(ingest_video, urls[_id], segments)
+                  for _id, segments in by_video.items()}
+
+        def clone(name: str):
+            for _id in {video_id(video['url']) for video in missing[name]}:
+                videos[_id].result()
+            voice = get_make_voice(name, audio_paths[name])
+            if voice is None:
+                raise RuntimeError("no ElevenLabs account, set the ElevenLabs API key")
+            return voice
+
+        jobs = {clone_pool.submit(clone, name): name for name in missing}
+        for job in as_completed(jobs):
+            name = jobs[job]
+            try:
+                job.result()
+                yield report(f"{name}: voice ready")
+            except Exception as e:
+                # One character failing never stops the others
+                failures += 1
+                yield report(f"{name}: failed, {e}")
+    if failures:
+        yield report(f"Finished with {failures} failed characters, update again to retry only those")
+    else:
+        yield report("Success")
 
 
 # Define the main GradIO UI
 with gr.Blocks() as demo:
+    # Only the session id lives in gradio's per-browser state, the conversation itself is in SESSIONS
+    gr_session = gr.State(None)
     gr.HTML('''
     <center>
     <h1>Speech2Speech</h1>
@@ -227,8 +471,13 @@ with gr.Blocks() as demo:
                     type="filepath",
                 )
                 gr_add_button = gr.Button(value="Add to conversation")
+                gr_speak_stream = gr.Checkbox(label="Speak new lines as they are generated", value=False)
+                gr_speculate = gr.Checkbox(label="Prepare the next turn in the background", value=SPECULATIVE_TURNS)
                 gr_playaudio_button = gr.Button(value="Play audio")
-                gr_saveaudio_button = gr.Button(value="Export audio")
+                with gr.Row():
+                    gr_saveaudio_button = gr.Button(value="Export audio")
+                    gr_export_format = gr.Dropdown(choices=list(EXPORT_FORMATS), value=EXPORT_FORMAT,
+                                                   label="Export format")
                 gr_outputaudio = gr.Audio(
                     label="Audio output",
                     source="upload",
@@ -236,10 +485,14 @@ with gr.Blocks() as demo:
                 )
             with gr.Column():
                 gr_iam = gr.Dropdown(
-                    choices=STATE.all_characters, label="I am", value=STATE.iam)
+                    choices=list(CHARACTERS_DICT.keys()), label="I am", value=DEFAULT_IAM)
                 gr_chars = gr.CheckboxGroup(
-                    STATE.all_characters, label="Characters", value=STATE.names)
+                    list(CHARACTERS_DICT.keys()), label="Characters", value=DEFAULT_NAMES)
                 gr_reset_button = gr.Button(value="Reset conversation")
+                with gr.Row():
+                    gr_conversation_id = gr.Textbox(label="Conversation id", placeholder="Paste an id to resume it",
+                                                    lines=1)
+                    gr_resume_button = gr.Button(value="Resume conversation")
                 with gr.Accordion("Settings", open=False):
                     openai_api_key_textbox = gr.Textbox(
                         placeholder="Paste your OpenAI API key here",
@@ -254,39 +507,52 @@ with gr.Blocks() as demo:
                         type="password",
                     )
                     gr_model = gr.Dropdown(choices=["gpt-3.5-turbo", "gpt-4"],
-                                           label='GPT Model behind conversation', value=STATE.model)
-                    gr_max_tokens = gr.Slider(minimum=1, maximum=500, value=STATE.max_tokens,
+                                           label='GPT Model behind conversation', value=ConversationState.MODEL)
+                    gr_max_tokens = gr.Slider(minimum=1, maximum=500, value=ConversationState.MAX_TOKENS,
                                               label="Max tokens", step=1)
                     gr_temperature = gr.Slider(
-                        minimum=0.0, maximum=1.0, value=STATE.temperature, label="Temperature (randomness in conversation)")
+                        minimum=0.0, maximum=1.0, value=ConversationState.TEMPERATURE, label="Temperature (randomness in conversation)")
     with gr.Tab("New Characters"):
         gr_make_voice_button = gr.Button(value="Update Characters")
         gr_voice_data = gr.Textbox(
-            lines=25, label="Character YAML config", value=STATE.characters_yaml)
+            lines=25, label="Character YAML config", value=CHARACTERS_YAML)
         gr_make_voice_output = gr.Textbox(
             lines=2, label="Character creation logs...")
 
+    with gr.Tab("Debug"):
+        gr_metrics_button = gr.Button(value="Refresh metrics")
+        gr_metrics_output = gr.JSON(label="Latency histograms, counters and recent turn traces")
+
     gr.HTML('''<center>
     Created by <a href="https://youtube.com/@hu-po">Hu Po</a> GitHub: <a href="https://github.com/hu-po/speech2speech">speech2speech</a>
     </center>
     ''')
 
     # Buttons and actions
-    gr_mic.change(step_mic, gr_mic, gr_convo_output)
+    gr_mic.change(step_mic, [gr_mic, gr_session], [gr_convo_output, gr_session])
     openai_api_key_textbox.change(set_openai_key, openai_api_key_textbox, None)
     elevenlabs_api_key_textbox.change(
         set_elevenlabs_key, elevenlabs_api_key_textbox, None)
-    gr_add_button.click(step_continue, None, gr_convo_output)
+    gr_add_button.click(step_continue_stream, [gr_speak_stream, gr_session], [gr_convo_output, gr_session])
+    gr_speculate.change(set_speculative, [gr_speculate, gr_session], gr_session)
     gr_reset_button.click(
         reset,
-        inputs=[gr_chars, gr_iam, gr_model, gr_max_tokens, gr_temperature],
-        outputs=[gr_convo_output],
+        inputs=[gr_chars, gr_iam, gr_model, gr_max_tokens, gr_temperature, gr_session],
+        outputs=[gr_convo_output, gr_session, gr_conversation_id],
     )
-    gr_saveaudio_button.click(save_audio, None, gr_outputaudio)
-    gr_playaudio_button.click(play_audio, None, None)
+    gr_resume_button.click(resume, [gr_conversation_id, gr_session], [gr_convo_output, gr_session, gr_conversation_id])
+    gr_saveaudio_button.click(save_audio, [gr_export_format, gr_session], [gr_outputaudio, gr_session, gr_conversation_id])
+    gr_playaudio_button.click(play_audio, gr_session, gr_session)
     gr_make_voice_button.click(
-        make_voices, inputs=gr_voice_data, outputs=gr_make_voice_output,
+        make_voices, inputs=[gr_voice_data, gr_session], outputs=[gr_make_voice_output, gr_session],
     )
+    gr_metrics_button.click(metrics.snapshot, None, gr_metrics_output)
 
 if __name__ == "__main__":
+    start_background()
+    # Handlers only lock their own session, so several can run at once
+    demo.queue(concurrency_count=int(os.environ.get("GRADIO_CONCURRENCY", 4)))
+    # Same snapshot as the Debug tab, as JSON for scrapers and dashboards
+    if "METRICS_PORT" in os.environ:
+        metrics.serve_metrics(int(os.environ["METRICS_PORT"]))
     demo.launch()
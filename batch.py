@@ -0,0 +1,205 @@
+'''
+Render conversations headlessly: N conversations of M turns each, as a transcript plus audio per conversation
+
+Usage:
+    batch.py [-n <conversations>] [-t <turns>] [-c <name,name> ...] [-o <output dir>] [-p <processes>]
+
+Every finished conversation is appended to <output dir>/manifest.jsonl, rerunning the same command skips
+the conversations already done. Set SPEECH2SPEECH_BACKEND=fake to try it without any accounts.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Render conversations to transcripts and audio files')
+parser.add_argument('-n', '--conversations', type=int, default=10, help='number of conversations (default: 10)')
+parser.add_argument('-t', '--turns', type=int, default=8, help='LLM turns per conversation (default: 8)')
+parser.add_argument('-c', '--characters', action='append',
+                    help='comma separated character set, repeat to cycle through several (default: random pairs)')
+parser.add_argument('-o', '--output-dir', default='batch_export', help='output directory (default: batch_export)')
+parser.add_argument('-p', '--processes', type=int, default=4, help='worker processes (default: 4)')
+parser.add_argument('--llm-concurrency', type=int, default=8, help='LLM requests in flight across all processes (default: 8)')
+parser.add_argument('--tts-concurrency', type=int, default=4, help='TTS requests in flight across all processes (default: 4)')
+parser.add_argument('--tts-rate', type=float, default=float(os.environ.get("TTS_RATE_PER_SECOND", 2.0)),
+                    help='TTS requests per second across all processes, 0 for no limit (default: 2)')
+parser.add_argument('--model', default='gpt-3.5-turbo', help='LLM model (default: gpt-3.5-turbo)')
+parser.add_argument('--max-tokens', type=int, default=30, help='max tokens per LLM turn (default: 30)')
+parser.add_argument('--temperature', type=float, default=0.5, help='LLM temperature (default: 0.5)')
+parser.add_argument('--gap', type=float, default=0.3, help='seconds of silence between lines in the audio (default: 0.3)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random character pairs (default: 0)')
+parser.add_argument('--llm-price', type=float, default=0.002, help='USD per 1k LLM tokens (default: 0.002)')
+parser.add_argument('--tts-price', type=float, default=0.30, help='USD per 1k TTS characters (default: 0.30)')
+
+# Counters every conversation reports the increase of, see openailib and elevenlabs
+COST_COUNTERS: List[str] = ["llm.requests", "llm.prompt_tokens", "llm.completion_tokens", "tts.requests", "tts.characters"]
+MANIFEST: str = 'manifest.jsonl'
+VOICES_YAML: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'voices.yaml')
+
+
+def plan_conversations(count: int, turns: int, character_sets: List[List[str]], seed: int = 0) -> List[Dict]:
+    """ The same arguments always give the same jobs, which is what lets a rerun resume. """
+    if not character_sets:
+        with open(VOICES_YAML) as f:
+            names = list(yaml.safe_load(f).keys())
+        rng = random.Random(seed)
+        character_sets = [rng.sample(names, k=2) for _ in range(count)]
+    return [{
+        "id": f"conversation-{index:05d}",
+        "names": character_sets[index % len(character_sets)],
+        "turns": turns,
+    } for index in range(count)]
+
+
+def load_manifest(path: str) -> Dict[str, Dict]:
+    # Last record per conversation wins, a failed conversation that was redone counts as done
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash
+                    continue
+                records[record["id"]] = record
+    return records
+
+
+def append_manifest(f, record: Dict):
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def init_worker(llm_slots, tts_slots, tts_rate: float, tts_workers: int, output_dir: str):
+    # Runs once per worker process: the clients and the voice registry are loaded per process, never the UI
+    global ConversationState
+    from src.conversation import ConversationState
+    from src import backends, scheduler
+    from src.elevenlabs import tts_backend
+    from src.openailib import llm_backend
+    # The semaphores are shared by the whole pool, so the limits are per provider, not per process
+    backends.set_backends(llm=backends.LimitedBackend(llm_backend(), llm_slots),
+                          tts=backends.LimitedBackend(tts_backend(), tts_slots))
+    scheduler.configure_tts_scheduler(max_workers=tts_workers, rate_per_second=tts_rate)
+    ConversationState.AUDIO_SAVEDIR = output_dir
+
+
+def render_conversation(job: Dict, model: str, max_tokens: int, temperature: float, gap_seconds: float) -> Dict:
+    """ Generates one conversation, writes <id>/transcript.txt and <id>/conversation.wav, returns its manifest record. """
+    import soundfile as sf
+    from src.elevenlabs import save_history
+    from src.metrics import METRICS
+    from src.openailib import top_response
+
+    counters_before = {name: METRICS.counters.get(name, 0) for name in COST_COUNTERS}
+    time_start = time.perf_counter()
+    record = {"id": job["id"], "names": job["names"], "turns": job["turns"]}
+    try:
+        state = ConversationState(names=job["names"], iam=job["names"][0], model=model, max_tokens=max_tokens,
+                                  temperature=temperature, export_gap_seconds=gap_seconds, session_id=job["id"])
+        # One turn is one Continue click in the app
+        for _ in range(job["turns"]):
+            response = top_response(state.history_to_prompt(),
+                                    system=state.system,
+                                    model=state.model,
+                                    max_tokens=state.max_tokens,
+                                    temperature=state.temperature,
+                                    )
+            for line in response.splitlines():
+                parsed = state.parse_line(line)
+                if parsed is not None:
+                    state.add_to_history(parsed[1], speaker=parsed[0])
+        if not state.history:
+            raise ValueError("No usable lines were generated")
+        transcript_path = os.path.join(state.export_dir, 'transcript.txt')
+        with open(transcript_path + '.tmp', 'w') as f:
+            f.writelines(f"{speaker.name}: {text.strip()}\n" for speaker, text in state.history)
+        os.replace(transcript_path + '.tmp', transcript_path)
+        asyncio.run(save_history(state.history, state.audio_savepath, gap_seconds=state.export_gap_seconds))
+        record.update({
+            "status": "done",
+            "lines": len(state.history),
+            "transcript": os.path.relpath(transcript_path, ConversationState.AUDIO_SAVEDIR),
+            "audio": os.path.relpath(state.audio_savepath, ConversationState.AUDIO_SAVEDIR),
+            "audio_seconds": round(sf.info(state.audio_savepath).duration, 2),
+        })
+    except Exception as e:
+        log.warning(f"{job['id']} failed: {e}")
+        record.update({"status": "failed", "error": repr(e)})
+    record["seconds"] = round(time.perf_counter() - time_start, 2)
+    # Worker processes render one conversation at a time, so the increase is this conversation's
+    record["usage"] = {name: METRICS.counters.get(name, 0) - counters_before[name] for name in COST_COUNTERS}
+    return record
+
+
+def report(records: List[Dict], wall_seconds: float, llm_price: float, tts_price: float) -> Dict:
+    done = [record for record in records if record["status"] == "done"]
+    usage = {name: sum(record["usage"].get(name, 0) for record in records) for name in COST_COUNTERS}
+    llm_usd = (usage["llm.prompt_tokens"] + usage["llm.completion_tokens"]) / 1000 * llm_price
+    tts_usd = usage["tts.characters"] / 1000 * tts_price
+    return {
+        "conversations": len(done),
+        "failed": len(records) - len(done),
+        "wall_seconds": round(wall_seconds, 1),
+        "conversations_per_hour": round(3600 * len(done) / wall_seconds, 1) if wall_seconds else 0.0,
+        "audio_seconds": round(sum(record.get("audio_seconds", 0) for record in done), 1),
+        **usage,
+        "llm_usd": round(llm_usd, 4),
+        "tts_usd": round(tts_usd, 4),
+        "usd_per_conversation": round((llm_usd + tts_usd) / len(done), 4) if done else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+
+    character_sets = [names.split(',') for names in args.characters or []]
+    jobs = plan_conversations(args.conversations, args.turns, character_sets, seed=args.seed)
+    finished = load_manifest(manifest_path)
+    todo = [job for job in jobs
+            if finished.get(job["id"], {}).get("status") != "done"
+            or not os.path.exists(os.path.join(output_dir, finished[job["id"]]["audio"]))]
+    log.info(f"{len(jobs) - len(todo)} of {len(jobs)} conversations already done, rendering {len(todo)}")
+
+    # Spawned, not forked: the SDK clients and scheduler threads must not be copied mid-request
+    context = multiprocessing.get_context("spawn")
+    processes = max(1, min(args.processes, len(todo)))
+    initargs = (
+        context.BoundedSemaphore(args.llm_concurrency),
+        context.BoundedSemaphore(args.tts_concurrency),
+        args.tts_rate / processes,
+        args.tts_concurrency,
+        output_dir,
+    )
+    records = []
+    time_start = time.perf_counter()
+    with open(manifest_path, 'a') as manifest, \
+            ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(render_conversation, job, args.model, args.max_tokens, args.temperature, args.gap)
+                   for job in todo]
+        for future in as_completed(futures):
+            record = future.result()
+            append_manifest(manifest, record)
+            records.append(record)
+            elapsed = time.perf_counter() - time_start
+            log.info(f"{len(records)}/{len(todo)} {record['id']} {record['status']} in {record['seconds']} seconds, "
+                     f"{3600 * len(records) / elapsed:.0f} conversations/hour")
+    summary = report(records, time.perf_counter() - time_start, args.llm_price, args.tts_price)
+    print(json.dumps(summary, indent=2))
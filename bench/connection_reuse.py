@@ -0,0 +1,88 @@
+'''
+Count the connections opened for a burst of TTS, STT and LLM requests with the pooled sessions against the SDK defaults
+
+Usage:
+    connection_reuse.py [-n <tts requests>] [--handshake <seconds>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+from stt_preprocess import fake_recording
+
+parser = argparse.ArgumentParser(description='Benchmark HTTP connection reuse against a fake server')
+parser.add_argument('-n', '--requests', type=int, default=40, help='TTS requests per run (default: 40)')
+parser.add_argument('--handshake', type=float, default=0.05, help='seconds the fake server spends on each new connection (default: 0.05)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+
+def burst(label: str, speaker, tmpdir: str) -> dict:
+    from src import openailib
+    from src.elevenlabs import prefetch_speech
+
+    connections_before = server.api.stats["connections"]
+    time_start = time.perf_counter()
+    # TTS fans out over the scheduler's workers, STT and LLM calls run from their own threads
+    futures = [prefetch_speech(f"{label} line number {i}", speaker) for i in range(args.requests)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for i in range(4):
+            path = os.path.join(tmpdir, f"{label}-{i}.wav")
+            fake_recording(path, 1.0 + 0.01 * i + (label == "pooled"), 0.2)
+            executor.submit(openailib.speech_to_text, path)
+            executor.submit(openailib.top_response, f"{label} {i}", "This conversation is between ElonMusk.")
+    for future in futures:
+        future.result()
+    return {
+        "seconds": time.perf_counter() - time_start,
+        "connections": server.api.stats["connections"] - connections_before,
+    }
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=0.05, background=True)
+    server.api.connect_latency = args.handshake
+    os.environ["ELEVENLABS_API_ENDPOINT"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["ELEVENLABS_API_KEY"] = "fake"
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    import openai
+    from elevenlabslib import helpers as elevenlabs_helpers
+    from src import audio, openailib
+    from src.connections import SessionModule, connection_stats, http_session
+    from src.elevenlabs import Speaker, check_voice_exists
+    audio.warm_up()
+    speaker = Speaker(name="ElonMusk", voice=check_voice_exists("ElonMusk"), color="#FFFFFF")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # SDK defaults: a new connection per ElevenLabs call, one session per thread for OpenAI
+        elevenlabs_helpers.requests = requests
+        openai.api_requestor._thread_context = threading.local()
+        default = burst("default", speaker, tmpdir)
+
+        elevenlabs_helpers.requests = SessionModule(http_session("elevenlabs"))
+        openailib.use_pooled_session()
+        pooled = burst("pooled", speaker, tmpdir)
+
+    total = args.requests + 8
+    print(f"{args.requests} TTS + 4 STT + 4 LLM requests, {args.handshake * 1000:.0f} ms per new connection")
+    print(f"SDK defaults:    {default['connections']:3d} connections, {default['seconds']:.2f} seconds")
+    print(f"pooled sessions: {pooled['connections']:3d} connections, {pooled['seconds']:.2f} seconds "
+          f"({1 - pooled['connections'] / total:.0%} of requests reused a connection)")
+    print(f"client side: {connection_stats()}")
+    server.shutdown()
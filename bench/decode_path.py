@@ -0,0 +1,69 @@
+'''
+Compare CPU time and allocations per second of audio for decoding TTS clips: compressed (mp3) through decode(),
+compressed through the reused ClipDecoder buffer, and raw PCM
+
+Usage:
+    decode_path.py [-n <clips>] [--repeat <n>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.audio import ClipDecoder, ClipWriter, decode
+from src.backends import synth_speech
+
+parser = argparse.ArgumentParser(description='Benchmark the TTS audio decode path')
+parser.add_argument('-n', '--clips', type=int, default=40, help='number of clips (default: 40)')
+parser.add_argument('--repeat', type=int, default=3, help='passes over the clips (default: 3)')
+parser.add_argument('--format', default='pcm_22050', help='raw PCM format (default: pcm_22050)')
+
+
+def measure(clips: list, decode_fn, export_path: str = None) -> dict:
+    """ CPU seconds and bytes allocated per second of audio, decoding (and optionally exporting) every clip. """
+    audio_seconds = 0.0
+    allocated = 0
+    cpu_start = time.process_time()
+    tracemalloc.start()
+    writer = ClipWriter(export_path) if export_path else None
+    for _ in range(args.repeat):
+        for clip in clips:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            audio, samplerate = decode_fn(clip)
+            if writer is not None:
+                writer.write(audio, samplerate)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+            audio_seconds += len(audio) / samplerate
+            del audio
+    if writer is not None:
+        writer.close()
+    tracemalloc.stop()
+    cpu = time.process_time() - cpu_start
+    return {"cpu_ms": 1000 * cpu / audio_seconds, "kb": allocated / 1024 / audio_seconds}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    texts = [f"This is line {i} of a very witty conversation, said by someone." for i in range(args.clips)]
+    compressed = [synth_speech(text) for text in texts]
+    pcm = [synth_speech(text, output_format=args.format) for text in texts]
+
+    paths = {
+        "mp3, decode()": (compressed, decode),
+        "mp3, ClipDecoder": (compressed, ClipDecoder().decode),
+        f"{args.format}, ClipDecoder": (pcm, ClipDecoder(args.format).decode),
+    }
+    print(f"{args.clips} clips x {args.repeat}, per second of audio:")
+    print(f"{'path':<26}{'decode cpu ms':>14}{'decode kB':>11}{'export cpu ms':>15}{'export kB':>11}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, (clips, decode_fn) in paths.items():
+            decoded = measure(clips, decode_fn)
+            exported = measure(clips, decode_fn, os.path.join(tmpdir, "export.wav"))
+            print(f"{label:<26}{decoded['cpu_ms']:14.3f}{decoded['kb']:11.1f}{exported['cpu_ms']:15.3f}{exported['kb']:11.1f}")
@@ -0,0 +1,66 @@
+'''
+Compare the wav export against the progressive compressed exports: time until the browser gets a file
+that already decodes to audio, total export time and file size, on fake TTS with every clip synthesized from scratch
+
+Usage:
+    export_formats.py [-n <lines>] [--tts-latency <seconds>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+parser = argparse.ArgumentParser(description='Benchmark wav against progressive mp3 and ogg/opus exports')
+parser.add_argument('-n', '--lines', type=int, default=40, help='lines in the conversation (default: 40)')
+parser.add_argument('--names', nargs='+', default=['ElonMusk', 'LexFridman'], help='characters talking')
+parser.add_argument('--tts-latency', type=float, default=0.3, help='seconds per fake TTS request (default: 0.3)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["CONVERSATION_STORE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    from src import backends
+    from src.backends import LatencyModel
+    backends.use_fakes(tts=LatencyModel(base=args.tts_latency, per_unit=0.005))
+
+    import app
+    from src import elevenlabs
+    from src.audio import warm_up
+    # The launched app imports the resampler at startup, Opus exports of 22.05 kHz clips need it
+    warm_up()
+    app.ConversationState.AUDIO_SAVEDIR = tempfile.mkdtemp()
+    session = app.SESSIONS.get(None)
+    state = app.ConversationState(names=args.names, iam=args.names[0], session_id=session.id)
+    session.state = state
+    for i in range(args.lines):
+        speaker = state.speakers[args.names[i % len(args.names)]]
+        state.add_to_history(f" This is line {i} of a long conversation, exported in one go.", speaker=speaker)
+
+    results = {}
+    for export_format in ("wav", "mp3", "ogg"):
+        # Every format synthesizes every clip, like a first export
+        elevenlabs.SPEECH_CACHE = elevenlabs.SpeechCache(cache_dir=tempfile.mkdtemp())
+        time_start = time.perf_counter()
+        first_audio = None
+        for path, _, _ in app.save_audio(export_format, session.id):
+            # Counts only once the handed out file decodes to audio, a file of headers alone does not play
+            if first_audio is None and sf.info(path).frames > 0:
+                first_audio = time.perf_counter() - time_start
+        results[export_format] = (first_audio, time.perf_counter() - time_start, os.path.getsize(path))
+
+    wav_first, _, wav_size = results["wav"]
+    print(f"{args.lines} lines, {args.tts_latency * 1000:.0f} ms per TTS request")
+    print(f"{'format':<8}{'first audio s':>14}{'total s':>9}{'size kB':>9}{'vs wav':>14}")
+    for export_format, (first_audio, total, size) in results.items():
+        print(f"{export_format:<8}{first_audio:14.2f}{total:9.2f}{size / 1024:9.0f}"
+              f"{f'{wav_first / first_audio:.0f}x, {size / wav_size:.0%}':>14}")
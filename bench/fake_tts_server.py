@@ -0,0 +1,242 @@
+'''
+Local stand-in for the ElevenLabs API (and the OpenAI chat endpoint), for running the app without accounts
+
+Usage:
+    fake_tts_server.py [--port <port>] [--latency <seconds>] [--rate-limit <requests per second>]
+
+Point the app at it with ELEVENLABS_API_ENDPOINT=http://127.0.0.1:<port>/v1
+and OPENAI_API_BASE=http://127.0.0.1:<port>/v1
+'''
+
+import argparse
+import io
+import json
+import math
+import re
+import struct
+import threading
+import time
+import uuid
+import wave
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import yaml
+
+YAML_FILEPATH = Path(__file__).parent.parent / 'voices.yaml'
+
+parser = argparse.ArgumentParser(description='Fake ElevenLabs API server')
+parser.add_argument('--port', type=int, default=8123, help='port to listen on (default: 8123)')
+parser.add_argument('--latency', type=float, default=0.3, help='seconds per synthesis request (default: 0.3)')
+parser.add_argument('--rate-limit', type=float, default=0, help='requests per second before answering 429 (default: unlimited)')
+
+
+def synth_wav(text: str, samplerate: int = 22050) -> bytes:
+    # A quiet tone whose length grows with the text, roughly like speech
+    duration = 0.3 + 0.06 * len(text)
+    frames = int(duration * samplerate)
+    pitch = 200 + (zlib.crc32(text.encode()) % 200)
+    samples = struct.pack(
+        f"<{frames}h", *(int(3000 * math.sin(2 * math.pi * pitch * i / samplerate)) for i in range(frames)))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(samplerate)
+        wav.writeframes(samples)
+    return buffer.getvalue()
+
+
+def audio_duration(multipart_body: bytes) -> float:
+    # Length of the uploaded file part of a multipart/form-data body, 0 if it cannot be decoded
+    import soundfile as sf
+    match = re.search(rb'name="file"[^\r]*\r\n(?:[^\r]+\r\n)*\r\n', multipart_body)
+    if match is None:
+        return 0.0
+    data = multipart_body[match.end():]
+    data = data[:data.rfind(b"\r\n--")]
+    try:
+        return sf.info(io.BytesIO(data)).duration
+    except Exception:
+        return 0.0
+
+
+def chat_reply(messages: list) -> str:
+    # Answer with one line per character named in the system prompt, in the expected "Name: text" format
+    system = " ".join(m["content"] for m in messages if m["role"] == "system")
+    match = re.search(r"This conversation is between (.*?)\.", system)
+    names = [name.strip() for name in match.group(1).split(",")] if match else ["Narrator"]
+    turn = sum(m["content"].count("\n") for m in messages if m["role"] == "user")
+    return "\n".join(f"{name}: This is line {turn + i} of a very witty conversation." for i, name in enumerate(names))
+
+
+class FakeElevenLabs:
+
+    def __init__(self, latency: float = 0.3, rate_limit: float = 0, latency_all: bool = False):
+        self.latency = latency
+        # Also delay the non-synthesis endpoints (voices, subscription, ...)
+        self.latency_all = latency_all
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.request_times: list = []
+        self.stats = {"requests": 0, "tts_requests": 0, "chat_requests": 0, "stt_requests": 0, "stt_bytes": 0,
+                      "throttled": 0, "max_inflight": 0, "connections": 0}
+        self.upload_bytes_per_second = 1_000_000
+        # Stands in for the TCP and TLS handshake round trips paid by every new connection
+        self.connect_latency = 0.0
+        # Whisper's processing time grows with the length of the recording
+        self.stt_seconds_per_audio_second = 0.0
+        self.inflight = 0
+        self.voices = {}
+        with open(YAML_FILEPATH) as f:
+            for name in yaml.safe_load(f):
+                self.add_voice(name)
+
+    def add_voice(self, name: str) -> dict:
+        voice = {"voice_id": uuid.uuid5(uuid.NAMESPACE_DNS, name).hex, "name": name, "category": "cloned"}
+        self.voices[voice["voice_id"]] = voice
+        return voice
+
+    def throttled(self) -> bool:
+        if self.rate_limit <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.request_times = [t for t in self.request_times if now - t < 1.0]
+            if len(self.request_times) >= self.rate_limit:
+                self.stats["throttled"] += 1
+                return True
+            self.request_times.append(now)
+            return False
+
+
+def make_handler(api: FakeElevenLabs):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with api.lock:
+                api.stats["connections"] += 1
+            time.sleep(api.connect_latency)
+
+        def _send(self, code: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, data, code: int = 200):
+            self._send(code, json.dumps(data).encode())
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _stream_chat(self, content: str):
+            # Server-sent events, one line per latency period, like a model generating tokens
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for line in content.splitlines(keepends=True):
+                time.sleep(api.latency)
+                chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": line}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def do_GET(self):
+            with api.lock:
+                api.stats["requests"] += 1
+            if api.latency_all:
+                time.sleep(api.latency)
+            if self.path == "/v1/voices":
+                self._json({"voices": list(api.voices.values())})
+            elif self.path.startswith("/v1/voices/"):
+                voice = api.voices.get(self.path.rsplit("/", 1)[-1])
+                self._json(voice or {"detail": "not found"}, 200 if voice else 404)
+            elif self.path == "/v1/user/subscription":
+                self._json({"can_use_instant_voice_cloning": True})
+            elif self.path == "/stats":
+                self._json(api.stats)
+            else:
+                self._json({"detail": "not found"}, 404)
+
+        def do_POST(self):
+            body = self._body()
+            with api.lock:
+                api.stats["requests"] += 1
+            match = re.match(r"^/v1/text-to-speech/([^/?]+)", self.path)
+            if match:
+                if api.throttled():
+                    self._send(429, b'{"detail": "too many requests"}', headers={"Retry-After": "1"})
+                    return
+                with api.lock:
+                    api.stats["tts_requests"] += 1
+                    api.inflight += 1
+                    api.stats["max_inflight"] = max(api.stats["max_inflight"], api.inflight)
+                time.sleep(api.latency)
+                with api.lock:
+                    api.inflight -= 1
+                output_format = re.search(r"output_format=pcm_(\d+)", self.path)
+                if output_format:
+                    # Raw 16 bit mono samples, no container
+                    wav = synth_wav(json.loads(body)["text"], int(output_format.group(1)))
+                    self._send(200, wav[44:], content_type="audio/pcm")
+                else:
+                    self._send(200, synth_wav(json.loads(body)["text"]), content_type="audio/wav")
+            elif self.path == "/v1/chat/completions":
+                with api.lock:
+                    api.stats["chat_requests"] += 1
+                request = json.loads(body)
+                content = chat_reply(request["messages"])
+                if request.get("stream"):
+                    self._stream_chat(content)
+                    return
+                time.sleep(api.latency)
+                self._json({
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(content) // 4},
+                })
+            elif self.path == "/v1/audio/transcriptions":
+                with api.lock:
+                    api.stats["stt_requests"] += 1
+                    api.stats["stt_bytes"] += len(body)
+                # Upload time grows with the request size, like over a real uplink
+                delay = api.latency + len(body) / api.upload_bytes_per_second
+                if api.stt_seconds_per_audio_second:
+                    delay += api.stt_seconds_per_audio_second * audio_duration(body)
+                time.sleep(delay)
+                self._json({"text": "Hello there, this is what I said into the microphone."})
+            elif self.path == "/v1/voices/add":
+                name = re.search(rb'name="name"\r\n\r\n([^\r]*)', body)
+                self._json(api.add_voice(name.group(1).decode() if name else "unnamed"))
+            else:
+                self._json({"detail": "not found"}, 404)
+
+    return Handler
+
+
+def serve(port: int = 8123, latency: float = 0.3, rate_limit: float = 0, background: bool = False):
+    api = FakeElevenLabs(latency=latency, rate_limit=rate_limit)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(api))
+    server.api = api
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.rate_limit)
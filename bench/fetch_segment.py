@@ -0,0 +1,115 @@
+'''
+Compare fetching a short segment of a long recording with input-side seeking against downloading it whole
+
+Usage:
+    fetch_segment.py [--minutes <source length>] [-s <start minute>] [-d <duration seconds>]
+'''
+
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.tube import cut_segments, fetch_segments
+
+parser = argparse.ArgumentParser(description='Benchmark range-limited source fetching against a local server')
+parser.add_argument('--minutes', type=float, default=45, help='length of the served recording (default: 45)')
+parser.add_argument('-s', '--start-minute', type=float, default=18.5, help='segment start in minutes (default: 18.5)')
+parser.add_argument('-d', '--duration', type=int, default=27, help='segment duration in seconds (default: 27)')
+parser.add_argument('--format', type=str, default='wav', help='served file format, wav or ogg (default: wav)')
+parser.add_argument('--port', type=int, default=8124, help='media server port (default: 8124)')
+
+BYTES_SENT = {"total": 0}
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Static file server that honors single byte ranges, like a CDN does. """
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # Small send buffer, so bytes counted as sent are close to bytes ffmpeg actually read
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header and header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first) if first else 0
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(16 * 1024, remaining))
+                    self.wfile.write(chunk)
+                    BYTES_SENT["total"] += len(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg hangs up as soon as it has the bytes it needs
+                pass
+
+
+def download(url: str, path: Path):
+    import urllib.request
+    with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+        shutil.copyfileobj(response, f)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    tmpdir = Path(tempfile.mkdtemp())
+    samplerate = 16000
+    source = tmpdir / f"source.{args.format}"
+    with sf.SoundFile(source, mode='w', samplerate=samplerate, channels=1) as f:
+        for minute in range(int(args.minutes)):
+            t = np.arange(60 * samplerate) / samplerate
+            f.write((0.1 * np.sin(2 * np.pi * (200 + minute) * t)).astype(np.float32))
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), partial(RangeRequestHandler, directory=str(tmpdir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{args.port}/{source.name}"
+    segment = [(tmpdir / "range.wav", args.start_minute, args.duration)]
+
+    BYTES_SENT["total"] = 0
+    time_start = time.perf_counter()
+    fetch_segments(url, segment)
+    range_time, range_bytes = time.perf_counter() - time_start, BYTES_SENT["total"]
+
+    BYTES_SENT["total"] = 0
+    time_start = time.perf_counter()
+    download(url, tmpdir / f"downloaded.{args.format}")
+    cut_segments(tmpdir / f"downloaded.{args.format}", [(tmpdir / "full.wav", args.start_minute, args.duration)])
+    full_time, full_bytes = time.perf_counter() - time_start, BYTES_SENT["total"]
+
+    print(f"source: {args.minutes} minutes, {source.stat().st_size / 1e6:.1f} MB; segment: {args.duration} seconds")
+    print(f"range fetch:   {range_bytes / 1e6:7.2f} MB in {range_time:.2f} seconds")
+    print(f"full download: {full_bytes / 1e6:7.2f} MB in {full_time:.2f} seconds")
+    print(f"segment frames match: {sf.info(tmpdir / 'range.wav').frames == sf.info(tmpdir / 'full.wav').frames}")
+    server.shutdown()
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,83 @@
+'''
+Measure TTS latency percentiles with and without hedged requests, against a fake TTS backend that injects
+long-tail delays
+
+Usage:
+    hedging.py [-n <requests>] [--tail <p>] [--tail-seconds <s>] [--budget <fraction>]
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+parser = argparse.ArgumentParser(description='Benchmark hedged TTS requests against long-tail delays')
+parser.add_argument('-n', '--requests', type=int, default=300, help='measured requests per run (default: 300)')
+parser.add_argument('--warmup', type=int, default=90, help='requests that only train the latency tracker (default: 90)')
+parser.add_argument('--tail', type=float, default=0.04, help='probability of a long-tail request (default: 0.04)')
+parser.add_argument('--tail-seconds', type=float, default=3.0, help='extra seconds of a long-tail request (default: 3)')
+parser.add_argument('--budget', type=float, default=0.1, help='max hedges as a fraction of requests (default: 0.1)')
+parser.add_argument('--percentile', type=float, default=95, help='hedge after this latency percentile (default: 95)')
+parser.add_argument('--workers', type=int, default=4, help='concurrent requests (default: 4)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the fake backend (default: 0)')
+
+
+def texts(label: str, count: int) -> list:
+    # Unique, so nothing is a cache hit, and of mixed lengths like real lines
+    rng = random.Random(f"{label}-{args.seed}")
+    words = "the rocket will land on mars before the podcast ends and nobody will read the book".split()
+    return [f"{label} {i}: " + " ".join(rng.choices(words, k=rng.randint(5, 40))) for i in range(count)]
+
+
+def run(hedged: bool) -> dict:
+    from src import elevenlabs
+    from src.elevenlabs import Hedger, text_to_speechbytes
+
+    elevenlabs.HEDGER = Hedger(enabled=hedged, percentile=args.percentile, budget=args.budget)
+    label = "hedged" if hedged else "plain"
+
+    def timed(text: str) -> float:
+        time_start = time.perf_counter()
+        text_to_speechbytes(text, voice, output_format="pcm_22050")
+        return time.perf_counter() - time_start
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(timed, texts(f"{label} warmup", args.warmup)))
+        requests_before = tts.stats["requests"]
+        latencies = list(executor.map(timed, texts(label, args.requests)))
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99, "max": max(latencies),
+            "backend_requests": tts.stats["requests"] - requests_before, "hedger": dict(elevenlabs.HEDGER.stats)}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    # Hedges queue on the TTS scheduler, only the injected tail should slow them down
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    from src import backends
+    from src.backends import LatencyModel
+    _, _, tts = backends.use_fakes(
+        tts=LatencyModel(base=0.2, per_unit=0.004, jitter=0.15, tail_probability=args.tail, tail_seconds=args.tail_seconds),
+        seed=args.seed,
+    )
+    from src.elevenlabs import check_voice_exists
+    voice = check_voice_exists("ElonMusk")
+
+    results = {"plain": run(hedged=False), "hedged": run(hedged=True)}
+    print(f"{args.requests} requests, {args.tail:.0%} delayed by {args.tail_seconds:.1f} seconds, "
+          f"hedging after p{args.percentile:.0f} with a {args.budget:.0%} budget")
+    print(f"{'':<8}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}{'requests':>10}")
+    for label, result in results.items():
+        print(f"{label:<8}{result['p50']:8.3f}{result['p95']:8.3f}{result['p99']:8.3f}{result['max']:8.3f}"
+              f"{result['backend_requests']:10d}")
+    print(f"hedger: {results['hedged']['hedger']}")
@@ -0,0 +1,79 @@
+'''
+Drive many simulated browser sessions through the app handlers at once, against the fake server
+
+Usage:
+    load_sessions.py [-s <sessions>] [-t <turns>] [-w <workers>]
+'''
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+
+parser = argparse.ArgumentParser(description='Load test per-session conversation state')
+parser.add_argument('-s', '--sessions', type=int, default=32, help='number of simulated sessions (default: 32)')
+parser.add_argument('-t', '--turns', type=int, default=3, help='conversation steps per session (default: 3)')
+parser.add_argument('-w', '--workers', type=int, default=8, help='concurrent handler threads (default: 8)')
+parser.add_argument('--latency', type=float, default=0.1, help='fake server latency (default: 0.1)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+
+def run_session(app, names: list) -> dict:
+    timings = []
+    time_start = time.perf_counter()
+    _, session_id, _ = app.reset(names, names[0], "gpt-3.5-turbo", 30, 0.5)
+    timings.append(time.perf_counter() - time_start)
+    for _ in range(args.turns):
+        time_start = time.perf_counter()
+        html, session_id = app.step_continue(session_id)
+        timings.append(time.perf_counter() - time_start)
+    time_start = time.perf_counter()
+    audio_savepath, session_id, _ = list(app.save_audio("wav", session_id))[-1]
+    timings.append(time.perf_counter() - time_start)
+    state = app.SESSIONS.get(session_id).state
+    # Every line must belong to this session's characters, and the export to this session
+    assert all(speaker.name in names for speaker, _ in state.history), "sessions leaked into each other"
+    assert session_id in audio_savepath and os.path.exists(audio_savepath)
+    return {"session_id": session_id, "turns": len(state.history), "timings": timings}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=args.latency, background=True)
+    os.environ["ELEVENLABS_API_ENDPOINT"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["ELEVENLABS_API_KEY"] = "fake"
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["CONVERSATION_STORE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    import app
+    app.ConversationState.AUDIO_SAVEDIR = tempfile.mkdtemp()
+    characters = list(app.CHARACTERS_DICT.keys())
+
+    time_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(
+            lambda i: run_session(app, [characters[i % len(characters)], characters[(i + 1) % len(characters)]]),
+            range(args.sessions)))
+    duration = time.perf_counter() - time_start
+
+    timings = sorted(t for result in results for t in result["timings"])
+    print(f"sessions: {args.sessions}, workers: {args.workers}")
+    print(f"distinct session ids: {len({result['session_id'] for result in results})}")
+    print(f"wall time: {duration:.2f} seconds")
+    print(f"handler latency p50: {statistics.median(timings):.3f} seconds, "
+          f"p95: {timings[int(0.95 * (len(timings) - 1))]:.3f} seconds")
+    print(f"sessions kept: {len(app.SESSIONS)}, store: {app.SESSIONS.stats}")
+    print(f"server: {server.api.stats}")
+    server.shutdown()
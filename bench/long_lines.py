@@ -0,0 +1,113 @@
+'''
+Measure time to first audio of long lines played through a SpeechStream and through play_history ("Play audio"),
+synthesized as one request against parallel sentence pieces stitched with crossfades, on a fake TTS backend whose
+latency grows with the text
+
+Usage:
+    long_lines.py [-n <lines>] [--min-chars <n>] [--max-chars <n>] [--split-chars <n>] [--tts-rate <r>]
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+parser = argparse.ArgumentParser(description='Benchmark sentence-level parallel synthesis of long lines')
+parser.add_argument('-n', '--lines', type=int, default=20, help='long lines per run (default: 20)')
+parser.add_argument('--min-chars', type=int, default=400, help='shortest line in characters (default: 400)')
+parser.add_argument('--max-chars', type=int, default=600, help='longest line in characters (default: 600)')
+parser.add_argument('--split-chars', type=int, default=200, help='TTS_SPLIT_CHARS of the split run (default: 200)')
+parser.add_argument('--tts-rate', type=float, default=0, help='TTS requests per second, 0 is unlimited (default: 0)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the lines and the fake backend (default: 0)')
+
+
+def lines(label: str) -> list:
+    # Unique, so nothing is a cache hit, and made of sentences of mixed lengths like real long answers
+    rng = random.Random(f"{label}-{args.seed}")
+    words = "the rocket will land on mars before the podcast ends and nobody will read the book".split()
+    result = []
+    for i in range(args.lines):
+        target = rng.randint(args.min_chars, args.max_chars)
+        line = f"{label} line {i}."
+        while len(line) < target:
+            clause = " ".join(rng.choices(words, k=rng.randint(4, 12)))
+            line += f" {clause.capitalize()}{rng.choice(['.', '.', ',', '?', '!'])}"
+        result.append(line)
+    return result
+
+
+class NullOutput:
+    def write(self, audio, samplerate: int):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(split_chars: int) -> dict:
+    from src import elevenlabs
+    from src.elevenlabs import SpeechStream
+
+    elevenlabs.TTS_SPLIT_CHARS = split_chars
+    label = "split" if split_chars else "single"
+    requests_before = tts.stats["requests"]
+    first_audio, whole = [], []
+    for text in lines(label):
+        stream = SpeechStream()
+        future = stream.add(text, speaker)
+        future.result()
+        whole.append(time.perf_counter() - stream.time_start)
+        stream.close()
+        first_audio.append(stream.time_to_first_audio)
+    return {"first_audio": np.percentile(first_audio, [50, 95]), "whole": np.percentile(whole, [50, 95]),
+            "backend_requests": tts.stats["requests"] - requests_before}
+
+
+def run_history(split_chars: int) -> dict:
+    import asyncio
+    from src import elevenlabs
+    from src.elevenlabs import play_history
+
+    elevenlabs.TTS_SPLIT_CHARS = split_chars
+    label = "history-split" if split_chars else "history-single"
+    requests_before = tts.stats["requests"]
+    first_audio, whole = [], []
+    for text in lines(label):
+        time_start = time.perf_counter()
+        report = asyncio.run(play_history([(speaker, text)]))
+        whole.append(time.perf_counter() - time_start)
+        first_audio.append(report.time_to_first_audio)
+    return {"first_audio": np.percentile(first_audio, [50, 95]), "whole": np.percentile(whole, [50, 95]),
+            "backend_requests": tts.stats["requests"] - requests_before}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = str(args.tts_rate)
+
+    from src import backends
+    from src.backends import LatencyModel
+    # Synthesis time grows with the text, like the real API
+    _, _, tts = backends.use_fakes(tts=LatencyModel(base=0.3, per_unit=0.008, jitter=0.1), seed=args.seed)
+    from src import elevenlabs
+    from src.elevenlabs import Speaker, check_voice_exists
+    # Only synthesis is measured, not the sound card
+    elevenlabs.AudioOutput = NullOutput
+    speaker = Speaker("ElonMusk", check_voice_exists("ElonMusk"), "red")
+
+    results = {"single": run(split_chars=0), "split": run(split_chars=args.split_chars),
+               "history single": run_history(split_chars=0), "history split": run_history(split_chars=args.split_chars)}
+    print(f"{args.lines} lines of {args.min_chars}-{args.max_chars} characters, "
+          f"split above {args.split_chars} characters")
+    print(f"{'':<16}{'first p50':>10}{'first p95':>10}{'whole p50':>10}{'whole p95':>10}{'requests':>10}")
+    for label, result in results.items():
+        print(f"{label:<16}{result['first_audio'][0]:10.3f}{result['first_audio'][1]:10.3f}"
+              f"{result['whole'][0]:10.3f}{result['whole'][1]:10.3f}{result['backend_requests']:10d}")
@@ -0,0 +1,67 @@
+'''
+Measure the cost of the metrics instrumentation per recorded span
+
+Usage:
+    metrics_overhead.py [-n <calls>]
+'''
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src import metrics
+
+parser = argparse.ArgumentParser(description='Benchmark metrics overhead')
+parser.add_argument('-n', '--calls', type=int, default=200000, help='calls per measurement (default: 200000)')
+
+
+def noop():
+    pass
+
+
+@metrics.timed("bench.sync")
+def timed_noop():
+    pass
+
+
+async def async_noop():
+    pass
+
+
+@metrics.timed("bench.async")
+async def timed_async_noop():
+    pass
+
+
+def per_call(fn, n: int) -> float:
+    time_start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - time_start) / n
+
+
+async def per_await(fn, n: int) -> float:
+    time_start = time.perf_counter()
+    for _ in range(n):
+        await fn()
+    return (time.perf_counter() - time_start) / n
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sync_cost = per_call(timed_noop, args.calls) - per_call(noop, args.calls)
+    async_cost = asyncio.run(per_await(timed_async_noop, args.calls)) - asyncio.run(per_await(async_noop, args.calls))
+
+    # Children of a long-lived parent, like the stages of a turn
+    with metrics.span("bench.turn"):
+        nested_cost = per_call(timed_noop, args.calls) - per_call(noop, args.calls)
+    metrics.METRICS.traces.clear()
+
+    print(f"timed function:  {sync_cost * 1e6:.2f} microseconds per call")
+    print(f"timed coroutine: {async_cost * 1e6:.2f} microseconds per call")
+    print(f"nested span:     {nested_cost * 1e6:.2f} microseconds per call")
+    print(f"histogram: {metrics.METRICS.histograms['bench.sync'].snapshot()}")
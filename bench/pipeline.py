@@ -0,0 +1,179 @@
+'''
+Drive full conversation turns (mic -> STT -> LLM -> TTS -> playback -> export) through in-process fake backends
+and report p50/p95/p99 latency per stage and end to end
+
+Usage:
+    pipeline.py [-t <turns>] [-c <conversations>] [--failure-rate <p>] [--save <json>] [--baseline <json>]
+
+With --baseline the run fails (exit code 1) when any p95 is more than --tolerance slower than the baseline,
+so it can gate performance changes. Save a baseline with --save first.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+parser = argparse.ArgumentParser(description='End to end latency benchmark on fake backends')
+parser.add_argument('-t', '--turns', type=int, default=10, help='turns per conversation (default: 10)')
+parser.add_argument('-c', '--conversations', type=int, default=4, help='concurrent conversations (default: 4)')
+parser.add_argument('--names', nargs='+', default=['ElonMusk', 'LexFridman'], help='characters talking')
+parser.add_argument('--jitter', type=float, default=0.2, help='log-normal jitter of every backend (default: 0.2)')
+parser.add_argument('--tail', type=float, default=0.02, help='probability of a long-tail request (default: 0.02)')
+parser.add_argument('--failure-rate', type=float, default=0.0, help='probability a TTS request fails with 503 (default: 0)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the fake backends (default: 0)')
+parser.add_argument('--save', help='write the percentiles to this json file')
+parser.add_argument('--baseline', help='compare against percentiles saved with --save')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 regression against the baseline (default: 0.2)')
+
+STAGES = ['stt', 'llm_first_line', 'llm', 'tts_first', 'tts_all', 'export', 'first_audio', 'turn']
+
+
+def fake_mic_recording(path: str, seed: int, seconds: float = 3.0, samplerate: int = 48000):
+    # Stereo 48 kHz with silence around the speech, like the browser hands over
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    voiced = 0.3 * np.sin(2 * np.pi * rng.uniform(120, 250) * t)
+    quiet = np.zeros(samplerate // 2)
+    mono = np.concatenate([quiet, voiced, quiet]) + 0.002 * rng.standard_normal(len(voiced) + 2 * len(quiet))
+    sf.write(path, np.stack([mono, mono], axis=1).astype(np.float32), samplerate, subtype='PCM_16')
+
+
+class NullOutput:
+    # Stands in for the sound card, SpeechStream stamps the first audio just before handing it over
+    def write(self, audio, samplerate: int):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_conversation(app, index: int, tmpdir: str) -> list:
+    from src.elevenlabs import SpeechStream, save_history
+    from src.openailib import speech_to_text, stream_response_lines
+
+    state = app.ConversationState(names=args.names, iam=args.names[0], session_id=f"bench-{index}")
+    turns = []
+    for turn in range(args.turns):
+        timings = {}
+        mic_path = os.path.join(tmpdir, f"mic-{index}-{turn}.wav")
+        # Every recording is different, so none of them is a transcript cache hit
+        fake_mic_recording(mic_path, seed=index * 10000 + turn)
+        try:
+            time_start = time.perf_counter()
+            state.add_to_history(speech_to_text(mic_path))
+            timings['stt'] = time.perf_counter() - time_start
+
+            # Lines go to TTS as soon as they are streamed and are played in order, like step_continue_stream
+            speech = SpeechStream()
+            try:
+                futures = []
+                for line in stream_response_lines(state.history_to_prompt(),
+                                                  system=state.system,
+                                                  model=state.model,
+                                                  max_tokens=state.max_tokens,
+                                                  temperature=state.temperature):
+                    parsed = state.parse_line(line)
+                    if parsed is None:
+                        continue
+                    state.add_to_history(parsed[1], speaker=parsed[0])
+                    futures.append(speech.add(parsed[1], parsed[0]))
+                    timings.setdefault('llm_first_line', time.perf_counter() - time_start)
+                timings['llm'] = time.perf_counter() - time_start
+
+                futures[0].result()
+                timings['tts_first'] = time.perf_counter() - time_start
+                for future in futures:
+                    future.result()
+                timings['tts_all'] = time.perf_counter() - time_start
+            finally:
+                speech.close()
+            # Playback has to decode the first clip (or its first piece) before anything is heard
+            timings['first_audio'] = speech.time_start - time_start + speech.time_to_first_audio
+
+            export_start = time.perf_counter()
+            history, append = state.pending_export()
+            asyncio.run(save_history(history, state.audio_savepath, append=append))
+            state.exported_history = state.history_signature()
+            timings['export'] = time.perf_counter() - export_start
+            timings['turn'] = time.perf_counter() - time_start
+        except Exception as e:
+            timings['failed'] = repr(e)
+        turns.append(timings)
+    return turns
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"n": len(values), "p50": p50, "p95": p95, "p99": p99}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    from src import backends
+    from src.backends import LatencyModel
+    # Roughly the latencies of the hosted providers
+    stt, llm, tts = backends.use_fakes(
+        stt=LatencyModel(base=0.3, per_unit=0.05, jitter=args.jitter, tail_probability=args.tail, tail_seconds=2.0),
+        llm=LatencyModel(base=0.4, jitter=args.jitter, tail_probability=args.tail, tail_seconds=2.0),
+        tts=LatencyModel(base=0.3, per_unit=0.005, jitter=args.jitter, tail_probability=args.tail, tail_seconds=2.0,
+                         failure_rate=args.failure_rate),
+        token_latency=0.02,
+        seed=args.seed,
+    )
+
+    import app
+    app.ConversationState.AUDIO_SAVEDIR = tempfile.mkdtemp()
+    from src import elevenlabs
+    # Only the pipeline is measured, not the sound card
+    elevenlabs.AudioOutput = NullOutput
+    from src import scheduler
+
+    time_start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir, ThreadPoolExecutor(max_workers=args.conversations) as executor:
+        results = list(executor.map(lambda i: run_conversation(app, i, tmpdir), range(args.conversations)))
+    wall = time.perf_counter() - time_start
+
+    turns = [timings for conversation in results for timings in conversation]
+    report = {stage: percentiles([t[stage] for t in turns if stage in t and 'failed' not in t]) for stage in STAGES}
+    failed = [t['failed'] for t in turns if 'failed' in t]
+
+    print(f"{args.conversations} conversations x {args.turns} turns in {wall:.1f} seconds, {len(failed)} failed turns")
+    print(f"{'stage':<16}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, stats in report.items():
+        if stats:
+            print(f"{stage:<16}{stats['p50']:9.3f}{stats['p95']:9.3f}{stats['p99']:9.3f}")
+    print(f"backend requests: stt {stt.stats}, llm {llm.stats}, tts {tts.stats}")
+    print(f"tts scheduler: {scheduler.TTS_SCHEDULER.stats}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = [
+            f"{stage}: p95 {report[stage]['p95']:.3f} vs {baseline[stage]['p95']:.3f} seconds"
+            for stage in STAGES
+            if report.get(stage) and baseline.get(stage)
+            and report[stage]['p95'] > baseline[stage]['p95'] * (1 + args.tolerance)
+        ]
+        if regressions:
+            print("Regressions against the baseline:\n\t" + "\n\t".join(regressions))
+            sys.exit(1)
+        print(f"No p95 regressed by more than {args.tolerance:.0%} against the baseline")
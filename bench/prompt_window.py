@@ -0,0 +1,43 @@
+'''
+Show that prompt size and build time stay flat as a conversation grows
+
+Usage:
+    prompt_window.py [-t <turns>] [-b <token budget>]
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.prompt import PromptWindow, count_tokens
+
+parser = argparse.ArgumentParser(description='Benchmark the token-budgeted prompt window')
+parser.add_argument('-t', '--turns', type=int, default=200, help='number of conversation turns (default: 200)')
+parser.add_argument('-b', '--budget', type=int, default=1000, help='prompt token budget (default: 1000)')
+
+
+def fake_summarize(summary: str, lines: list) -> str:
+    # Stands in for the LLM: a summary that stays short no matter how much it has seen
+    time.sleep(0.01)
+    return f"{len(lines)} more lines about rockets and literature. " + summary[:200]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    system = "You create funny conversation dialogues. " * 10
+    window = PromptWindow(budget=args.budget, system=system, summarize=fake_summarize)
+    full_transcript = ''
+    for turn in range(args.turns):
+        line = f"ElonMusk:This is turn {turn}, and it is a reasonably long line of witty banter.\n"
+        full_transcript += line
+        time_start = time.perf_counter()
+        window.append(line)
+        prompt = window.prompt()
+        duration = time.perf_counter() - time_start
+        if turn % (args.turns // 10 or 1) == 0 or turn == args.turns - 1:
+            print(f"turn {turn:4d}: prompt tokens {count_tokens(system) + count_tokens(prompt):5d}, "
+                  f"unbounded tokens {count_tokens(system) + count_tokens(full_transcript):6d}, "
+                  f"build time {duration * 1e6:7.1f} us")
@@ -0,0 +1,100 @@
+'''
+Measure perceived turn latency (click to first audio) with and without speculative turns, on fake backends.
+Between turns the user listens to the whole turn, which is when the next one is prepared.
+
+Usage:
+    speculation.py [-t <turns>] [--listen <factor>] [--interrupt <p>]
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+parser = argparse.ArgumentParser(description='Benchmark speculative pre-generation of the next turn')
+parser.add_argument('-t', '--turns', type=int, default=12, help='turns per run (default: 12)')
+parser.add_argument('--names', nargs='+', default=['ElonMusk', 'LexFridman'], help='characters talking')
+parser.add_argument('--listen', type=float, default=1.0,
+                    help='seconds the user listens per second of audio before continuing (default: 1.0)')
+parser.add_argument('--interrupt', type=float, default=0.0,
+                    help='probability the user speaks instead of continuing, discarding the speculation (default: 0)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the fake backends (default: 0)')
+
+
+def run(app, speculative: bool) -> list:
+    from src.audio import decode
+    from src.elevenlabs import PLAYBACK_FORMAT, prefetch_speech
+    from src.openailib import top_response
+
+    rng = random.Random(args.seed)
+    state = app.ConversationState(names=args.names, iam=args.names[0], session_id=f"speculation-{speculative}")
+    state.speculator.enabled = speculative
+    latencies = []
+    for turn in range(args.turns):
+        if rng.random() < args.interrupt:
+            # New mic input: the prepared turn continues a history that no longer exists
+            state.speculator.cancel()
+            state.add_to_history(f"Interrupting for the {turn}th time.")
+            state.speculate_next_turn()
+        # Same work as step_continue_stream up to the first clip being ready to play
+        time_start = time.perf_counter()
+        prepared = state.speculator.take(state.history_signature())
+        if prepared is not None:
+            lines = prepared
+        else:
+            response = top_response(state.history_to_prompt(), system=state.system, model=state.model,
+                                    max_tokens=state.max_tokens, temperature=state.temperature)
+            lines = []
+            for line in response.splitlines():
+                parsed = state.parse_line(line)
+                if parsed is not None:
+                    lines.append((*parsed, prefetch_speech(parsed[1], parsed[0], output_format=PLAYBACK_FORMAT)))
+        for speaker, text, _ in lines:
+            state.add_to_history(text, speaker=speaker)
+        clips = [decode(future.result(), PLAYBACK_FORMAT) for _, _, future in lines[:1]]
+        latencies.append(time.perf_counter() - time_start)
+        state.speculate_next_turn()
+        # The user hears the whole turn before clicking again
+        clips += [decode(future.result(), PLAYBACK_FORMAT) for _, _, future in lines[1:]]
+        time.sleep(args.listen * sum(len(audio) / samplerate for audio, samplerate in clips))
+    state.speculator.cancel()
+    return latencies
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["TTS_RATE_PER_SECOND"] = "0"
+
+    from src import backends
+    from src.backends import LatencyModel
+    backends.use_fakes(
+        llm=LatencyModel(base=0.6, jitter=0.2),
+        tts=LatencyModel(base=0.4, per_unit=0.005, jitter=0.2),
+        token_latency=0.02,
+        seed=args.seed,
+    )
+
+    import app
+    app.ConversationState.AUDIO_SAVEDIR = tempfile.mkdtemp()
+    from src.metrics import METRICS
+
+    baseline = run(app, speculative=False)
+    speculative = run(app, speculative=True)
+    counters = METRICS.counters
+    print(f"{args.turns} turns, listening {args.listen:.1f}x the audio, {args.interrupt:.0%} interrupted")
+    print(f"{'':<14}{'p50':>9}{'p95':>9}{'max':>9}")
+    for label, latencies in (("on demand", baseline), ("speculative", speculative)):
+        p50, p95 = np.percentile(latencies, [50, 95])
+        print(f"{label:<14}{p50:9.3f}{p95:9.3f}{max(latencies):9.3f}")
+    print(f"speculation: {counters.get('speculation.started', 0)} started, {counters.get('speculation.hits', 0)} used, "
+          f"{counters.get('speculation.discarded', 0)} discarded, "
+          f"{counters.get('speculation.wasted_characters', 0)} characters of audio and "
+          f"{counters.get('speculation.wasted_tokens', 0)} tokens wasted")
@@ -0,0 +1,45 @@
+'''
+Measure how long importing the app takes and how long until the default conversation is ready
+
+Usage:
+    startup.py [--latency <seconds>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+
+parser = argparse.ArgumentParser(description='Benchmark application startup against a fake server')
+parser.add_argument('--latency', type=float, default=0.3, help='fake server latency per request (default: 0.3)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=args.latency, background=True)
+    # Every API call pays the configured latency, not just synthesis
+    server.api.latency_all = True
+    os.environ["ELEVENLABS_API_ENDPOINT"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["ELEVENLABS_API_KEY"] = "fake"
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ["CONVERSATION_STORE_DIR"] = tempfile.mkdtemp()
+
+    time_start = time.perf_counter()
+    import app
+    import_time = time.perf_counter() - time_start
+    # What `python app.py` does before serving
+    app.start_background()
+    app._WARM_UP.join()
+    ready_time = time.perf_counter() - time_start
+
+    print(f"import time: {import_time:.2f} seconds")
+    print(f"time to ready: {ready_time:.2f} seconds")
+    print(f"server requests: {server.api.stats['requests']}")
+    server.shutdown()
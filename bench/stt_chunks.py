@@ -0,0 +1,79 @@
+'''
+Compare transcription wall time of a long recording sent in one request against concurrent chunks split at pauses
+
+Usage:
+    stt_chunks.py [--minutes <minutes>] [--chunk <seconds>] [--workers <n>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+
+parser = argparse.ArgumentParser(description='Benchmark chunked STT against a fake server')
+parser.add_argument('--minutes', type=float, default=3.0, help='length of the recording (default: 3)')
+parser.add_argument('--chunk', type=float, default=30.0, help='maximum chunk length in seconds (default: 30)')
+parser.add_argument('--workers', type=int, default=4, help='concurrent chunk requests (default: 4)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+
+def fake_monologue(path: str, minutes: float, seed: int, samplerate: int = 16000):
+    # Phrases of 3-9 seconds separated by half second pauses, with a little room noise
+    rng = np.random.default_rng(seed)
+    pieces = []
+    total = 0
+    while total < minutes * 60 * samplerate:
+        t = np.arange(int(rng.uniform(3, 9) * samplerate)) / samplerate
+        pieces.append(0.3 * np.sin(2 * np.pi * rng.uniform(120, 250) * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t)))
+        pieces.append(np.zeros(int(0.5 * samplerate)))
+        total += len(pieces[-1]) + len(pieces[-2])
+    mono = np.concatenate(pieces)
+    mono += 0.002 * rng.standard_normal(len(mono))
+    sf.write(path, mono.astype(np.float32), samplerate, subtype='PCM_16')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=0.2, background=True)
+    # Roughly the pace of the hosted Whisper API
+    server.api.stt_seconds_per_audio_second = 0.05
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+
+    from src import audio, openailib
+    audio.warm_up()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        single_path = os.path.join(tmpdir, "single.wav")
+        chunked_path = os.path.join(tmpdir, "chunked.wav")
+        # Different seeds, so the second run is not a transcript cache hit
+        fake_monologue(single_path, args.minutes, seed=0)
+        fake_monologue(chunked_path, args.minutes, seed=1)
+
+        time_start = time.perf_counter()
+        openailib.speech_to_text(single_path)
+        single_time = time.perf_counter() - time_start
+
+        requests_before = server.api.stats["stt_requests"]
+        time_start = time.perf_counter()
+        first_partial = None
+        for partial in openailib.speech_to_text_stream(chunked_path, args.chunk, args.workers):
+            first_partial = first_partial or time.perf_counter() - time_start
+        chunked_time = time.perf_counter() - time_start
+        chunks = server.api.stats["stt_requests"] - requests_before
+
+    print(f"recording: {args.minutes} minutes")
+    print(f"single request:  {single_time:.3f} seconds")
+    print(f"{chunks} chunks ({args.workers} workers): {chunked_time:.3f} seconds, "
+          f"first partial transcript after {first_partial:.3f} seconds")
+    server.shutdown()
@@ -0,0 +1,71 @@
+'''
+Compare upload size and transcription latency of raw microphone recordings against preprocessed ones
+
+Usage:
+    stt_preprocess.py [--speech <seconds>] [--silence <seconds>]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+
+parser = argparse.ArgumentParser(description='Benchmark STT preprocessing against a fake server')
+parser.add_argument('--speech', type=float, default=4.0, help='seconds of speech in the recording (default: 4)')
+parser.add_argument('--silence', type=float, default=1.5, help='seconds of silence before and after (default: 1.5)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+
+def fake_recording(path: str, speech: float, silence: float, samplerate: int = 48000):
+    # What a browser typically hands over: 48 kHz stereo WAV with room noise around the speech
+    rng = np.random.default_rng(0)
+    t = np.arange(int(speech * samplerate)) / samplerate
+    voiced = 0.3 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))
+    quiet = np.zeros(int(silence * samplerate))
+    mono = np.concatenate([quiet, voiced, quiet]) + 0.002 * rng.standard_normal(len(quiet) * 2 + len(voiced))
+    sf.write(path, np.stack([mono, mono], axis=1).astype(np.float32), samplerate, subtype='PCM_16')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=0.2, background=True)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+
+    from src import audio, openailib
+    from src.audio import prepare_for_transcription
+    audio.warm_up()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {}
+        for preprocess in (False, True):
+            path = os.path.join(tmpdir, f"recording_{preprocess}.wav")
+            # Different seeds, so the second run is not a transcript cache hit
+            fake_recording(path, args.speech + 0.01 * preprocess, args.silence)
+            bytes_before = server.api.stats["stt_bytes"]
+            time_start = time.perf_counter()
+            openailib.speech_to_text(path, preprocess=preprocess)
+            results[preprocess] = (server.api.stats["stt_bytes"] - bytes_before, time.perf_counter() - time_start)
+        time_start = time.perf_counter()
+        prepare_for_transcription(path)
+        preprocess_time = time.perf_counter() - time_start
+        time_start = time.perf_counter()
+        openailib.speech_to_text(path)
+        cached_time = time.perf_counter() - time_start
+
+    print(f"recording: {args.speech} seconds of speech, {args.silence} seconds of silence either side")
+    print(f"raw upload:          {results[False][0] / 1e3:8.1f} kB, transcription {results[False][1]:.3f} seconds")
+    print(f"preprocessed upload: {results[True][0] / 1e3:8.1f} kB, transcription {results[True][1]:.3f} seconds "
+          f"(of which preprocessing {preprocess_time:.3f} seconds)")
+    print(f"repeated recording:  cache hit in {cached_time:.4f} seconds")
+    server.shutdown()
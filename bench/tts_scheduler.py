@@ -0,0 +1,57 @@
+'''
+Synthesize a long conversation through the shared TTS scheduler against the fake ElevenLabs server
+
+Usage:
+    tts_scheduler.py [-n <turns>] [--concurrency <workers>] [--rate <requests per second>]
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_tts_server import serve
+
+parser = argparse.ArgumentParser(description='Benchmark the TTS scheduler against a fake server')
+parser.add_argument('-n', '--turns', type=int, default=40, help='number of conversation turns (default: 40)')
+parser.add_argument('--concurrency', type=int, default=4, help='scheduler worker count (default: 4)')
+parser.add_argument('--rate', type=float, default=5.0, help='scheduler requests per second (default: 5)')
+parser.add_argument('--server-rate-limit', type=float, default=4.0, help='fake server 429 threshold (default: 4)')
+parser.add_argument('--port', type=int, default=8123, help='fake server port (default: 8123)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args.port, latency=0.3, rate_limit=args.server_rate_limit, background=True)
+    os.environ["ELEVENLABS_API_ENDPOINT"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["ELEVENLABS_API_KEY"] = "fake"
+    os.environ["SPEECH2SPEECH_CACHE_DIR"] = tempfile.mkdtemp()
+
+    from src import elevenlabs
+    from src.scheduler import PRIORITY_EXPORT, configure_tts_scheduler
+
+    scheduler = configure_tts_scheduler(max_workers=args.concurrency, rate_per_second=args.rate)
+    voice = elevenlabs.get_user().get_voices_by_name("ElonMusk")[0]
+    speaker = elevenlabs.Speaker(name="ElonMusk", voice=voice, color="#FFFFFF")
+    history = [(speaker, f"This is line number {i} of the conversation.") for i in range(args.turns)]
+
+    async def synthesize_all():
+        # Same fan-out as save_history: everything at once, the scheduler does the limiting
+        return await asyncio.gather(*[
+            elevenlabs.text_to_speechbytes_async(text, speaker, priority=(PRIORITY_EXPORT, i))
+            for i, (speaker, text) in enumerate(history)])
+
+    time_start = time.perf_counter()
+    asyncio.run(synthesize_all())
+    duration = time.perf_counter() - time_start
+
+    print(f"turns: {args.turns}")
+    print(f"synthesis time: {duration:.2f} seconds")
+    print(f"scheduler: {scheduler.stats}")
+    print(f"server: {server.api.stats}")
+    server.shutdown()
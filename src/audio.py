@@ -0,0 +1,307 @@
+import io
+import logging
+import os
+from math import gcd
+from typing import List, Tuple, Union
+
+import numpy as np
+import soundfile as sf
+
+from .metrics import timed
+
+log = logging.getLogger(__name__)
+
+
+def pcm_samplerate(output_format: str) -> Union[int, None]:
+    # ElevenLabs style format names: pcm_22050 is raw 16 bit little-endian mono at 22050 Hz
+    if output_format and output_format.startswith("pcm_"):
+        return int(output_format.split("_")[1])
+    return None
+
+
+def as_float32(audio: np.ndarray) -> np.ndarray:
+    if audio.dtype == np.int16:
+        return audio.astype(np.float32) / 32768.0
+    return audio
+
+
+@timed("decode")
+def decode(speech_bytes: bytes, output_format: str = None) -> Tuple[np.ndarray, int]:
+    # Always 2D (frames, channels) so clips can be stacked and written uniformly
+    samplerate = pcm_samplerate(output_format)
+    if samplerate is not None:
+        # Raw PCM needs no decoding at all: an int16 view of the bytes, which players and writers take as is
+        return np.frombuffer(speech_bytes, dtype='<i2').reshape(-1, 1), samplerate
+    with sf.SoundFile(io.BytesIO(speech_bytes)) as soundFile:
+        audio = soundFile.read(dtype='float32', always_2d=True)
+        return audio, soundFile.samplerate
+
+
+class ClipDecoder:
+    """ Decodes clips one after another into a reused buffer, so compressed audio costs no allocation per clip.
+
+    Each result is a view that is only valid until the next call, consume it (play, write) first.
+    """
+
+    def __init__(self, output_format: str = None):
+        self.output_format = output_format
+        self._buffer: np.ndarray = np.empty((0, 1), dtype=np.float32)
+
+    @timed("decode")
+    def decode(self, speech_bytes: bytes) -> Tuple[np.ndarray, int]:
+        samplerate = pcm_samplerate(self.output_format)
+        if samplerate is not None:
+            return np.frombuffer(speech_bytes, dtype='<i2').reshape(-1, 1), samplerate
+        with sf.SoundFile(io.BytesIO(speech_bytes)) as soundFile:
+            frames, channels = soundFile.frames, soundFile.channels
+            if self._buffer.shape[0] < frames or self._buffer.shape[1] != channels:
+                # Grow with headroom so slightly longer clips do not reallocate every time
+                self._buffer = np.empty((int(frames * 1.5), channels), dtype=np.float32)
+            audio = soundFile.read(frames, out=self._buffer[:frames])
+            return audio, soundFile.samplerate
+
+
+def resample(audio: np.ndarray, samplerate: int, target_samplerate: int) -> np.ndarray:
+    if samplerate == target_samplerate:
+        return audio
+    audio = as_float32(audio)
+    # scipy.signal takes over a second to import and is rarely needed, so only load it here
+    from scipy.signal import resample_poly
+    divisor = gcd(samplerate, target_samplerate)
+    return resample_poly(audio, target_samplerate // divisor, samplerate // divisor, axis=0).astype(np.float32)
+
+
+def warm_up():
+    # Pays the scipy.signal import off the request path, e.g. from a startup thread
+    import scipy.signal  # noqa: F401
+
+
+def match_channels(audio: np.ndarray, channels: int) -> np.ndarray:
+    if audio.shape[1] == channels:
+        return audio
+    audio = as_float32(audio)
+    if channels == 1:
+        return audio.mean(axis=1, keepdims=True)
+    # Upmix by repeating the (downmixed) signal on every channel
+    return np.repeat(audio.mean(axis=1, keepdims=True), channels, axis=1)
+
+
+def trim_silence(audio: np.ndarray,
+                 samplerate: int,
+                 frame_ms: int = 30,
+                 threshold_db: float = -35.0,
+                 pad_ms: int = 200) -> np.ndarray:
+    """ Energy based voice activity trimming: drops leading and trailing frames quieter than
+    `threshold_db` below the loudest frame, keeping `pad_ms` of context on each side. """
+    frame = max(1, int(samplerate * frame_ms / 1000))
+    mono = audio.mean(axis=1) if audio.ndim == 2 else audio
+    frames = len(mono) // frame
+    if frames == 0:
+        return audio
+    rms = np.sqrt(np.mean(mono[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+    db = 20 * np.log10(np.maximum(rms, 1e-10))
+    active = np.flatnonzero(db > max(db.max() + threshold_db, -70.0))
+    if len(active) == 0:
+        return audio
+    pad = int(samplerate * pad_ms / 1000)
+    start = max(0, active[0] * frame - pad)
+    end = min(len(audio), (active[-1] + 1) * frame + pad)
+    return audio[start:end]
+
+
+def load_for_transcription(audio_path: str, samplerate: int = 16000) -> np.ndarray:
+    """ Reads a recording trimmed of leading and trailing silence, as mono at `samplerate`. """
+    audio, original_samplerate = sf.read(audio_path, dtype='float32', always_2d=True)
+    audio = trim_silence(audio, original_samplerate)
+    return resample(match_channels(audio, 1), original_samplerate, samplerate)
+
+
+@timed("encode")
+def encode_for_upload(audio: np.ndarray, samplerate: int = 16000) -> Tuple[bytes, str]:
+    """ Encodes compactly, returning the bytes and a filename whose extension tells the API the format. """
+    try:
+        return _encode(audio, samplerate, format='OGG', subtype='VORBIS'), "speech.ogg"
+    except (sf.LibsndfileError, ValueError, TypeError):
+        # Older libsndfile builds without Vorbis support
+        return _encode(audio, samplerate, format='FLAC'), "speech.flac"
+
+
+def _encode(audio: np.ndarray, samplerate: int, block_seconds: int = 10, **format) -> bytes:
+    buffer = io.BytesIO()
+    channels = audio.shape[1] if audio.ndim == 2 else 1
+    block = block_seconds * samplerate
+    # libsndfile's Vorbis encoder crashes on very long single writes, so feed it in blocks
+    with sf.SoundFile(buffer, mode='w', samplerate=samplerate, channels=channels, **format) as soundFile:
+        for start in range(0, len(audio), block):
+            soundFile.write(audio[start:start + block])
+    return buffer.getvalue()
+
+
+def prepare_for_transcription(audio_path: str, samplerate: int = 16000) -> Tuple[bytes, str]:
+    """ Trims silence, downmixes to mono, resamples to `samplerate` and encodes compactly for upload. """
+    return encode_for_upload(load_for_transcription(audio_path, samplerate), samplerate)
+
+
+def split_at_silence(audio: np.ndarray,
+                     samplerate: int,
+                     max_chunk_seconds: float = 30.0,
+                     frame_ms: int = 30,
+                     min_silence_ms: int = 300) -> List[Tuple[int, int]]:
+    """ (start, end) sample ranges of at most `max_chunk_seconds`, cut in the middle of pauses where possible. """
+    max_chunk = int(max_chunk_seconds * samplerate)
+    if len(audio) <= max_chunk:
+        return [(0, len(audio))]
+    frame = max(1, int(samplerate * frame_ms / 1000))
+    mono = audio.mean(axis=1) if audio.ndim == 2 else audio
+    frames = len(mono) // frame
+    rms = np.sqrt(np.mean(mono[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+    db = 20 * np.log10(np.maximum(rms, 1e-10))
+    silent = db < max(db.max() - 35.0, -70.0)
+    # Runs of silent frames, found by diffing the padded boolean mask
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], silent.astype(np.int8), [0]])))
+    starts, ends = edges[0::2], edges[1::2]
+    long_enough = (ends - starts) * frame_ms >= min_silence_ms
+    cut_points = ((starts[long_enough] + ends[long_enough]) // 2) * frame
+    chunks = []
+    start = 0
+    while len(audio) - start > max_chunk:
+        candidates = cut_points[(cut_points > start) & (cut_points <= start + max_chunk)]
+        # Without a pause in range, fall back to a hard cut
+        end = int(candidates[-1]) if len(candidates) else start + max_chunk
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, len(audio)))
+    return chunks
+
+
+class PCMStitcher:
+    """ Joins consecutive clips of one utterance with a short linear crossfade, one clip at a time.
+
+    `add` returns what can be played (or written) right away: the clip with the previous clip's tail
+    faded into its start, minus its own tail, which is held back for the next clip. The last clip is
+    added with last=True and is returned whole. Works on int16 (n, channels) arrays.
+    """
+
+    def __init__(self, fade_samples: int):
+        self.fade_samples = fade_samples
+        self._tail: np.ndarray = None
+
+    def add(self, audio: np.ndarray, last: bool = False) -> np.ndarray:
+        fade = min(self.fade_samples, len(audio) // 2)
+        if self._tail is not None:
+            fade = min(fade, len(self._tail))
+            ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None]
+            mixed = self._tail[len(self._tail) - fade:] * (1.0 - ramp) + audio[:fade] * ramp
+            audio = np.concatenate([self._tail[:len(self._tail) - fade],
+                                    mixed.astype(np.int16), audio[fade:]])
+        if last:
+            self._tail = None
+            return audio
+        # Copied, the caller may reuse the buffer `audio` came from (see ClipDecoder)
+        self._tail = audio[len(audio) - self.fade_samples:].copy()
+        return audio[:len(audio) - self.fade_samples]
+
+
+def stitch_pcm(pieces: List[bytes], samplerate: int, fade_ms: float = 20.0) -> bytes:
+    """ Raw 16 bit mono PCM pieces of one utterance, crossfaded into one clip of the same format. """
+    stitcher = PCMStitcher(int(samplerate * fade_ms / 1000))
+    return b"".join(stitcher.add(np.frombuffer(piece, dtype='<i2').reshape(-1, 1), last=i == len(pieces) - 1).tobytes()
+                    for i, piece in enumerate(pieces))
+
+
+# Export formats by file extension. The compressed ones are written as a stream, so a partial file already plays
+EXPORT_FORMATS = {
+    "wav": {},
+    "mp3": {"format": "MP3", "subtype": "MPEG_LAYER_III"},
+    "ogg": {"format": "OGG", "subtype": "OPUS"},
+}
+# Opus only encodes these rates
+OPUS_SAMPLERATES = (8000, 12000, 16000, 24000, 48000)
+
+
+class ClipWriter:
+    """ Appends decoded clips to an audio file one at a time, converting each to a common format.
+
+    The first clip fixes the sample rate and channel layout unless they are given up front. With
+    append=True an existing file is extended in place and keeps its own format, which only works
+    for wav. Compressed formats (see EXPORT_FORMATS) are flushed after every clip, so readers of
+    the file see each clip as soon as the encoder wrote it out, see `playable`.
+    """
+
+    def __init__(self,
+                 path: str,
+                 samplerate: int = None,
+                 channels: int = None,
+                 gap_seconds: float = 0.0,
+                 append: bool = False,
+                 export_format: str = "wav"):
+        self.path = path
+        self.samplerate = samplerate
+        self.channels = channels
+        self.gap_seconds = gap_seconds
+        self.format = EXPORT_FORMATS[export_format]
+        self.clips_written: int = 0
+        self.frames_written: int = 0
+        self._file: sf.SoundFile = None
+        self._has_audio: bool = False
+        self._playable: bool = False
+        if append and os.path.exists(path) and not self.format:
+            # libsndfile rewrites the header with the new length when the file is closed
+            self._file = sf.SoundFile(path, mode='r+')
+            self._file.seek(0, sf.SEEK_END)
+            self.samplerate = self._file.samplerate
+            self.channels = self._file.channels
+            self._has_audio = self._file.frames > 0
+
+    def write(self, audio: np.ndarray, samplerate: int):
+        if self._file is None:
+            self.samplerate = self.samplerate or samplerate
+            if self.format.get("subtype") == "OPUS":
+                self.samplerate = min((rate for rate in OPUS_SAMPLERATES if rate >= self.samplerate),
+                                      default=OPUS_SAMPLERATES[-1])
+            self.channels = self.channels or audio.shape[1]
+            self._file = sf.SoundFile(self.path, mode='w', samplerate=self.samplerate, channels=self.channels,
+                                      **self.format)
+        audio = match_channels(resample(audio, samplerate, self.samplerate), self.channels)
+        if self._has_audio and self.gap_seconds > 0:
+            silence = np.zeros((int(self.gap_seconds * self.samplerate), self.channels), dtype=np.float32)
+            self._file.write(silence)
+            self.frames_written += len(silence)
+        # Same blocks as _encode, the compressed encoders do not like very long single writes
+        block = 10 * self.samplerate
+        for start in range(0, len(audio), block):
+            self._file.write(audio[start:start + block])
+        self.frames_written += len(audio)
+        self.clips_written += 1
+        self._has_audio = True
+        if self.format:
+            self._file.flush()
+
+    @property
+    def playable(self) -> bool:
+        """ Whether the file on disk holds decodable audio yet, not just headers. """
+        if not self._playable and self.frames_written > 0:
+            if not self.format:
+                self._playable = True
+            else:
+                # Ogg only writes a page once about a second of audio is buffered, until then
+                # the file is headers alone and readers reject it as malformed
+                try:
+                    self._playable = sf.info(self.path).frames > 0
+                except RuntimeError:
+                    pass
+        return self._playable
+
+    def write_bytes(self, speech_bytes: bytes, output_format: str = None):
+        self.write(*decode(speech_bytes, output_format))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
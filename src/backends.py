@@ -0,0 +1,265 @@
+import hashlib
+import io
+import logging
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Protocol
+
+import numpy as np
+import soundfile as sf
+
+log = logging.getLogger(__name__)
+
+
+class STTBackend(Protocol):
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        ...
+
+
+class LLMBackend(Protocol):
+
+    def complete(self, messages: List[Dict], model: str, max_tokens: int, temperature: float) -> str:
+        ...
+
+    def stream(self, messages: List[Dict], model: str, max_tokens: int, temperature: float) -> Iterator[str]:
+        """ Yields pieces of the reply as they are generated. """
+        ...
+
+
+class TTSBackend(Protocol):
+
+    def voices(self) -> List:
+        """ Every voice of the account, each with a `voiceID` and an `initialName`. """
+        ...
+
+    def synthesize(self, text: str, voice, settings: Dict, model: str, output_format: str = None) -> bytes:
+        """ Raw 16 bit mono PCM for output formats like pcm_22050, the provider's compressed default for None. """
+        ...
+
+
+# The backends in use. None means the real provider, see openailib.OpenAIBackend and elevenlabs.ElevenLabsBackend
+STT: STTBackend = None
+LLM: LLMBackend = None
+TTS: TTSBackend = None
+
+
+def set_backends(stt: STTBackend = None, llm: LLMBackend = None, tts: TTSBackend = None):
+    # Only replaces the backends that are given
+    global STT, LLM, TTS
+    STT = stt or STT
+    LLM = llm or LLM
+    TTS = tts or TTS
+
+
+def reset_backends():
+    global STT, LLM, TTS
+    STT = LLM = TTS = None
+
+
+class LimitedBackend:
+    """ Wraps a backend so at most as many calls run at once as `semaphore` allows. With a
+    multiprocessing semaphore the limit holds across every process of a pool. """
+
+    def __init__(self, backend, semaphore):
+        self.backend = backend
+        self.semaphore = semaphore
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def limited(*args, **kwargs):
+            # Only holds the slot until the call returns, a generator (LLM stream) is not limited while iterated
+            with self.semaphore:
+                return attr(*args, **kwargs)
+        return limited
+
+
+class BackendError(Exception):
+    """ A failed provider request. `status_code` is what the scheduler's retry logic looks at. """
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class LatencyModel:
+    """ How long a fake request takes: `base` plus `per_unit` per unit of work (characters, seconds of audio, tokens),
+    scaled by log-normal jitter, sometimes stretched into a long tail, and sometimes failing outright. """
+    base: float = 0.0
+    per_unit: float = 0.0
+    # Sigma of the log-normal multiplier, 0 for no jitter
+    jitter: float = 0.0
+    tail_probability: float = 0.0
+    tail_seconds: float = 0.0
+    failure_rate: float = 0.0
+    failure_status: int = 503
+
+    def sample(self, rng: random.Random, units: float = 0.0) -> float:
+        delay = self.base + self.per_unit * units
+        if self.jitter:
+            delay *= rng.lognormvariate(0.0, self.jitter)
+        if self.tail_probability and rng.random() < self.tail_probability:
+            delay += self.tail_seconds
+        return delay
+
+    def fails(self, rng: random.Random) -> bool:
+        return bool(self.failure_rate) and rng.random() < self.failure_rate
+
+
+class FakeBackend:
+    """ Base of the in-process fakes: sleeps according to a `LatencyModel` and fails on cue.
+
+    Every request draws from its own generator, seeded from `seed`, the request and how often that
+    request was made before, so a run is reproducible no matter how threads interleave.
+    """
+
+    def __init__(self, latency: LatencyModel = None, seed: int = 0):
+        self.latency = latency or LatencyModel()
+        self.seed = seed
+        self._attempts: Counter = Counter()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"requests": 0, "failures": 0}
+
+    def _rng(self, request: str) -> random.Random:
+        digest = hashlib.sha256(request.encode("utf-8")).hexdigest()
+        with self._lock:
+            attempt = self._attempts[digest]
+            self._attempts[digest] += 1
+            self.stats["requests"] += 1
+        return random.Random(f"{self.seed}:{type(self).__name__}:{digest}:{attempt}")
+
+    def _wait(self, rng: random.Random, units: float = 0.0):
+        time.sleep(self.latency.sample(rng, units))
+        if self.latency.fails(rng):
+            with self._lock:
+                self.stats["failures"] += 1
+            raise BackendError(f"{type(self).__name__} injected failure", self.latency.failure_status)
+
+
+class FakeSTT(FakeBackend):
+    """ Transcribes anything to the same sentence, taking longer for longer recordings. """
+
+    TEXT: str = "Hello there, this is what I said into the microphone."
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        try:
+            duration = sf.info(io.BytesIO(audio_bytes)).duration
+        except RuntimeError:
+            duration = 0.0
+        self._wait(self._rng(hashlib.sha256(audio_bytes).hexdigest()), units=duration)
+        return self.TEXT
+
+
+class FakeLLM(FakeBackend):
+    """ Replies with one line per character named in the system prompt, in the "Name: text" format the app parses.
+
+    `latency` is the time to the first token, `token_latency` the time for each token after it.
+    """
+
+    def __init__(self, latency: LatencyModel = None, token_latency: float = 0.0, seed: int = 0):
+        super().__init__(latency, seed)
+        self.token_latency = token_latency
+        self._replies = 0
+
+    def _reply(self, messages: List[Dict], max_tokens: int) -> str:
+        system = " ".join(m["content"] for m in messages if m["role"] == "system")
+        match = re.search(r"This conversation is between (.*?)\.", system)
+        names = [name.strip() for name in match.group(1).split(",")] if match else ["Narrator"]
+        with self._lock:
+            # Every reply is new, like a sampled completion, so TTS never gets it from the cache
+            self._replies += 1
+            reply = self._replies
+        lines = [f"{name}: This is line {reply}.{i} of a very witty conversation." for i, name in enumerate(names)]
+        # Words stand in for tokens
+        return " ".join("\n".join(lines).split(" ")[:max(1, max_tokens)])
+
+    def complete(self, messages: List[Dict], model: str, max_tokens: int, temperature: float) -> str:
+        # The whole reply arrives at once, after every token was generated
+        return "".join(self.stream(messages, model, max_tokens, temperature))
+
+    def stream(self, messages: List[Dict], model: str, max_tokens: int, temperature: float) -> Iterator[str]:
+        reply = self._reply(messages, max_tokens)
+        self._wait(self._rng(reply))
+        for i, word in enumerate(reply.split(" ")):
+            if i:
+                time.sleep(self.token_latency)
+            yield word if i == 0 else " " + word
+
+
+@dataclass
+class FakeVoice:
+    voiceID: str
+    initialName: str
+
+
+class FakeTTS(FakeBackend):
+    """ Synthesizes a tone about as long as the text would take to say. `latency.per_unit` is per character. """
+
+    def __init__(self, latency: LatencyModel = None, names: List[str] = None, samplerate: int = 22050, seed: int = 0):
+        super().__init__(latency, seed)
+        self.samplerate = samplerate
+        self.names = names
+        self.stats["characters"] = 0
+
+    def voices(self) -> List[FakeVoice]:
+        names = self.names
+        if names is None:
+            import yaml
+            voices_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'voices.yaml')
+            with open(voices_path) as f:
+                names = list(yaml.safe_load(f))
+        return [FakeVoice(voiceID=hashlib.sha256(name.encode()).hexdigest()[:20], initialName=name) for name in names]
+
+    def synthesize(self, text: str, voice, settings: Dict, model: str, output_format: str = None) -> bytes:
+        self._wait(self._rng(f"{voice.voiceID}:{text}"), units=len(text))
+        with self._lock:
+            self.stats["characters"] += len(text)
+        return synth_speech(text, self.samplerate, output_format)
+
+
+def synth_speech(text: str, samplerate: int = 22050, output_format: str = None) -> bytes:
+    # A quiet tone whose length grows with the text, roughly like speech. MP3 like the ElevenLabs
+    # default, or raw 16 bit PCM when asked for e.g. pcm_16000
+    if output_format and output_format.startswith("pcm_"):
+        samplerate = int(output_format.split("_")[1])
+    duration = 0.3 + 0.06 * len(text)
+    pitch = 200 + (zlib.crc32(text.encode()) % 200)
+    t = np.arange(int(duration * samplerate)) / samplerate
+    audio = (0.1 * np.sin(2 * np.pi * pitch * t)).astype(np.float32)
+    if output_format and output_format.startswith("pcm_"):
+        return (audio * 32767).astype('<i2').tobytes()
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, samplerate, format='MP3')
+    return buffer.getvalue()
+
+
+def use_fakes(stt: LatencyModel = None,
+              llm: LatencyModel = None,
+              tts: LatencyModel = None,
+              token_latency: float = 0.0,
+              seed: int = 0):
+    """ Swaps every provider for an in-process fake, returns the (stt, llm, tts) fakes. """
+    fakes = (FakeSTT(stt, seed=seed), FakeLLM(llm, token_latency=token_latency, seed=seed), FakeTTS(tts, seed=seed))
+    set_backends(*fakes)
+    log.info("Using fake STT, LLM and TTS backends")
+    return fakes
+
+
+# Run the whole app offline, with no accounts, e.g. for demos and benchmarks
+if os.environ.get("SPEECH2SPEECH_BACKEND") == "fake":
+    use_fakes(
+        stt=LatencyModel(base=0.3, per_unit=0.05, jitter=0.2),
+        llm=LatencyModel(base=0.4, jitter=0.2),
+        tts=LatencyModel(base=0.3, per_unit=0.005, jitter=0.2),
+        token_latency=0.02,
+    )
@@ -0,0 +1,138 @@
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Enough for every TTS worker plus concurrent STT chunks and LLM streams
+HTTP_POOL_SIZE: int = int(os.environ.get("HTTP_POOL_SIZE", 16))
+# Seconds a connection may sit idle before the kernel starts sending TCP keep-alive probes
+HTTP_KEEPALIVE: int = int(os.environ.get("HTTP_KEEPALIVE", 60))
+HTTP_CONNECT_TIMEOUT: float = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5.0))
+HTTP_READ_TIMEOUT: float = float(os.environ.get("HTTP_READ_TIMEOUT", 120.0))
+
+
+def keepalive_socket_options(idle: int) -> list:
+    options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Linux and macOS name the idle time differently, Windows has neither
+    for name in ("TCP_KEEPIDLE", "TCP_KEEPALIVE"):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), idle))
+            break
+    return options
+
+
+class _TimedConnection:
+    # Set on the per-provider subclasses below
+    provider: str = None
+
+    def connect(self):
+        # TCP connect plus, for https, the TLS handshake: the cost a reused connection avoids
+        time_start = time.perf_counter()
+        super().connect()
+        metrics.METRICS.observe(f"http.handshake.{self.provider}", time.perf_counter() - time_start)
+        metrics.METRICS.incr(f"http.connections.{self.provider}")
+
+
+class PooledAdapter(HTTPAdapter):
+    """ Requests adapter with a fixed-size blocking connection pool, TCP keep-alive, default timeouts and
+    counters for connections opened and handshake time, per provider. """
+
+    def __init__(self,
+                 provider: str,
+                 pool_size: int = HTTP_POOL_SIZE,
+                 keepalive: int = HTTP_KEEPALIVE,
+                 timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                 max_retries: int = 2):
+        self.provider = provider
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # Per provider connection classes, so the counters know who they are counting for
+        http_connection = type(f"{provider}HTTPConnection", (_TimedConnection, HTTPConnection), {"provider": provider})
+        https_connection = type(f"{provider}HTTPSConnection", (_TimedConnection, HTTPSConnection), {"provider": provider})
+        self._pool_classes = {
+            "http": type(f"{provider}HTTPConnectionPool", (HTTPConnectionPool,), {"ConnectionCls": http_connection}),
+            "https": type(f"{provider}HTTPSConnectionPool", (HTTPSConnectionPool,), {"ConnectionCls": https_connection}),
+        }
+        # Blocking: past pool_size concurrent requests wait for a connection instead of opening throwaway ones
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=max_retries)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs["socket_options"] = keepalive_socket_options(self.keepalive)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = self._pool_classes
+
+    def send(self, request, timeout=None, **kwargs):
+        metrics.METRICS.incr(f"http.requests.{self.provider}")
+        # The SDKs pass their own (often very long) defaults, the provider's configured timeout wins
+        return super().send(request, timeout=self.timeout, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        pools = [self.poolmanager.pools[key] for key in self.poolmanager.pools.keys()]
+        counters = metrics.METRICS.counters
+        handshake = metrics.METRICS.histograms.get(f"http.handshake.{self.provider}")
+        return {
+            "requests": counters.get(f"http.requests.{self.provider}", 0),
+            "connections_opened": counters.get(f"http.connections.{self.provider}", 0),
+            # Empty slots of a urllib3 pool hold None until a connection is returned to them
+            "idle_connections": sum(1 for pool in pools if pool.pool is not None
+                                    for connection in list(pool.pool.queue) if connection is not None),
+            "pool_size": self._pool_maxsize,
+            "handshake_p50": handshake.percentile(50) if handshake else None,
+        }
+
+
+class SessionModule:
+    """ Stands in for the `requests` module inside an SDK that calls requests.get/post directly,
+    so those calls go through a pooled session. """
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, **kwargs)
+
+    def __getattr__(self, name):
+        # exceptions, Response, ...
+        return getattr(requests, name)
+
+
+_SESSIONS: Dict[str, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def http_session(provider: str, **adapter_kwargs) -> requests.Session:
+    """ The process-wide session of `provider`, shared by every thread. Requests sessions are safe to
+    share between threads for plain requests, the pool hands each request its own connection. """
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(provider)
+        if session is None:
+            session = requests.Session()
+            adapter = PooledAdapter(provider, **adapter_kwargs)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSIONS[provider] = session
+        return session
+
+
+def connection_stats() -> Dict[str, Dict[str, int]]:
+    return {provider: session.get_adapter("https://").stats() for provider, session in list(_SESSIONS.items())}
+
+
+metrics.METRICS.register_gauge("http", connection_stats)
@@ -0,0 +1,238 @@
+import functools
+import logging
+import os
+import random
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Union
+
+import yaml
+
+from . import metrics
+from .elevenlabs import PLAYBACK_FORMAT, Speaker, check_voice_exists
+from .openailib import summarize_conversation
+from .prompt import PromptWindow
+from .speculation import Speculator
+from .store import ConversationClips, ConversationStore
+
+log = logging.getLogger(__name__)
+
+# path -> (mtime, raw yaml, parsed yaml)
+_CHARACTERS_CACHE: Dict[str, Tuple[float, str, Dict]] = {}
+
+
+def load_characters(yaml_filepath: str) -> Tuple[str, Dict]:
+    # Only re-read and re-parse the characters file when it changed on disk
+    mtime = os.path.getmtime(yaml_filepath)
+    cached = _CHARACTERS_CACHE.get(yaml_filepath)
+    if cached is None or cached[0] != mtime:
+        with open(yaml_filepath, 'r') as file:
+            characters_yaml = file.read()
+        cached = (mtime, characters_yaml, yaml.safe_load(characters_yaml))
+        _CHARACTERS_CACHE[yaml_filepath] = cached
+    return cached[1], cached[2]
+
+
+class ConversationState:
+    COLORS: list = ['#FFA07A', '#F08080', '#AFEEEE', '#B0E0E6', '#DDA0DD',
+                    '#FFFFE0', '#F0E68C', '#90EE90', '#87CEFA', '#FFB6C1']
+    YAML_FILEPATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'voices.yaml')
+    AUDIO_SAVEDIR: str = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audio_export')
+    MODEL: str = "gpt-3.5-turbo"
+    MAX_TOKENS: int = 30
+    TEMPERATURE: float = 0.5
+    PROMPT_TOKEN_BUDGET: int = 1000
+
+    def __init__(self,
+                 names: list = None,
+                 iam: str = None,
+                 model: str = MODEL,
+                 max_tokens: int = MAX_TOKENS,
+                 temperature: float = TEMPERATURE,
+                 history: list = None,
+                 export_gap_seconds: float = 0.0,
+                 session_id: str = None,
+                 prompt_token_budget: int = PROMPT_TOKEN_BUDGET,
+                 store: ConversationStore = None,
+                 conversation_id: str = None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        # Silence inserted between turns in the exported audio
+        self.export_gap_seconds = export_gap_seconds
+        # Every session exports into its own folder so concurrent users never overwrite each other
+        self.session_id = session_id
+        self.export_dir = os.path.join(self.AUDIO_SAVEDIR, session_id) if session_id else self.AUDIO_SAVEDIR
+        # Make sure save dir exists, make any necessary directories
+        os.makedirs(self.export_dir, exist_ok=True)
+        self.audio_savepath = os.path.join(
+            self.export_dir, 'conversation.wav')
+        log.info(f"Resetting conversation")
+        self.characters_yaml, characters_dict = load_characters(self.YAML_FILEPATH)
+        # Copy so edits from make_voices never leak into the shared cache
+        self.characters_dict = dict(characters_dict)
+        self.all_characters = [
+            name for name in self.characters_dict.keys()]
+        self.names = names or random.choices(self.all_characters, k=2)
+        self.iam = iam or random.choice(self.names)
+        assert self.iam in self.names, f"{self.iam} not in {self.names}"
+        log.info(f"Loading voices")
+        self.speakers: Dict[str, Speaker] = {}
+        self.speakers_descriptions: str = ''
+        # Lookups in the voice registry, which lists the account's voices once and shares them across sessions
+        voices = [check_voice_exists(name) for name in self.names]
+        for i, (name, voice) in enumerate(zip(self.names, voices)):
+            if voice is None:
+                log.warning(f"Voice {name} does not exist")
+                continue
+            _speaker = Speaker(
+                name=name,
+                voice=voice,
+                color=self.COLORS[i % len(self.COLORS)],
+                description=self.characters_dict[name].get(
+                    "description", None),
+            )
+            self.speakers[name] = _speaker
+            if _speaker.description is not None:
+                self.speakers_descriptions += f"{_speaker.name}: {_speaker.description}.\n"
+        # System is fed into OpenAI to condition the prompt
+        self.system = f"You create funny conversation dialogues."
+        self.system += f"This conversation is between {', '.join(self.names)}."
+        self.system += "Do not introduce new characters."
+        self.system += "Descriptions for each of the characters are:\n"
+        for speaker in self.speakers.values():
+            self.system += f"{speaker.name}: {speaker.description}\n"
+        self.system += "Only return one person's response at a time."
+        self.system += "Each response must start with the character name, then a colon, then their response in a single line."
+        self.system += "Keep the responses short and witty."
+        self.system += "Make sure the responses are only one sentence long."
+        self.system += "Do not continue a previous response. Always start a new response."
+        # History is fed in at every step
+        self.step = 0
+        if history is None:
+            self.history: List[Tuple[Speaker, str]] = []
+        # Recent lines verbatim plus a rolling summary of older ones, within the token budget
+        self.prompt_window = PromptWindow(
+            budget=prompt_token_budget,
+            system=self.system,
+            summarize=functools.partial(summarize_conversation, model=self.model),
+        )
+        # (name, text) of the history entries already rendered into audio_savepath
+        self.exported_history: List[Tuple[str, str]] = []
+        # Same for the compressed exports, by format. Those are always rendered from scratch
+        self.compressed_exports: Dict[str, List[Tuple[str, str]]] = {}
+        # Taken by the thread writing a compressed export, not by the handler streaming it
+        self.export_lock = threading.Lock()
+        # Prepares the next turn in the background when speculative turns are on
+        self.speculator = Speculator()
+        # Every turn and its rendered audio are also recorded on disk, `conversation_id` continues a stored one
+        self.store = store
+        self.conversation_id = conversation_id
+        if store is not None and conversation_id is None:
+            self.conversation_id = store.start(session_id, names=self.names, iam=self.iam, model=self.model,
+                                               max_tokens=self.max_tokens, temperature=self.temperature)
+
+    @classmethod
+    def resume(cls, store: ConversationStore, conversation_id: str, session_id: str = None) -> Union["ConversationState", None]:
+        """ Continues a stored conversation, None if it is not stored or one of its voices is gone. """
+        stored = store.load(conversation_id)
+        if stored is None:
+            log.warning(f"Conversation {conversation_id} is not stored")
+            return None
+        settings = stored.settings
+        state = cls(names=settings["names"], iam=settings["iam"], model=settings.get("model", cls.MODEL),
+                    max_tokens=settings.get("max_tokens", cls.MAX_TOKENS),
+                    temperature=settings.get("temperature", cls.TEMPERATURE),
+                    session_id=session_id, store=store, conversation_id=conversation_id)
+        missing = {turn.speaker for turn in stored.turns} - set(state.speakers)
+        if missing:
+            # Skipping their turns would misalign the history with the stored audio
+            log.warning(f"Cannot resume {conversation_id}, no voice for {', '.join(missing)}")
+            return None
+        for turn in stored.turns:
+            state.add_to_history(turn.text, speaker=state.speakers[turn.speaker], record=False)
+        log.info(f"Resumed conversation {conversation_id} with {len(stored.turns)} turns")
+        return state
+
+    def add_to_history(self, text: str, speaker: Speaker = None, record: bool = True):
+        if speaker is None:
+            speaker = self.speakers[self.iam]
+        self.history.append((speaker, text))
+        self.prompt_window.append(f"{speaker.name}:{text}\n")
+        if record and self.store is not None:
+            self.store.append_turn(self.conversation_id, speaker.name, text)
+
+    def keep_audio(self, index: int, future: Future):
+        # Stores the clip of history entry `index` once it is synthesized, so it is never synthesized again
+        if self.store is None:
+            return
+
+        def store(future: Future):
+            if not future.cancelled() and future.exception() is None:
+                self.store.append_audio(self.conversation_id, index, future.result(), PLAYBACK_FORMAT)
+        future.add_done_callback(store)
+
+    def stored_clips(self, start: int = 0) -> Union[ConversationClips, None]:
+        # Audio of the history entries from `start` on that was already rendered, for playback and export
+        if self.store is None:
+            return None
+        return self.store.clips(self.conversation_id, PLAYBACK_FORMAT, start)
+
+    def history_signature(self) -> List[Tuple[str, str]]:
+        return [(speaker.name, text) for speaker, text in self.history]
+
+    def pending_export(self) -> Tuple[List[Tuple[Speaker, str]], bool]:
+        """ History entries that still need rendering, and whether they can be appended to the existing export. """
+        exported = self.exported_history
+        if (exported and os.path.exists(self.audio_savepath)
+                and self.history_signature()[:len(exported)] == exported):
+            return self.history[len(exported):], True
+        # History was reset or edited since the last export: rebuild from scratch
+        return self.history, False
+
+    @metrics.timed("parse")
+    def parse_line(self, line: str) -> Union[Tuple[Speaker, str], None]:
+        """ Parses one "Name: text" line of an LLM response, None if it should be skipped. """
+        try:
+            # TODO: Add any filters here as assertion errors
+            if not line:
+                return None
+            assert ":" in line, f"Line {line} does not have a colon"
+            name, text = line.split(":", 1)
+            assert name in self.all_characters, f"Name {name} is not in {self.all_characters}"
+            assert name in self.speakers, f"Name {name} has no voice"
+            speaker = self.speakers[name]
+            assert len(text) > 0, f"Text {text} is empty"
+            return speaker, text
+        except AssertionError as e:
+            log.warning(e)
+            return None
+
+    def history_to_prompt(self) -> str:
+        return self.prompt_window.prompt()
+
+    def speculate_next_turn(self):
+        # While this turn is played or read, the next one is generated and synthesized
+        self.speculator.start(self.history_signature(),
+                              self.history_to_prompt(),
+                              system=self.system,
+                              model=self.model,
+                              max_tokens=self.max_tokens,
+                              temperature=self.temperature,
+                              parse_line=self.parse_line)
+
+    def approx_bytes(self) -> int:
+        # Rough memory footprint, used by the session store's memory cap
+        return 1024 + sum(len(text) + 64 for _, text in self.history) + len(self.system)
+
+    def html_history(self, pending: str = None) -> str:
+        history_html: str = ''
+        for speaker, text in self.history:
+            _bubble = f"<div style='background-color: {speaker.color}; border-radius: 5px; padding: 5px; margin: 5px;'>{speaker.name}: {text}</div>"
+            history_html += _bubble
+        if pending:
+            # Partial transcript of what the user is saying, not yet part of the history
+            speaker = self.speakers[self.iam]
+            history_html += f"<div style='background-color: {speaker.color}; border-radius: 5px; padding: 5px; margin: 5px; opacity: 0.6;'>{speaker.name}: {pending}...</div>"
+        return history_html
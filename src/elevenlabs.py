@@ -1,104 +1,790 @@
 import asyncio
-import io
+import bisect
+import contextvars
+import functools
+import hashlib
+import json
 import logging
 import os
+import queue
+import re
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from typing import List, Union, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, List, Union, Tuple
 
 import sounddevice as sd
-import soundfile as sf
 from elevenlabslib import ElevenLabsUser, ElevenLabsVoice
+from elevenlabslib import helpers as elevenlabs_helpers
 
-from .utils import timeit
+from . import backends, metrics, scheduler
+from .audio import ClipDecoder, ClipWriter, PCMStitcher, pcm_samplerate, stitch_pcm
+from .connections import SessionModule, http_session
+from .scheduler import PRIORITY_EXPORT, PRIORITY_PLAYBACK
+from .metrics import timed
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 USER = None
+_USER_LOCK = threading.Lock()
+
+# Point the SDK at another server, e.g. bench/fake_tts_server.py, to run without a real account
+if "ELEVENLABS_API_ENDPOINT" in os.environ:
+    elevenlabs_helpers.api_endpoint = os.environ["ELEVENLABS_API_ENDPOINT"]
+
+# The SDK calls requests.get/post directly, a new connection per call: route them through one keep-alive pool
+elevenlabs_helpers.requests = SessionModule(http_session("elevenlabs"))
+
+class VoiceRegistry:
+    """ Name to voice index of the account's voices, fetched in one request and refreshed after `ttl` seconds. """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._voices: Dict[str, ElevenLabsVoice] = {}
+        self._loaded_at: float = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"refreshes": 0, "lookups": 0}
+
+    def _stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def refresh(self):
+        if not tts_available():
+            return
+        log.info("Fetching voice list...")
+        voices = tts_backend().voices()
+        index: Dict[str, ElevenLabsVoice] = {}
+        for voice in voices:
+            # Keep the first voice for duplicated names, like get_voices_by_name()[0]
+            index.setdefault(voice.initialName, voice)
+        self._voices = index
+        self._loaded_at = time.monotonic()
+        self.stats["refreshes"] += 1
+
+    def get(self, name: str) -> Union[ElevenLabsVoice, None]:
+        with self._lock:
+            if self._stale():
+                self.refresh()
+            self.stats["lookups"] += 1
+            return self._voices.get(name)
+
+    def add(self, name: str, voice: ElevenLabsVoice):
+        with self._lock:
+            self._voices[name] = voice
+
+    def invalidate(self):
+        with self._lock:
+            self._voices = {}
+            self._loaded_at = None
+
+
+VOICE_REGISTRY = VoiceRegistry(ttl=float(os.environ.get("VOICE_REGISTRY_TTL", 300.0)))
+
+
+def get_user() -> Union[ElevenLabsUser, None]:
+    # The client is created on first use, so importing this module never touches the network
+    global USER
+    with _USER_LOCK:
+        if USER is None and os.environ.get("ELEVENLABS_API_KEY"):
+            USER = ElevenLabsUser(os.environ["ELEVENLABS_API_KEY"])
+    return USER
+
 
 def set_elevenlabs_key(elevenlabs_api_key_textbox=None):
     global USER
     log.info(f"Setting ElevenLabs key.")
     if elevenlabs_api_key_textbox is not None:
         os.environ["ELEVENLABS_API_KEY"] = elevenlabs_api_key_textbox
-    try:
-        USER = ElevenLabsUser(os.environ["ELEVENLABS_API_KEY"])
-    except KeyError as e:
+    # A different key means a different account, and a different set of voices
+    VOICE_REGISTRY.invalidate()
+    with _USER_LOCK:
         USER = None
+    if "ELEVENLABS_API_KEY" not in os.environ:
         log.warning("ELEVENLABS_API_KEY not found in environment variables.")
-        pass
 
 set_elevenlabs_key()
 
+
+class ElevenLabsBackend:
+    """ Voices and synthesis of the ElevenLabs account set by ELEVENLABS_API_KEY. """
+
+    def voices(self) -> List[ElevenLabsVoice]:
+        return get_user().get_all_voices()
+
+    def synthesize(self, text: str, voice: ElevenLabsVoice, settings: Dict, model: str, output_format: str = None) -> bytes:
+        if output_format is None:
+            # The SDK default, mp3
+            return voice.generate_audio_bytes(text, model_id=model, **(settings or {}))
+        # elevenlabslib has no output_format option, so ask the API directly through the same pooled session
+        payload = {"text": text, "model_id": model}
+        if settings:
+            payload["voice_settings"] = settings
+        response = http_session("elevenlabs").post(
+            f"{elevenlabs_helpers.api_endpoint}/text-to-speech/{voice.voiceID}",
+            params={"output_format": output_format},
+            headers=get_user().headers,
+            json=payload,
+        )
+        response.raise_for_status()
+        return response.content
+
+
+ELEVENLABS = ElevenLabsBackend()
+
+
+def tts_backend() -> backends.TTSBackend:
+    return backends.TTS or ELEVENLABS
+
+
+def tts_available() -> bool:
+    # A fake backend needs no account
+    return backends.TTS is not None or get_user() is not None
+
+# Model used for synthesis, part of the cache key so switching models never serves stale audio
+TTS_MODEL: str = "eleven_monolingual_v1"
+# Playback and export only ever need samples, so ask for raw PCM and skip decoding. None is the compressed
+# SDK default (mp3), for audio that leaves the app as is
+PLAYBACK_FORMAT: str = os.environ.get("TTS_PLAYBACK_FORMAT", "pcm_22050") or None
+# Lines longer than this are synthesized as parallel sentence pieces, so the first one plays sooner. 0 disables it
+TTS_SPLIT_CHARS: int = int(os.environ.get("TTS_SPLIT_CHARS", 200))
+# Pieces are joined with a crossfade this long, hiding the seam between two requests
+TTS_SPLIT_CROSSFADE_MS: float = float(os.environ.get("TTS_SPLIT_CROSSFADE_MS", 20.0))
+CACHE_DIR: str = os.environ.get(
+    "SPEECH2SPEECH_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audio_cache'))
+
+
+class SpeechCache:
+    """ Content-addressed cache of synthesized speech: a bounded in-memory LRU in front of a size-capped directory. """
+
+    def __init__(self,
+                 cache_dir: str = CACHE_DIR,
+                 max_memory_items: int = 64,
+                 max_disk_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict = OrderedDict()
+        self._disk_bytes: int = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bytes_served": 0,
+            "bytes_stored": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def key(voice_id: str, text: str, settings: Dict = None, model: str = TTS_MODEL, output_format: str = None) -> str:
+        # Whitespace differences should not cost another synthesis
+        normalized = " ".join(text.split())
+        # The default format is left out, so audio cached before formats existed stays valid
+        formats = [output_format] if output_format else []
+        payload = json.dumps([voice_id, settings or {}, model, normalized] + formats, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def _remember(self, key: str, data: bytes):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str, memory_only: bool = False) -> Union[bytes, None]:
+        # memory_only never blocks (safe on an event loop) and leaves a miss to be counted by the full lookup
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                self.stats["bytes_served"] += len(data)
+                return data
+        if memory_only:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Touch the file so disk eviction is least-recently-used rather than oldest-written
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self._remember(key, data)
+            self.stats["disk_hits"] += 1
+            self.stats["bytes_served"] += len(data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._remember(key, data)
+            self.stats["bytes_stored"] += len(data)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so concurrent readers never see partial audio. Named per process
+        # and thread: batch workers share the cache directory and their thread ids repeat
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith(".audio"))
+
+    def _evict_disk(self):
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".audio")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if os.path.isdir(self.cache_dir):
+                for entry in os.scandir(self.cache_dir):
+                    if entry.name.endswith(".audio"):
+                        os.remove(entry.path)
+            self._disk_bytes = 0
+
+
+SPEECH_CACHE = SpeechCache()
+
+
+def cache_stats() -> Dict[str, int]:
+    return dict(SPEECH_CACHE.stats)
+
+
+# Opt-in: a request slower than usual for its length gets a duplicate, and the first response wins
+TTS_HEDGE: bool = os.environ.get("TTS_HEDGE", "0") == "1"
+
+
+class Hedger:
+    """ Hedged TTS requests against tail latency. Latency is tracked per size class of the text over the last
+    `window` requests; once a request has been running for longer than `percentile` of its class, the same
+    request is sent again and whichever answers first is used. Hedges are capped at `budget` of all requests.
+
+    The hedge is queued on the TTS scheduler at the primary's priority, so it waits for a rate limit token and
+    a worker like any other request. The loser is cancelled if it has not started yet. One already in flight
+    cannot be aborted, its response is dropped when it arrives (and still billed).
+    """
+
+    # Upper bounds in characters, text length dominates synthesis time
+    SIZE_CLASSES: Tuple[int, ...] = (80, 250)
+
+    def __init__(self,
+                 enabled: bool = TTS_HEDGE,
+                 percentile: float = float(os.environ.get("TTS_HEDGE_PERCENTILE", 95)),
+                 budget: float = float(os.environ.get("TTS_HEDGE_BUDGET", 0.05)),
+                 min_samples: int = 20,
+                 window: int = int(os.environ.get("TTS_HEDGE_WINDOW", 200)),
+                 max_workers: int = 16):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        # Recent latencies only, so the threshold follows the API when it gets slower or faster
+        self.latencies: List[deque] = [deque(maxlen=window) for _ in range(len(self.SIZE_CLASSES) + 1)]
+        # Primaries run here while the caller waits, the caller (usually a scheduler worker) holds their slot
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-hedge")
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"requests": 0, "hedged": 0, "hedge_won": 0, "over_budget": 0}
+
+    def threshold(self, text: str) -> Union[float, None]:
+        """ Seconds after which a request for `text` is hedged, None while too few requests were seen. """
+        latencies = self.latencies[bisect.bisect_left(self.SIZE_CLASSES, len(text))]
+        with self._lock:
+            if len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(self.percentile / 100 * len(ordered)))]
+
+    def _timed(self, fn: Callable[[], bytes], latencies: deque) -> bytes:
+        time_start = time.perf_counter()
+        result = fn()
+        # Losers are recorded too, they are part of the latency distribution
+        with self._lock:
+            latencies.append(time.perf_counter() - time_start)
+        return result
+
+    def _allow_hedge(self) -> bool:
+        with self._lock:
+            if self.stats["hedged"] + 1 > self.budget * self.stats["requests"]:
+                self.stats["over_budget"] += 1
+                return False
+            self.stats["hedged"] += 1
+            return True
+
+    def synthesize(self, fn: Callable[[], bytes], text: str) -> bytes:
+        latencies = self.latencies[bisect.bisect_left(self.SIZE_CLASSES, len(text))]
+        with self._lock:
+            self.stats["requests"] += 1
+        threshold = self.threshold(text) if self.enabled else None
+        if threshold is None:
+            # Learning the distribution, or hedging is off: run on the caller's thread
+            return self._timed(fn, latencies)
+        primary = self._pool.submit(contextvars.copy_context().run, self._timed, fn, latencies)
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._allow_hedge():
+            return primary.result()
+        log.info(f"TTS request for {len(text)} characters slower than {threshold:.2f} seconds, hedging")
+        hedge = scheduler.TTS_SCHEDULER.submit(self._timed, fn, latencies, priority=scheduler.current_priority())
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    # The other request may still succeed
+                    error = error or future.exception()
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    with self._lock:
+                        self.stats["hedge_won"] += 1
+                return future.result()
+        raise error
+
+
+HEDGER = Hedger()
+
+metrics.METRICS.register_gauge("speech_cache", cache_stats)
+metrics.METRICS.register_gauge("tts_scheduler", lambda: dict(scheduler.TTS_SCHEDULER.stats))
+metrics.METRICS.register_gauge("voice_registry", lambda: dict(VOICE_REGISTRY.stats))
+metrics.METRICS.register_gauge("tts_hedging", lambda: {**HEDGER.stats, "enabled": HEDGER.enabled})
+
+
 @dataclass
 class Speaker:
     name: str
     voice: ElevenLabsVoice
     color: str
     description: str = None
+    # Optional voice settings (stability, similarity_boost) sent with every synthesis
+    settings: Dict = None
+
+
+async def text_to_speechbytes_async(text, speaker, loop=None, priority=PRIORITY_PLAYBACK, output_format=None):
+    # Audio in memory is served straight from the event loop, no thread needed
+    speech_bytes = SPEECH_CACHE.get(SpeechCache.key(
+        speaker.voice.voiceID, text, speaker.settings, output_format=output_format), memory_only=True)
+    if speech_bytes is not None:
+        return speech_bytes
+    # Everything else goes through the shared TTS worker pool, which reads the disk cache before any request
+    future = scheduler.TTS_SCHEDULER.submit(
+        text_to_speechbytes, text, speaker.voice, speaker.settings, output_format, priority=priority)
+    return await asyncio.wrap_future(future)
+
+
+def prefetch_speech(text: str, speaker: Speaker, priority=PRIORITY_PLAYBACK, output_format: str = None) -> Future:
+    # Starts synthesis right away without waiting for it, the audio also lands in the speech cache
+    return _speech_futures(text, speaker, priority, output_format)[1]
+
+
+def _speech_futures(text: str, speaker: Speaker, priority, output_format: str = None) -> Tuple[List[Future], Future]:
+    # Futures of the clips to play in order (the pieces of a split line) and of the whole line.
+    # Callers are handler or background threads, so the (disk) lookup is done here, once
+    key = SpeechCache.key(speaker.voice.voiceID, text, speaker.settings, output_format=output_format)
+    speech_bytes = SPEECH_CACHE.get(key)
+    if speech_bytes is not None:
+        future: Future = Future()
+        future.set_result(speech_bytes)
+        return [future], future
+    pieces = split_for_synthesis(text, output_format)
+    if pieces is not None:
+        return synthesize_pieces(text, speaker, pieces, priority=priority, output_format=output_format)
+    future = scheduler.TTS_SCHEDULER.submit(
+        synthesize_speechbytes, key, text, speaker.voice, speaker.settings, output_format, priority=priority)
+    return [future], future
+
+
+def speech_requests(future: Future, text: str) -> List[Tuple[str, Future]]:
+    """ The TTS requests behind a speech future with their texts: the pieces of a split line, else itself.
+
+    Cancel or reprioritize these rather than the future of a split line, which only resolves once all are done.
+    """
+    return getattr(future, "pieces", None) or [(text, future)]
+
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+_CLAUSE_END = re.compile(r"(?<=[,;:—–])\s+")
+
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    # At clause marks first, then at the last space that fits, then anywhere
+    parts = []
+    for clause in _CLAUSE_END.split(sentence):
+        while len(clause) > max_chars:
+            cut = clause.rfind(" ", 0, max_chars + 1)
+            cut = cut if cut > 0 else max_chars
+            parts.append(clause[:cut])
+            clause = clause[cut:].lstrip()
+        parts.append(clause)
+    return parts
+
+
+def split_sentences(text: str, max_chars: int = 200, first_chars: int = 100) -> List[str]:
+    """ Packs whole sentences into pieces of at most `max_chars`, splitting a longer sentence at clauses.
+
+    The first piece is kept under `first_chars` since it is the one playback waits for, the later ones are
+    as long as possible: every request has a fixed cost and counts against the rate limit.
+    """
+    units = [part for sentence in _SENTENCE_END.split(text.strip()) for part in _split_long(sentence, max_chars)]
+    units = [unit for unit in units if unit]
+    if units and len(units[0]) > first_chars:
+        units[:1] = _split_long(units[0], first_chars)
+    pieces: List[str] = []
+    for unit in units:
+        limit = first_chars if len(pieces) == 1 else max_chars
+        if pieces and len(pieces[-1]) + 1 + len(unit) <= limit:
+            pieces[-1] += " " + unit
+        else:
+            pieces.append(unit)
+    return pieces
+
+
+def split_for_synthesis(text: str, output_format: str = None) -> Union[List[str], None]:
+    # Only raw PCM can be crossfaded without decoding and re-encoding every piece
+    if not TTS_SPLIT_CHARS or len(text) <= TTS_SPLIT_CHARS or pcm_samplerate(output_format) is None:
+        return None
+    pieces = split_sentences(text, max_chars=TTS_SPLIT_CHARS, first_chars=TTS_SPLIT_CHARS // 2)
+    return pieces if len(pieces) > 1 else None
+
+
+def synthesize_pieces(text: str, speaker: Speaker, pieces: List[str], priority=PRIORITY_PLAYBACK,
+                      output_format: str = None) -> Tuple[List[Future], Future]:
+    """ Submits every piece of `text` at once, same voice and settings, and returns their futures in order
+    together with a future of the whole line: the pieces stitched with crossfades, cached under the line's key.
+    """
+    futures = [scheduler.TTS_SCHEDULER.submit(text_to_speechbytes, piece, speaker.voice, speaker.settings,
+                                              output_format, priority=priority) for piece in pieces]
+    whole: Future = Future()
+    whole.pieces = list(zip(pieces, futures))
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    metrics.METRICS.incr("tts.split_lines")
+    metrics.METRICS.incr("tts.split_pieces", len(pieces))
+
+    def piece_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        # Atomic against a concurrent cancel, e.g. a discarded speculative turn
+        if not whole.set_running_or_notify_cancel():
+            return
+        try:
+            audio_bytes = stitch_pcm([future.result() for future in futures], pcm_samplerate(output_format),
+                                     fade_ms=TTS_SPLIT_CROSSFADE_MS)
+        except BaseException as e:
+            whole.set_exception(e)
+            return
+        SPEECH_CACHE.put(SpeechCache.key(speaker.voice.voiceID, text, speaker.settings, output_format=output_format),
+                         audio_bytes)
+        whole.set_result(audio_bytes)
+
+    def whole_done(_):
+        if whole.cancelled():
+            for future in futures:
+                future.cancel()
+
+    whole.add_done_callback(whole_done)
+    for future in futures:
+        future.add_done_callback(piece_done)
+    return futures, whole
 
 
-async def text_to_speechbytes_async(text, speaker, loop):
-    with ThreadPoolExecutor() as executor:
-        speech_bytes = await loop.run_in_executor(executor, text_to_speechbytes, text, speaker.voice)
-    return speech_bytes
+class AudioOutput:
+    """ Plays clips back to back on one open output stream, so consecutive clips, and the crossfaded pieces of
+    a split line, join without the device stopping and starting in between. A clip that is not synthesized
+    yet when its turn comes still leaves a pause.
+    """
 
+    def __init__(self):
+        self._stream: sd.OutputStream = None
+        self._format: tuple = None
 
-async def play_history(history: List[Tuple[Speaker, str]]):
+    @timed("playback")
+    def write(self, audio, samplerate: int):
+        # Raw PCM is int16 and compressed clips decode to float32, a change of format needs a new stream
+        clip_format = (samplerate, audio.shape[1], audio.dtype.name)
+        if clip_format != self._format:
+            self.close()
+            self._stream = sd.OutputStream(samplerate=samplerate, channels=audio.shape[1], dtype=audio.dtype.name)
+            self._stream.start()
+            self._format = clip_format
+        # Blocks until the clip is buffered, not until it has been played
+        self._stream.write(audio)
+
+    def close(self):
+        # Waits for everything written to finish playing
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+            self._format = None
+
+
+class SpeechStream:
+    """ Synthesizes lines as soon as they are added and, if `play` is set, plays them in order on a background thread. """
+
+    def __init__(self, play: bool = True):
+        self.play = play
+        self.time_start = time.perf_counter()
+        self.time_to_first_audio: float = None
+        self._count = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread = None
+        if play:
+            # Playback spans belong to the trace of whoever opened the stream
+            self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._playback,),
+                                            name="speech-stream", daemon=True)
+            self._thread.start()
+
+    def add(self, text: str, speaker: Speaker, future: Future = None) -> Future:
+        # `future` is synthesis already under way for this line, e.g. from a speculative turn
+        if future is None:
+            futures, future = _speech_futures(text, speaker, (PRIORITY_PLAYBACK, self._count), PLAYBACK_FORMAT)
+        else:
+            futures = [piece for _, piece in speech_requests(future, text)]
+        # Long line: its pieces are played as each one arrives, the first long before the last is ready
+        self._queue.put(futures)
+        self._count += 1
+        return future
+
+    def _playback(self):
+        output = AudioOutput()
+        try:
+            self._play_queued(output)
+        finally:
+            output.close()
+
+    def _play_queued(self, output: AudioOutput):
+        # Clips are played one at a time, so one decode buffer serves them all
+        decoder = ClipDecoder(PLAYBACK_FORMAT)
+        while True:
+            futures = self._queue.get()
+            if futures is None:
+                break
+            # Pieces of one line are crossfaded as they are played, a single clip passes through untouched
+            stitcher = PCMStitcher(int((pcm_samplerate(PLAYBACK_FORMAT) or 0) * TTS_SPLIT_CROSSFADE_MS / 1000))
+            for i, future in enumerate(futures):
+                try:
+                    audio, samplerate = decoder.decode(future.result())
+                except Exception as e:
+                    log.warning(f"Skipping line that failed to synthesize: {e}")
+                    break
+                if len(futures) > 1:
+                    audio = stitcher.add(audio, last=i == len(futures) - 1)
+                if self.time_to_first_audio is None:
+                    self.time_to_first_audio = time.perf_counter() - self.time_start
+                    log.info(f"Time to first spoken word: {self.time_to_first_audio:.2f} seconds")
+                output.write(audio, samplerate)
+
+    def close(self):
+        # Blocks until every added line has been played
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+
+@dataclass
+class PlaybackReport:
+    # Seconds from the call until the first clip started playing
+    time_to_first_audio: float = None
+    # Seconds of silence between the end of one clip and the start of the next
+    gaps: List[float] = field(default_factory=list)
+    clips_played: int = 0
+
+
+async def iter_history_speech(history: List[Tuple[Speaker, str]],
+                              lookahead: int = 3,
+                              priority: int = PRIORITY_PLAYBACK,
+                              output_format: str = None,
+                              clips=None) -> AsyncIterator[bytes]:
+    # Whole clips in history order, see _iter_history_requests
+    async with aclosing(_iter_history_requests(history, lookahead, priority, output_format, clips)) as requests:
+        async for _, whole in requests:
+            yield await whole
+
+
+async def _iter_history_requests(history: List[Tuple[Speaker, str]],
+                                 lookahead: int = 3,
+                                 priority: int = PRIORITY_PLAYBACK,
+                                 output_format: str = None,
+                                 clips=None,
+                                 split: bool = False) -> AsyncIterator[Tuple[List[asyncio.Future], asyncio.Future]]:
+    # (clips to play in order, whole line) of every turn. With `split`, long lines are synthesized as parallel
+    # pieces (see synthesize_pieces), so their first piece can be played long before the whole line is ready.
+    # `clips` is stored audio of the history (see store.ConversationClips): clips.get(i) is used instead of
+    # synthesizing turn i, and whatever has to be synthesized is handed to clips.put(i, audio)
     loop = asyncio.get_event_loop()
 
-    # Create a list of tasks for all text_to_speechbytes function calls
-    tasks = [text_to_speechbytes_async(
-        text, speaker, loop) for speaker, text in history]
+    # Bounded queue of synthesis tasks: at most lookahead lines are buffered ahead of the one being consumed
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, lookahead))
+
+    async def produce():
+        for i, (speaker, text) in enumerate(history):
+            # Stored clips are read with a file lock held, which must not stall the event loop
+            stored = await metrics.run_in_executor(loop, None, clips.get, i) if clips is not None else None
+            if stored is not None:
+                task = loop.create_future()
+                task.set_result(stored)
+                await queue.put(([task], task))
+                continue
+            # Earlier turns are consumed first, so they are served first
+            if split:
+                # Looks the line up in the speech cache, disk included, so not on the event loop
+                futures, whole = await metrics.run_in_executor(
+                    loop, None, _speech_futures, text, speaker, (priority, i), output_format)
+                task = asyncio.wrap_future(whole)
+                pieces = [task] if futures == [whole] else [asyncio.wrap_future(future) for future in futures]
+            else:
+                task = asyncio.ensure_future(text_to_speechbytes_async(
+                    text, speaker, loop, priority=(priority, i), output_format=output_format))
+                pieces = [task]
+            if clips is not None:
+                task.add_done_callback(functools.partial(_keep_clip, clips, i))
+            await queue.put((pieces, task))
+        await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        # Lines are yielded in history order regardless of which synthesis finishes first
+        while True:
+            request = await queue.get()
+            if request is None:
+                break
+            yield request
+    finally:
+        producer.cancel()
+        while not queue.empty():
+            request = queue.get_nowait()
+            if request is not None:
+                # Cancelling a split line cancels its pieces too
+                request[1].cancel()
 
-    # Run tasks concurrently, waiting for the first one to complete
-    for speech_bytes in await asyncio.gather(*tasks):
-        audioFile = io.BytesIO(speech_bytes)
-        soundFile = sf.SoundFile(audioFile)
-        sd.play(soundFile.read(), samplerate=soundFile.samplerate, blocking=True)
 
+def _keep_clip(clips, index: int, task: asyncio.Future):
+    # Runs on the event loop, the write itself (file lock and all) goes to the default executor
+    if not task.cancelled() and task.exception() is None:
+        metrics.run_in_executor(task.get_loop(), None, clips.put, index, task.result())
 
-async def save_history(history: List[Tuple[Speaker, str]], audio_savepath: str):
+
+@timed("playback.history")
+async def play_history(history: List[Tuple[Speaker, str]], lookahead: int = 3, clips=None) -> PlaybackReport:
     loop = asyncio.get_event_loop()
+    report = PlaybackReport()
+    time_start = time.perf_counter()
+    # When the audio written so far finishes playing
+    last_end = None
+    decoder = ClipDecoder(PLAYBACK_FORMAT)
+    output = AudioOutput()
+    try:
+        async with aclosing(_iter_history_requests(history, lookahead, PRIORITY_PLAYBACK, PLAYBACK_FORMAT, clips,
+                                                   split=True)) as requests:
+            async for pieces, _ in requests:
+                # Pieces of a long line are crossfaded and played as each one arrives
+                stitcher = PCMStitcher(int((pcm_samplerate(PLAYBACK_FORMAT) or 0) * TTS_SPLIT_CROSSFADE_MS / 1000))
+                for i, piece in enumerate(pieces):
+                    speech_bytes = await piece
+                    # Anything still compressed is decoded off the event loop, into the decoder's reused buffer
+                    audio, samplerate = await metrics.run_in_executor(loop, None, decoder.decode, speech_bytes)
+                    if len(pieces) > 1:
+                        audio = stitcher.add(audio, last=i == len(pieces) - 1)
+                    now = time.perf_counter()
+                    if last_end is None:
+                        report.time_to_first_audio = now - time_start
+                    else:
+                        # The output stream plays on by itself, silence only if this clip came after the last ended
+                        report.gaps.append(max(0.0, now - last_end))
+                    # Written off the event loop so synthesis of later clips keeps progressing
+                    await metrics.run_in_executor(loop, None, output.write, audio, samplerate)
+                    last_end = max(now, last_end or now) + len(audio) / samplerate
+                    report.clips_played += 1
+    finally:
+        # Waits for the last clip to finish playing
+        await metrics.run_in_executor(loop, None, output.close)
+    if report.clips_played:
+        log.info(f"Time to first audio: {report.time_to_first_audio:.2f} seconds, "
+                 f"max gap between clips: {max(report.gaps, default=0.0):.2f} seconds")
+    log.info(f"Speech cache stats: {cache_stats()}")
+    return report
 
-    # Create a list of tasks for all text_to_speechbytes function calls
-    tasks = [text_to_speechbytes_async(
-        text, speaker, loop) for speaker, text in history]
 
-    # Run tasks concurrently, waiting for the first one to complete
-    all_speech_bytes = await asyncio.gather(*tasks)
+@timed("export")
+async def save_history(history: List[Tuple[Speaker, str]],
+                       audio_savepath: str,
+                       gap_seconds: float = 0.0,
+                       lookahead: int = 4,
+                       append: bool = False,
+                       clips=None,
+                       export_format: str = "wav",
+                       on_clip: Callable[[ClipWriter], None] = None) -> str:
+    # Each clip is decoded on its own and appended as soon as it is ready, so only
+    # the clips in the look-ahead window are ever held in memory
+    loop = asyncio.get_event_loop()
+    decoder = ClipDecoder(PLAYBACK_FORMAT)
 
-    # Combine all audio bytes into a single audio file
-    concatenated_audio = io.BytesIO(b''.join(all_speech_bytes))
+    def write(speech_bytes: bytes):
+        writer.write(*decoder.decode(speech_bytes))
+        # e.g. to hand the partial file of a compressed export to the browser
+        if on_clip is not None:
+            on_clip(writer)
 
-    # Save the combined audio file to disk
-    with sf.SoundFile(concatenated_audio, mode='r') as soundFile:
-        with sf.SoundFile(
-            audio_savepath, mode='w',
-            samplerate=soundFile.samplerate,
-            channels=soundFile.channels,
-        ) as outputFile:
-            outputFile.write(soundFile.read())
+    with ClipWriter(audio_savepath, gap_seconds=gap_seconds, append=append, export_format=export_format) as writer:
+        async with aclosing(iter_history_speech(history, lookahead, PRIORITY_EXPORT, PLAYBACK_FORMAT, clips)) as speech:
+            async for speech_bytes in speech:
+                # Decoding and file writes stay off the event loop, which keeps scheduling synthesis
+                await metrics.run_in_executor(loop, None, write, speech_bytes)
+    log.info(f"Saved {writer.clips_written} clips ({writer.frames_written / (writer.samplerate or 1):.1f} seconds) "
+             f"to {audio_savepath}")
+    log.info(f"Speech cache stats: {cache_stats()}")
+    return audio_savepath
 
 
 def check_voice_exists(voice: Union[ElevenLabsVoice, str]) -> Union[ElevenLabsVoice, None]:
-    if USER is None:
+    if not tts_available():
         log.warning(
             "No ElevenLabsUser found, have you set the ELEVENLABS_API_KEY environment variable?")
         return None
     log.info(f"Getting voice {voice}...")
-    _available_voices = USER.get_voices_by_name(voice)
-    if _available_voices:
-        log.info(f"Voice {voice} already exists, found {_available_voices}.")
-        return _available_voices[0]
-    return None
+    _voice = VOICE_REGISTRY.get(voice)
+    if _voice is not None:
+        log.info(f"Voice {voice} already exists, found {_voice}.")
+    return _voice
 
 
-@timeit
+@timed("voice.clone")
 def get_make_voice(voice: Union[ElevenLabsVoice, str], audio_path: List[str] = None) -> ElevenLabsVoice:
-    if USER is None:
+    user = get_user()
+    if user is None:
         log.warning(
             "No ElevenLabsUser found, have you set the ELEVENLABS_API_KEY environment variable?")
         return None
@@ -106,7 +792,7 @@ def get_make_voice(voice: Union[ElevenLabsVoice, str], audio_path: List[str] = N
     if _voice is not None:
         return _voice
     else:
-        if USER.get_voice_clone_available():
+        if user.get_voice_clone_available():
             assert audio_path is not None, "audio_path must be provided"
             assert isinstance(audio_path, list), "audio_path must be a list"
             log.info(f"Cloning voice {voice}...")
@@ -114,13 +800,14 @@ def get_make_voice(voice: Union[ElevenLabsVoice, str], audio_path: List[str] = N
                 # Audio path is a PosixPath
                 _.name: open(_, "rb").read() for _ in audio_path
             }
-            newVoice = USER.clone_voice_bytes(voice, _audio_source_dict)
+            newVoice = user.clone_voice_bytes(voice, _audio_source_dict)
+            VOICE_REGISTRY.add(voice, newVoice)
             return newVoice
     raise ValueError(
         f"Voice {voice} does not exist and cloning is not available.")
 
 
-@timeit
+@timed("tts.play")
 def text_to_speech(text: str, voice: ElevenLabsVoice):
     log.info(f"Generating audio using voice {voice}...")
     time_start = time.time()
@@ -129,8 +816,29 @@ def text_to_speech(text: str, voice: ElevenLabsVoice):
     return duration
 
 
-@timeit
-def text_to_speechbytes(text: str, voice: ElevenLabsVoice):
+def _synthesize_request(text: str, voice: ElevenLabsVoice, settings: Dict = None, output_format: str = None) -> bytes:
+    scheduler.throttle()
+    audio_bytes = tts_backend().synthesize(text, voice, settings, TTS_MODEL, output_format)
+    # ElevenLabs bills per character, cache hits are free and a hedge is billed like any other request
+    metrics.METRICS.incr("tts.requests")
+    metrics.METRICS.incr("tts.characters", len(text))
+    return audio_bytes
+
+
+def text_to_speechbytes(text: str, voice: ElevenLabsVoice, settings: Dict = None, output_format: str = None):
+    key = SpeechCache.key(voice.voiceID, text, settings, output_format=output_format)
+    audio_bytes = SPEECH_CACHE.get(key)
+    if audio_bytes is not None:
+        log.info(f"Using cached audio for voice {voice} text {text}")
+        return audio_bytes
+    return synthesize_speechbytes(key, text, voice, settings, output_format)
+
+
+@timed("tts")
+def synthesize_speechbytes(key: str, text: str, voice: ElevenLabsVoice, settings: Dict = None, output_format: str = None):
+    # Cache miss already established by the caller, `key` is where the audio is stored
     log.info(f"Generating audio for voice {voice} text {text}...")
-    audio_bytes = voice.generate_audio_bytes(text)
+    audio_bytes = HEDGER.synthesize(
+        functools.partial(_synthesize_request, text, voice, settings, output_format), text)
+    SPEECH_CACHE.put(key, audio_bytes)
     return audio_bytes
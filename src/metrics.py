@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+log = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, 10% apart from 1 microsecond to about 20 minutes
+BUCKETS: List[float] = [1e-6 * 1.1 ** i for i in range(220)]
+# Beyond this a span stops collecting children, so a long-lived parent cannot grow without bound
+MAX_CHILDREN: int = 256
+
+
+class Histogram:
+    """ Fixed log-spaced buckets, so observing is a bisect and an increment and percentiles are within 10%. """
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            rank = q / 100 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return min(BUCKETS[index] if index < len(BUCKETS) else self.max, self.max)
+        return 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Span:
+    """ One timed stage. Spans started while another is current become its children, forming a per-turn trace. """
+
+    __slots__ = ("name", "attrs", "parent", "children", "start_ns", "end_ns")
+
+    def __init__(self, name: str, parent: "Span" = None, attrs: Dict = None):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.children: List[Span] = []
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns: int = None
+        if parent is not None and len(parent.children) < MAX_CHILDREN:
+            parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.perf_counter_ns()
+        METRICS.observe(self.name, self.duration)
+        # Only spans with stages inside them are worth keeping as traces, e.g. a whole turn
+        if self.parent is None and self.children:
+            METRICS.add_trace(self)
+
+    def to_dict(self, origin_ns: int = None) -> Dict:
+        origin_ns = self.start_ns if origin_ns is None else origin_ns
+        span = {
+            "name": self.name,
+            "start": round((self.start_ns - origin_ns) / 1e9, 6),
+            "duration": round(self.duration, 6),
+        }
+        if self.attrs:
+            span["attrs"] = self.attrs
+        if self.children:
+            span["children"] = [child.to_dict(origin_ns) for child in list(self.children)]
+        return span
+
+
+_CURRENT_SPAN: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span() -> Span:
+    return _CURRENT_SPAN.get()
+
+
+class Metrics:
+    """ In-process histograms per span name, counters, gauges and the most recent complete traces. """
+
+    def __init__(self, max_traces: int = 50):
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, Callable] = {}
+        self.traces: deque = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(seconds)
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_gauge(self, name: str, fn: Callable):
+        # Evaluated only when a snapshot is taken, e.g. lambda: dict(SCHEDULER.stats)
+        self.gauges[name] = fn
+
+    def add_trace(self, span: Span):
+        self.traces.append(span)
+        log.info(f"{span.name} took {span.duration:.2f} seconds: "
+                 + ", ".join(f"{child.name} {child.duration:.2f}" for child in list(span.children)))
+
+    def snapshot(self, traces: int = 10) -> Dict:
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = repr(e)
+        return {
+            "histograms": {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "traces": [span.to_dict() for span in list(self.traces)[-traces:]] if traces else [],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.traces.clear()
+
+
+METRICS = Metrics()
+
+
+def start_span(name: str, parent: Span = None, **attrs) -> Span:
+    """ Starts a span without making it current, end it with `span.end()`. For work that spans
+    generator yields or threads, where a context manager would leak into whoever resumes it. """
+    return Span(name, parent if parent is not None else _CURRENT_SPAN.get(), attrs or None)
+
+
+@contextmanager
+def activate(span: Span):
+    # Makes an already started span the parent of the spans started in this block
+    token = _CURRENT_SPAN.set(span)
+    try:
+        yield span
+    finally:
+        _CURRENT_SPAN.reset(token)
+
+
+@contextmanager
+def span(name: str, parent: Span = None, **attrs):
+    _span = start_span(name, parent, **attrs)
+    token = _CURRENT_SPAN.set(_span)
+    try:
+        yield _span
+    finally:
+        _CURRENT_SPAN.reset(token)
+        _span.end()
+
+
+def timed(name: str = None):
+    """ Decorator recording every call as a span, for plain functions, coroutines and generators.
+
+    Generators are timed from the first item requested until they are exhausted or closed, but do
+    not become the parent of spans started while they run.
+    """
+
+    def decorator(func):
+        _name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                # The parent is whatever is current at the call, not wherever the generator is resumed
+                return _timed_generator(_name, _CURRENT_SPAN.get(), func(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _timed_generator(name: str, parent: Span, generator):
+    _span = Span(name, parent)
+    try:
+        yield from generator
+    finally:
+        _span.end()
+
+
+def run_in_executor(loop: asyncio.AbstractEventLoop, executor, fn: Callable, *args) -> asyncio.Future:
+    # Unlike loop.run_in_executor, spans started by fn nest under the caller's current span
+    return loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, fn, *args))
+
+
+def snapshot(traces: int = 10) -> Dict:
+    return METRICS.snapshot(traces)
+
+
+def serve_metrics(port: int = 9100, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """ Serves the metrics snapshot as JSON on GET /metrics from a background thread. """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = json.dumps(snapshot(), default=str).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,7 +1,18 @@
+import hashlib
+import io
 import logging
 import os
+import threading
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
-from .utils import timeit
+from . import backends
+from .audio import encode_for_upload, load_for_transcription, prepare_for_transcription, split_at_silence
+from .connections import http_session
+from .metrics import METRICS, timed
+from .prompt import count_tokens
 
 import openai
 
@@ -21,17 +32,145 @@ def set_openai_key(openai_api_key_textbox = None):
 
 set_openai_key()
 
-@timeit
-def speech_to_text(audio_path):
+
+def use_pooled_session():
+    # One keep-alive pool for every thread, instead of the SDK's session (and handshake) per thread
+    session = http_session("openai")
+    if hasattr(openai, "requestssession"):
+        openai.requestssession = session
+    else:
+        # openai<0.27.3 keeps its session in a thread local, any object with a session attribute works
+        openai.api_requestor._thread_context = types.SimpleNamespace(session=session)
+
+use_pooled_session()
+
+
+class OpenAIBackend:
+    """ Whisper for speech to text and chat completions for the dialogue, through the openai SDK. """
+
+    def transcribe(self, audio_bytes, filename):
+        audio_file = io.BytesIO(audio_bytes)
+        # The API infers the format from the file name
+        audio_file.name = filename
+        with audio_file:
+            return openai.Audio.transcribe("whisper-1", audio_file)["text"]
+
+    def complete(self, messages, model, max_tokens, temperature):
+        _response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=1,
+            max_tokens=max_tokens,
+        )
+        log.info(f"API reponse: \n\t{_response}")
+        return _response['choices'][0]['message']['content']
+
+    def stream(self, messages, model, max_tokens, temperature):
+        _response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=1,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in _response:
+            delta = chunk['choices'][0].get('delta', {}).get('content')
+            if delta:
+                yield delta
+
+
+OPENAI = OpenAIBackend()
+
+
+def stt_backend() -> backends.STTBackend:
+    return backends.STT or OPENAI
+
+
+def llm_backend() -> backends.LLMBackend:
+    return backends.LLM or OPENAI
+
+# sha256 of the recorded file -> transcript, so the same recording is never uploaded twice
+TRANSCRIPT_CACHE: OrderedDict = OrderedDict()
+TRANSCRIPT_CACHE_SIZE: int = 256
+_TRANSCRIPT_LOCK = threading.Lock()
+
+
+def _transcript_digest(audio_path) -> str:
+    with open(audio_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _cached_transcript(digest):
+    with _TRANSCRIPT_LOCK:
+        if digest in TRANSCRIPT_CACHE:
+            TRANSCRIPT_CACHE.move_to_end(digest)
+            log.info("Using cached transcript")
+            return TRANSCRIPT_CACHE[digest]
+    return None
+
+
+def _cache_transcript(digest, text):
+    with _TRANSCRIPT_LOCK:
+        TRANSCRIPT_CACHE[digest] = text
+        while len(TRANSCRIPT_CACHE) > TRANSCRIPT_CACHE_SIZE:
+            TRANSCRIPT_CACHE.popitem(last=False)
+
+
+@timed("stt.request")
+def _transcribe_bytes(audio_bytes, filename):
+    return stt_backend().transcribe(audio_bytes, filename)
+
+
+@timed("stt")
+def speech_to_text(audio_path, preprocess=True):
+    digest = _transcript_digest(audio_path)
+    text = _cached_transcript(digest)
+    if text is not None:
+        return text
     log.info("Transcribing audio...")
-    transcript = openai.Audio.transcribe("whisper-1", open(audio_path, "rb"))
-    text = transcript["text"]
+    if preprocess:
+        # Silence trimmed, 16 kHz mono, compressed: far fewer bytes to upload than the raw recording
+        audio_bytes, filename = prepare_for_transcription(audio_path)
+        log.info(f"Uploading {len(audio_bytes)} bytes instead of {os.path.getsize(audio_path)}")
+        text = _transcribe_bytes(audio_bytes, filename)
+    else:
+        with open(audio_path, "rb") as audio_file:
+            text = _transcribe_bytes(audio_file.read(), os.path.basename(audio_path))
     log.info(f"Transcript: \n\t{text}")
+    _cache_transcript(digest, text)
     return text
 
 
-@timeit
-def top_response(prompt, system=None, model="gpt-3.5-turbo", max_tokens=20, temperature=0.8):
+@timed("stt")
+def speech_to_text_stream(audio_path, max_chunk_seconds=30.0, max_workers=4, samplerate=16000) -> Iterator[str]:
+    """ Transcribes long recordings in chunks split at pauses, concurrently.
+
+    Yields the transcript so far each time the next chunk (in order) is done, so wall time
+    approaches the slowest chunk rather than the sum of all of them.
+    """
+    digest = _transcript_digest(audio_path)
+    text = _cached_transcript(digest)
+    if text is not None:
+        yield text
+        return
+    audio = load_for_transcription(audio_path, samplerate)
+    chunks = split_at_silence(audio, samplerate, max_chunk_seconds)
+    log.info(f"Transcribing {len(audio) / samplerate:.1f} seconds of audio in {len(chunks)} chunks...")
+    texts = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_transcribe_bytes, *encode_for_upload(audio[start:end], samplerate))
+                   for start, end in chunks]
+        for future in futures:
+            texts.append(future.result().strip())
+            yield " ".join(texts)
+    text = " ".join(texts)
+    log.info(f"Transcript: \n\t{text}")
+    _cache_transcript(digest, text)
+
+
+def _messages(prompt, system=None):
     _prompt = [
         {
             "role": "user",
@@ -45,14 +184,46 @@ def top_response(prompt, system=None, model="gpt-3.5-turbo", max_tokens=20, temp
                 "content": system,
             },
         ] + _prompt
+    return _prompt
+
+
+def _count_usage(messages, response: str):
+    # Billed tokens, counted locally since the backends only hand back the text
+    METRICS.incr("llm.requests")
+    METRICS.incr("llm.prompt_tokens", sum(count_tokens(message["content"]) for message in messages))
+    METRICS.incr("llm.completion_tokens", count_tokens(response))
+
+
+@timed("llm")
+def top_response(prompt, system=None, model="gpt-3.5-turbo", max_tokens=20, temperature=0.8):
+    _prompt = _messages(prompt, system)
     log.info(f"API call to {model} with prompt: \n\n\t{_prompt}\n\n")
-    _response = openai.ChatCompletion.create(
-        model=model,
-        messages=_prompt,
-        temperature=temperature,
-        n=1,
-        max_tokens=max_tokens,
-    )
-    log.info(f"API reponse: \n\t{_response}")
-    response: str = _response['choices'][0]['message']['content']
+    response: str = llm_backend().complete(_prompt, model, max_tokens, temperature)
+    _count_usage(_prompt, response)
     return response
+
+
+@timed("llm")
+def stream_response_lines(prompt, system=None, model="gpt-3.5-turbo", max_tokens=20, temperature=0.8) -> Iterator[str]:
+    # Same request as top_response, but each line is yielded as soon as its newline arrives
+    _prompt = _messages(prompt, system)
+    log.info(f"Streaming API call to {model} with prompt: \n\n\t{_prompt}\n\n")
+    buffer: str = ''
+    response: str = ''
+    for delta in llm_backend().stream(_prompt, model, max_tokens, temperature):
+        buffer += delta
+        response += delta
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            yield line
+    if buffer:
+        yield buffer
+    _count_usage(_prompt, response)
+
+
+def summarize_conversation(summary, lines, model="gpt-3.5-turbo", max_tokens=150):
+    # Folds older conversation lines into a running summary, used to keep prompts within budget
+    prompt = f"Summary so far: {summary}\n" if summary else ''
+    prompt += "New lines:\n" + ''.join(lines)
+    system = "Summarize this conversation in a few sentences. Keep who said what and any running jokes."
+    return top_response(prompt, system=system, model=model, max_tokens=max_tokens, temperature=0.0)
@@ -0,0 +1,114 @@
+import functools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+log = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    # Loaded on first use: tiktoken downloads the BPE file the first time, which must not break imports offline
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        log.warning(f"Counting tokens by characters, tiktoken is not available: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Without tiktoken, English averages roughly four characters per token
+    return len(text) // 4 + 1
+
+
+class PromptWindow:
+    """ Conversation transcript for the LLM, kept within a token budget.
+
+    Recent lines are kept verbatim. Once they no longer fit, the oldest lines are folded into a
+    rolling summary, which `summarize(previous_summary, lines)` refreshes on a background thread.
+    """
+
+    SUMMARY_HEADER: str = "Summary of the conversation so far: "
+
+    def __init__(self,
+                 budget: int = 1000,
+                 system: str = '',
+                 summarize: Callable[[str, List[str]], str] = None):
+        self.budget = budget
+        self.summarize = summarize
+        self.system_tokens = count_tokens(system)
+        self.summary: str = ''
+        self.summary_tokens: int = 0
+        # (line, tokens) pairs of the verbatim tail of the conversation
+        self._lines: deque = deque()
+        self._lines_tokens: int = 0
+        self._text: str = ''
+        # Lines folded out of the window but not yet part of the summary
+        self._unsummarized: List[str] = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if summarize else None
+
+    def _available(self) -> int:
+        return self.budget - self.system_tokens - self.summary_tokens
+
+    def append(self, line: str):
+        tokens = count_tokens(line)
+        with self._lock:
+            self._lines.append((line, tokens))
+            self._lines_tokens += tokens
+            folded = []
+            # Always keep the newest line, even if it alone is over budget
+            while self._lines_tokens > self._available() and len(self._lines) > 1:
+                old_line, old_tokens = self._lines.popleft()
+                self._lines_tokens -= old_tokens
+                folded.append(old_line)
+            if folded:
+                self._text = ''.join(line for line, _ in self._lines)
+                self._unsummarized.extend(folded)
+                self._schedule_summary()
+            else:
+                self._text += line
+
+    def _schedule_summary(self):
+        if self._executor is None or self._summarizing or not self._unsummarized:
+            return
+        self._summarizing = True
+        lines, self._unsummarized = self._unsummarized, []
+        self._executor.submit(self._refresh_summary, self.summary, lines)
+
+    def _refresh_summary(self, previous: str, lines: List[str]):
+        try:
+            summary = self.summarize(previous, lines)
+        except Exception as e:
+            log.warning(f"Failed to summarize conversation: {e}")
+            summary = None
+        with self._lock:
+            self._summarizing = False
+            if summary is None:
+                # Try again with these lines the next time something is folded
+                self._unsummarized = lines + self._unsummarized
+                return
+            self.summary = summary
+            self.summary_tokens = count_tokens(self.SUMMARY_HEADER + summary)
+            # A longer summary may push more lines out of the window
+            while self._lines_tokens > self._available() and len(self._lines) > 1:
+                old_line, old_tokens = self._lines.popleft()
+                self._lines_tokens -= old_tokens
+                self._unsummarized.append(old_line)
+            self._text = ''.join(line for line, _ in self._lines)
+            self._schedule_summary()
+
+    def prompt(self) -> str:
+        with self._lock:
+            if self.summary:
+                return f"{self.SUMMARY_HEADER}{self.summary}\n{self._text}"
+            return self._text
+
+    def tokens(self) -> int:
+        return self.system_tokens + self.summary_tokens + self._lines_tokens
@@ -0,0 +1,218 @@
+import contextvars
+import email.utils
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Union
+
+log = logging.getLogger(__name__)
+
+# Lower numbers are served first: the clip about to play beats background export work
+PRIORITY_PLAYBACK: int = 0
+PRIORITY_EXPORT: int = 10
+# Audio of a turn the user may never ask for, see speculation.py
+PRIORITY_SPECULATIVE: int = 20
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Scheduler and priority of the job running in this context, so follow-up work (e.g. a hedge) can queue
+# alongside it and requests are throttled by the scheduler that runs them
+_CURRENT_JOB: contextvars.ContextVar = contextvars.ContextVar("tts_job", default=None)
+
+
+def current_priority() -> tuple:
+    job = _CURRENT_JOB.get()
+    return job[1] if job is not None else (PRIORITY_PLAYBACK,)
+
+
+def throttle():
+    """ Waits for a rate limit token of the scheduler running this job, call it right before each request.
+
+    Outside a scheduler job it returns immediately.
+    """
+    job = _CURRENT_JOB.get()
+    if job is not None:
+        job[0].bucket.acquire()
+
+
+def _run_at(call: Callable, scheduler: "TTSScheduler", priority: tuple):
+    _CURRENT_JOB.set((scheduler, priority))
+    return call()
+
+
+class TokenBucket:
+    """ Thread-safe token bucket, refilled continuously at `rate` tokens per second up to `capacity`. """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def status_code(exc: BaseException) -> Union[int, None]:
+    # requests.HTTPError carries the response, other clients expose the code directly
+    response = getattr(exc, "response", None)
+    code = getattr(response, "status_code", None) or getattr(exc, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after(exc: BaseException) -> Union[float, None]:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TTSScheduler:
+    """ Process-wide worker pool for TTS requests with a concurrency cap, rate limit, priorities and retries.
+
+    Jobs are plain callables run on a fixed set of threads, so the scheduler is shared across
+    the event loops created by each `asyncio.run` call. Await a job with `asyncio.wrap_future`.
+    Jobs take their rate limit token with `throttle()`, so one that needs no request (a cache hit) takes none.
+    """
+
+    def __init__(self,
+                 max_workers: int = 4,
+                 rate_per_second: float = 2.0,
+                 burst: float = None,
+                 max_retries: int = 5,
+                 base_backoff: float = 0.5,
+                 max_backoff: float = 30.0):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self._queue: list = []
+        self._counter = itertools.count()
+        self._cv = threading.Condition()
+        self._threads: list = []
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "retries": 0,
+            "throttled": 0,
+        }
+
+    def _ensure_workers(self):
+        # Workers are started lazily so importing the module never spawns threads
+        while len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._worker, name=f"tts-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn: Callable, *args, priority: Union[int, tuple] = PRIORITY_PLAYBACK, **kwargs) -> Future:
+        future: Future = Future()
+        # Priorities may be refined with a position, e.g. (PRIORITY_PLAYBACK, turn_index)
+        if not isinstance(priority, tuple):
+            priority = (priority,)
+        # Run in a copy of the caller's context, so the job's spans nest under the caller's trace
+        job = functools.partial(contextvars.copy_context().run, _run_at, functools.partial(fn, *args, **kwargs))
+        with self._cv:
+            self._ensure_workers()
+            # The counter keeps equal priorities first-in first-out
+            heapq.heappush(self._queue, (priority, next(self._counter), future, job))
+            self.stats["submitted"] += 1
+            self._cv.notify()
+        return future
+
+    def reprioritize(self, future: Future, priority: Union[int, tuple]) -> bool:
+        """ Moves a job that is still queued to `priority`, False if it already started or finished. """
+        if not isinstance(priority, tuple):
+            priority = (priority,)
+        with self._cv:
+            for index, (_, count, queued, job) in enumerate(self._queue):
+                if queued is future:
+                    # Same counter, so the job keeps its place among jobs of the new priority
+                    self._queue[index] = (priority, count, queued, job)
+                    heapq.heapify(self._queue)
+                    return True
+        return False
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        # Full jitter, but never retry earlier than the server asked us to
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        server_delay = retry_after(exc)
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.max_backoff))
+        return delay
+
+    def _worker(self):
+        while True:
+            with self._cv:
+                while not self._queue:
+                    self._cv.wait()
+                priority, _, future, job = heapq.heappop(self._queue)
+            # Skip jobs whose caller already gave up (e.g. playback was cancelled)
+            if not future.set_running_or_notify_cancel():
+                continue
+            attempt = 0
+            while True:
+                try:
+                    result = job(self, priority)
+                except Exception as e:
+                    code = status_code(e)
+                    if code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                        delay = self._backoff(attempt, e)
+                        attempt += 1
+                        with self._cv:
+                            self.stats["retries"] += 1
+                            if code == 429:
+                                self.stats["throttled"] += 1
+                        log.warning(f"TTS request failed with {code}, retrying in {delay:.2f} seconds")
+                        time.sleep(delay)
+                        continue
+                    with self._cv:
+                        self.stats["failed"] += 1
+                    future.set_exception(e)
+                else:
+                    with self._cv:
+                        self.stats["completed"] += 1
+                    future.set_result(result)
+                break
+
+
+TTS_SCHEDULER = TTSScheduler(
+    max_workers=int(os.environ.get("TTS_MAX_CONCURRENCY", 4)),
+    rate_per_second=float(os.environ.get("TTS_RATE_PER_SECOND", 2.0)),
+)
+
+
+def configure_tts_scheduler(**kwargs) -> TTSScheduler:
+    # Replaces the process-wide scheduler, jobs already queued on the old one still finish
+    global TTS_SCHEDULER
+    TTS_SCHEDULER = TTSScheduler(**kwargs)
+    return TTS_SCHEDULER
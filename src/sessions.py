@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Session:
+    id: str
+    state: Any
+    # Serializes handlers of one session, different sessions run concurrently. A plain Lock
+    # rather than an RLock, since gradio may resume a generator handler on another thread
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class SessionStore:
+    """ Per-browser-session state, evicted least-recently-used past `max_sessions`, `max_bytes` or `idle_timeout`.
+
+    `factory(session_id)` builds the state for a new session, `sizeof(state)` estimates its memory
+    footprint and `on_evict(session)` cleans up anything the session left behind (e.g. exports).
+    """
+
+    def __init__(self,
+                 factory: Callable[[str], Any],
+                 max_sessions: int = 64,
+                 idle_timeout: float = 3600.0,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 sizeof: Callable[[Any], int] = None,
+                 on_evict: Callable[[Session], None] = None):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda state: 0)
+        self.on_evict = on_evict
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"created": 0, "evicted": 0}
+
+    def get(self, session_id: str = None) -> Session:
+        """ Returns the session for `session_id`, creating a new one if it is unknown or was evicted.
+
+        Every call also evicts, so idle sessions go even when no new browser connects.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(session.id)
+                evicted = self._evict(keep=session)
+        if session is not None:
+            self._cleanup(evicted)
+            return session
+        # Build the state outside the store lock so a slow factory never blocks other sessions
+        session_id = session_id or uuid.uuid4().hex
+        session = Session(id=session_id, state=self.factory(session_id))
+        with self._lock:
+            # Another request for the same session may have won the race
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                return existing
+            self._sessions[session_id] = session
+            self.stats["created"] += 1
+            evicted = self._evict(keep=session)
+        self._cleanup(evicted)
+        return session
+
+    def _evict(self, keep: Session) -> List[Session]:
+        # Oldest first. Each evicted session comes back with its lock taken, released after its cleanup
+        evicted = []
+        now = time.monotonic()
+        count = len(self._sessions)
+        total_bytes = sum(self.sizeof(session.state) for session in self._sessions.values())
+        for session in list(self._sessions.values()):
+            # Never the session that was just used, even if it alone exceeds the caps
+            if session is keep:
+                continue
+            if now - session.last_used <= self.idle_timeout and count <= self.max_sessions \
+                    and total_bytes <= self.max_bytes:
+                continue
+            # A handler is using it, it goes on a later call once the handler is done
+            if not session.lock.acquire(blocking=False):
+                continue
+            del self._sessions[session.id]
+            count -= 1
+            total_bytes -= self.sizeof(session.state)
+            evicted.append(session)
+        self.stats["evicted"] += len(evicted)
+        return evicted
+
+    def _cleanup(self, sessions: List[Session]):
+        for session in sessions:
+            log.info(f"Evicting session {session.id}")
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(session)
+                except Exception as e:
+                    log.warning(f"Failed to clean up session {session.id}: {e}")
+            session.lock.release()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple, Union
+
+from . import metrics, scheduler
+from .elevenlabs import PLAYBACK_FORMAT, Speaker, prefetch_speech, speech_requests
+from .openailib import top_response
+from .prompt import count_tokens
+from .scheduler import PRIORITY_PLAYBACK, PRIORITY_SPECULATIVE
+
+log = logging.getLogger(__name__)
+
+# Off by default: a speculative turn the user never asks for is paid for anyway
+SPECULATIVE_TURNS: bool = os.environ.get("SPECULATIVE_TURNS", "0") == "1"
+# Characters of discarded speculative audio a conversation may waste before it stops speculating
+SPECULATIVE_WASTE_CHARACTERS: int = int(os.environ.get("SPECULATIVE_WASTE_CHARACTERS", 2000))
+# Same for the LLM: prompt and completion tokens of discarded speculative turns
+SPECULATIVE_WASTE_TOKENS: int = int(os.environ.get("SPECULATIVE_WASTE_TOKENS", 20000))
+
+# Only LLM calls run here, their TTS goes through the shared scheduler at the lowest priority
+_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("SPECULATIVE_WORKERS", 4)), thread_name_prefix="speculate")
+
+
+@dataclass
+class SpeculativeTurn:
+    # History signature the turn continues, it is only valid while the history still matches
+    basis: List[Tuple[str, str]]
+    lines: List[Tuple[Speaker, str]] = field(default_factory=list)
+    speech: List[Future] = field(default_factory=list)
+    done: threading.Event = field(default_factory=threading.Event)
+    cancelled: bool = False
+    error: Exception = None
+    # Prompt and completion tokens of the LLM call, 0 until it returns
+    tokens: int = 0
+
+
+class Speculator:
+    """ Generates a conversation's next turn in the background, LLM response and audio, while the
+    current one is played or read. `take` commits it if the history did not change in the meantime,
+    `cancel` discards it, as does a turn that failed or came back empty. Once discarded audio adds up to
+    `waste_budget` characters, or discarded LLM calls to `token_budget` tokens, it stops speculating.
+    """
+
+    def __init__(self,
+                 enabled: bool = SPECULATIVE_TURNS,
+                 waste_budget: int = SPECULATIVE_WASTE_CHARACTERS,
+                 token_budget: int = SPECULATIVE_WASTE_TOKENS):
+        self.enabled = enabled
+        self.waste_budget = waste_budget
+        self.token_budget = token_budget
+        self.wasted_characters = 0
+        self.wasted_tokens = 0
+        self.turn: SpeculativeTurn = None
+        self._lock = threading.Lock()
+
+    def start(self,
+              basis: List[Tuple[str, str]],
+              prompt: str,
+              system: str,
+              model: str,
+              max_tokens: int,
+              temperature: float,
+              parse_line: Callable[[str], Union[Tuple[Speaker, str], None]]) -> bool:
+        self.cancel()
+        if not self.enabled:
+            return False
+        if self.wasted_characters >= self.waste_budget:
+            log.info(f"Not speculating, {self.wasted_characters} characters of speculative audio already wasted")
+            return False
+        if self.wasted_tokens >= self.token_budget:
+            log.info(f"Not speculating, {self.wasted_tokens} tokens of speculative turns already wasted")
+            return False
+        turn = SpeculativeTurn(basis=basis)
+        with self._lock:
+            self.turn = turn
+        metrics.METRICS.incr("speculation.started")
+        # Spans of the background turn start their own trace
+        _POOL.submit(self._generate, turn, prompt, system, model, max_tokens, temperature, parse_line)
+        return True
+
+    def _generate(self, turn: SpeculativeTurn, prompt, system, model, max_tokens, temperature, parse_line):
+        try:
+            with metrics.span("turn.speculate"):
+                response = top_response(prompt, system=system, model=model, max_tokens=max_tokens, temperature=temperature)
+                tokens = count_tokens(system or '') + count_tokens(prompt) + count_tokens(response)
+                with self._lock:
+                    turn.tokens = tokens
+                    # Discarded while the LLM was still answering, the call is paid for all the same
+                    late = turn.cancelled
+                    if late:
+                        self.wasted_tokens += tokens
+                if late:
+                    metrics.METRICS.incr("speculation.wasted_tokens", tokens)
+                    return
+                for line in response.splitlines():
+                    parsed = parse_line(line)
+                    if parsed is None:
+                        continue
+                    with self._lock:
+                        # Checked under the lock, so a cancel never misses a clip submitted after it
+                        if turn.cancelled:
+                            return
+                        turn.lines.append(parsed)
+                        turn.speech.append(prefetch_speech(parsed[1], parsed[0], priority=PRIORITY_SPECULATIVE,
+                                                           output_format=PLAYBACK_FORMAT))
+        except Exception as e:
+            log.warning(f"Speculative turn failed: {e}")
+            turn.error = e
+        finally:
+            turn.done.set()
+
+    def take(self, basis: List[Tuple[str, str]]) -> List[Tuple[Speaker, str, Future]]:
+        """ The speculative turn's lines with their audio futures, None if there is none for this history. """
+        with self._lock:
+            turn = self.turn
+            self.turn = None
+        if turn is None:
+            return None
+        if turn.basis != basis:
+            self._discard(turn)
+            return None
+        # Still waiting on the LLM is never slower than starting the request over
+        turn.done.wait()
+        if turn.error is not None or not turn.lines:
+            # Nothing to play, but the LLM call and any clip of the lines before a failure were paid for
+            self._discard(turn)
+            return None
+        metrics.METRICS.incr("speculation.hits")
+        # Clips still queued were waiting behind exports and other sessions, now they are about to be played
+        for i, ((_, text), future) in enumerate(zip(turn.lines, turn.speech)):
+            for _, request in speech_requests(future, text):
+                scheduler.TTS_SCHEDULER.reprioritize(request, (PRIORITY_PLAYBACK, i))
+        return [(speaker, text, future) for (speaker, text), future in zip(turn.lines, turn.speech)]
+
+    def cancel(self):
+        # New mic input, a reset or a disabled checkbox: whatever was prepared no longer fits
+        with self._lock:
+            turn = self.turn
+            self.turn = None
+        if turn is not None:
+            self._discard(turn)
+
+    def _discard(self, turn: SpeculativeTurn):
+        with self._lock:
+            turn.cancelled = True
+            # Requests still queued are dropped for free, the ones already synthesized or in flight were paid for.
+            # A split line's own future is cancelled first, which cancels its queued pieces
+            wasted = 0
+            for (_, text), future in zip(turn.lines, turn.speech):
+                future.cancel()
+                wasted += sum(len(piece) for piece, request in speech_requests(future, text) if not request.cancel())
+            self.wasted_characters += wasted
+            # Still 0 if the LLM has not answered yet, _generate charges it then
+            tokens = turn.tokens
+            self.wasted_tokens += tokens
+        metrics.METRICS.incr("speculation.discarded")
+        metrics.METRICS.incr("speculation.wasted_characters", wasted)
+        metrics.METRICS.incr("speculation.wasted_tokens", tokens)
+        log.info(f"Discarded speculative turn, {wasted} characters of audio and {tokens} tokens wasted")
@@ -0,0 +1,404 @@
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process locking, run a single app process per store directory
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+STORE_DIR: str = os.environ.get(
+    "CONVERSATION_STORE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conversations'))
+# Conversations untouched for this long are deleted, their audio goes earlier and only the transcript is kept
+RETENTION_DAYS: float = float(os.environ.get("CONVERSATION_RETENTION_DAYS", 90))
+AUDIO_RETENTION_DAYS: float = float(os.environ.get("CONVERSATION_AUDIO_RETENTION_DAYS", 7))
+# Past this the least recently written conversations are deleted
+STORE_MAX_BYTES: int = int(os.environ.get("CONVERSATION_STORE_MAX_BYTES", 1024 * 1024 * 1024))
+# A conversation is rewritten once this many of its bytes are no longer referenced
+COMPACT_MIN_DEAD_BYTES: int = 1024 * 1024
+
+# Conversation ids end up in file names, and come back from the UI when resuming
+_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+@dataclass
+class StoredTurn:
+    speaker: str
+    text: str
+    time: float
+    # (offset, length, output format) of the rendered clip in the conversation's audio file
+    audio: Tuple[int, int, str] = None
+
+
+@dataclass
+class StoredConversation:
+    id: str
+    session_id: str
+    # names, iam, model, max_tokens, temperature
+    settings: Dict
+    started: float
+    audio_file: str
+    turns: List[StoredTurn] = field(default_factory=list)
+    # Bytes of log and audio the turns above no longer need, e.g. a clip rendered twice
+    dead_bytes: int = 0
+    # Inode of the log this was read from, a different one on disk means another process rewrote it
+    log_inode: int = None
+
+
+class ConversationStore:
+    """ Conversations on disk, each an append-only JSON lines log of its turns plus an append-only file of their
+    rendered audio, so a conversation resumes after a restart without synthesizing anything again.
+
+    Records are only ever appended: a turn's audio is a later record pointing at (offset, length) in the audio
+    file. `sweep` applies the retention policy and compacts conversations with many unreferenced bytes.
+
+    Several processes may share a directory: writes, compaction and deletion of a conversation hold its lock
+    file, and a process whose index is stale (the log was compacted or deleted elsewhere) re-reads it first.
+    """
+
+    def __init__(self,
+                 root: str = STORE_DIR,
+                 retention_seconds: float = RETENTION_DAYS * 86400,
+                 audio_retention_seconds: float = AUDIO_RETENTION_DAYS * 86400,
+                 max_bytes: int = STORE_MAX_BYTES,
+                 max_open: int = 256):
+        self.root = root
+        self.retention_seconds = retention_seconds
+        self.audio_retention_seconds = audio_retention_seconds
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        # Loaded conversations by id, the index for turn lookups. Dropped with close() or past max_open
+        self._open: OrderedDict = OrderedDict()
+        # Started but without turns yet, nothing is written for a conversation that never gets any
+        self._pending: Dict[str, StoredConversation] = {}
+        # session id -> conversation ids, built from the log headers on first use
+        self._sessions: Dict[str, List[str]] = None
+        self._lock = threading.RLock()
+        self.stats: Dict[str, int] = {"turns": 0, "clips": 0, "compacted": 0, "deleted": 0}
+
+    @staticmethod
+    def valid_id(conversation_id: str) -> bool:
+        return isinstance(conversation_id, str) and _ID_PATTERN.match(conversation_id) is not None
+
+    def _log_path(self, conversation_id: str) -> str:
+        return os.path.join(self.root, f"{conversation_id}.log")
+
+    def _audio_path(self, audio_file: str) -> str:
+        return os.path.join(self.root, audio_file)
+
+    def _files(self, conversation_id: str) -> List[str]:
+        # The log and every generation of the audio file, an interrupted compaction can leave a newer one behind
+        return [self._log_path(conversation_id)] + glob.glob(os.path.join(self.root, f"{conversation_id}.*.audio"))
+
+    @contextmanager
+    def _file_lock(self, conversation_id: str):
+        # Taken before self._lock, never while holding it
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f"{conversation_id}.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _current(self, conversation_id: str) -> Union[StoredConversation, None]:
+        # Like load, but with the file lock held: re-read if another process compacted or deleted the log since
+        conversation = self.load(conversation_id)
+        if conversation is None or conversation_id in self._pending:
+            return conversation
+        try:
+            inode = os.stat(self._log_path(conversation_id)).st_ino
+        except FileNotFoundError:
+            self._forget(conversation_id)
+            return None
+        if inode != conversation.log_inode:
+            conversation = self._read(conversation_id)
+            if conversation is None:
+                self._forget(conversation_id)
+                return None
+            self._remember(conversation)
+        return conversation
+
+    def _forget(self, conversation_id: str):
+        self._open.pop(conversation_id, None)
+        self._pending.pop(conversation_id, None)
+
+    def _append(self, conversation_id: str, record: Dict):
+        # One line per record, a line cut short by a crash is skipped when loading
+        with open(self._log_path(conversation_id), "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def start(self, session_id: str = None, **settings) -> str:
+        """ Starts a new conversation, returns its id. """
+        conversation_id = uuid.uuid4().hex
+        conversation = StoredConversation(id=conversation_id, session_id=session_id, settings=settings,
+                                          started=time.time(), audio_file=f"{conversation_id}.0.audio")
+        with self._lock:
+            self._pending[conversation_id] = conversation
+        return conversation_id
+
+    @staticmethod
+    def _header(conversation: StoredConversation) -> Dict:
+        return {"type": "conversation", "id": conversation.id, "session": conversation.session_id,
+                "settings": conversation.settings, "time": conversation.started, "audio_file": conversation.audio_file}
+
+    def _remember(self, conversation: StoredConversation):
+        self._open[conversation.id] = conversation
+        self._open.move_to_end(conversation.id)
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+
+    def load(self, conversation_id: str) -> Union[StoredConversation, None]:
+        """ The conversation with every turn and audio reference, None if it is not stored. """
+        if not self.valid_id(conversation_id):
+            return None
+        with self._lock:
+            conversation = self._open.get(conversation_id) or self._pending.get(conversation_id)
+            if conversation is None:
+                conversation = self._read(conversation_id)
+            if conversation is not None and conversation_id not in self._pending:
+                self._remember(conversation)
+            return conversation
+
+    def _read(self, conversation_id: str) -> Union[StoredConversation, None]:
+        conversation = None
+        try:
+            f = open(self._log_path(conversation_id))
+        except FileNotFoundError:
+            return None
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                kind = record.get("type")
+                if kind == "conversation":
+                    conversation = StoredConversation(id=conversation_id, session_id=record.get("session"),
+                                                      settings=record.get("settings", {}),
+                                                      started=record["time"], audio_file=record["audio_file"],
+                                                      log_inode=inode)
+                elif conversation is None:
+                    continue
+                elif kind == "turn" and record["i"] == len(conversation.turns):
+                    conversation.turns.append(StoredTurn(record["speaker"], record["text"], record["time"]))
+                elif kind == "audio" and record["i"] < len(conversation.turns):
+                    turn = conversation.turns[record["i"]]
+                    if turn.audio is not None:
+                        conversation.dead_bytes += turn.audio[1] + len(line)
+                    turn.audio = (record["offset"], record["length"], record["format"])
+                else:
+                    conversation.dead_bytes += len(line)
+        return conversation
+
+    def close(self, conversation_id: str):
+        # Frees the in-memory index, the conversation stays on disk
+        with self._lock:
+            self._forget(conversation_id)
+
+    def append_turn(self, conversation_id: str, speaker: str, text: str) -> Union[int, None]:
+        """ Records the next turn, returns its index or None if the conversation was deleted. """
+        with self._file_lock(conversation_id), self._lock:
+            conversation = self._current(conversation_id)
+            if conversation is None:
+                log.warning(f"Conversation {conversation_id} is no longer stored, not recording turn")
+                return None
+            if conversation_id in self._pending:
+                os.makedirs(self.root, exist_ok=True)
+                self._append(conversation_id, self._header(conversation))
+                conversation.log_inode = os.stat(self._log_path(conversation_id)).st_ino
+                self._remember(self._pending.pop(conversation_id))
+                if self._sessions is not None:
+                    self._sessions.setdefault(conversation.session_id, []).append(conversation_id)
+            turn = StoredTurn(speaker, text, time.time())
+            index = len(conversation.turns)
+            self._append(conversation_id, {"type": "turn", "i": index, "speaker": speaker, "text": text,
+                                           "time": turn.time})
+            conversation.turns.append(turn)
+            self.stats["turns"] += 1
+            return index
+
+    def append_audio(self, conversation_id: str, index: int, audio_bytes: bytes, output_format: str):
+        """ Keeps the rendered audio of turn `index`, unless it already has audio in this format. """
+        with self._file_lock(conversation_id), self._lock:
+            conversation = self._current(conversation_id)
+            if conversation is None or index >= len(conversation.turns):
+                return
+            turn = conversation.turns[index]
+            if turn.audio is not None and turn.audio[2] == output_format:
+                return
+            # The clip is written before the record pointing at it, so a crash never leaves a dangling reference
+            with open(self._audio_path(conversation.audio_file), "ab") as f:
+                offset = f.tell()
+                f.write(audio_bytes)
+            self._append(conversation_id, {"type": "audio", "i": index, "offset": offset, "length": len(audio_bytes),
+                                           "format": output_format, "time": time.time()})
+            if turn.audio is not None:
+                conversation.dead_bytes += turn.audio[1]
+            turn.audio = (offset, len(audio_bytes), output_format)
+            self.stats["clips"] += 1
+
+    def read_audio(self, conversation_id: str, index: int, output_format: str) -> Union[bytes, None]:
+        """ Stored audio of turn `index` in `output_format`, None if there is none. """
+        with self._lock:
+            conversation = self.load(conversation_id)
+            if conversation is None or index >= len(conversation.turns):
+                return None
+            audio = conversation.turns[index].audio
+            path = self._audio_path(conversation.audio_file)
+        if audio is None or audio[2] != output_format:
+            return None
+        offset, length, _ = audio
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            return None
+        return data if len(data) == length else None
+
+    def clips(self, conversation_id: str, output_format: str, start: int = 0) -> "ConversationClips":
+        return ConversationClips(self, conversation_id, output_format, start)
+
+    def conversations(self, session_id: str) -> List[str]:
+        """ Ids of the conversations of a session, oldest first. """
+        with self._lock:
+            if self._sessions is None:
+                self._sessions = {}
+                for conversation_id, header in sorted(self._headers(), key=lambda item: item[1].get("time", 0)):
+                    self._sessions.setdefault(header.get("session"), []).append(conversation_id)
+            return list(self._sessions.get(session_id, []))
+
+    def _headers(self):
+        # (id, first record) of every stored conversation, reading one line of each log
+        for path in glob.glob(os.path.join(self.root, "*.log")):
+            try:
+                with open(path) as f:
+                    header = json.loads(f.readline())
+            except (OSError, json.JSONDecodeError):
+                continue
+            yield os.path.basename(path)[:-len(".log")], header
+
+    def compact(self, conversation_id: str, keep_audio: bool = True):
+        """ Rewrites a conversation with only the records and clips still referenced, or without any audio. """
+        with self._file_lock(conversation_id), self._lock:
+            # Read from disk, another process may have appended to it. Not added to the index, a sweep should
+            # not push live conversations out of it
+            conversation = self._read(conversation_id)
+            if conversation is None:
+                return
+            old_audio_path = self._audio_path(conversation.audio_file)
+            generation = int(conversation.audio_file.split(".")[1]) + 1
+            audio_file = f"{conversation_id}.{generation}.audio"
+            turns = []
+            # New generation of the audio file first, the old log keeps pointing at the old file until the swap
+            with open(self._audio_path(audio_file), "wb") as out:
+                for turn in conversation.turns:
+                    audio = None
+                    if keep_audio and turn.audio is not None:
+                        with open(old_audio_path, "rb") as f:
+                            f.seek(turn.audio[0])
+                            data = f.read(turn.audio[1])
+                        if len(data) == turn.audio[1]:
+                            audio = (out.tell(), len(data), turn.audio[2])
+                            out.write(data)
+                    turns.append(StoredTurn(turn.speaker, turn.text, turn.time, audio))
+            compacted = StoredConversation(id=conversation_id, session_id=conversation.session_id,
+                                           settings=conversation.settings, started=conversation.started,
+                                           audio_file=audio_file, turns=turns)
+            records = [self._header(compacted)]
+            for i, turn in enumerate(turns):
+                records.append({"type": "turn", "i": i, "speaker": turn.speaker, "text": turn.text, "time": turn.time})
+                if turn.audio is not None:
+                    records.append({"type": "audio", "i": i, "offset": turn.audio[0], "length": turn.audio[1],
+                                    "format": turn.audio[2], "time": turn.time})
+            log_path = self._log_path(conversation_id)
+            with open(f"{log_path}.tmp", "w") as f:
+                f.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+            # Atomic: readers see either the old log and audio file or the new ones
+            os.replace(f"{log_path}.tmp", log_path)
+            compacted.log_inode = os.stat(log_path).st_ino
+            for path in self._files(conversation_id)[1:]:
+                if path != self._audio_path(audio_file):
+                    os.remove(path)
+            if conversation_id in self._open:
+                self._open[conversation_id] = compacted
+            self.stats["compacted"] += 1
+
+    def delete(self, conversation_id: str):
+        with self._file_lock(conversation_id), self._lock:
+            self._forget(conversation_id)
+            # The lock file too: a process still waiting on it finds no log afterwards and records nothing
+            for path in self._files(conversation_id) + [os.path.join(self.root, f"{conversation_id}.lock")]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            if self._sessions is not None:
+                for ids in self._sessions.values():
+                    if conversation_id in ids:
+                        ids.remove(conversation_id)
+            self.stats["deleted"] += 1
+
+    def sweep(self):
+        """ Applies the retention policy: old conversations are deleted, older audio dropped, wasted space
+        compacted, and the least recently written conversations go while the store is over `max_bytes`. """
+        now = time.time()
+        sizes: Dict[str, Tuple[float, int]] = {}
+        for conversation_id, _ in list(self._headers()):
+            with self._lock:
+                conversation = self._open.get(conversation_id) or self._read(conversation_id)
+            if conversation is None:
+                continue
+            # Age from the records, not file times, which compaction itself updates
+            last_active = max([conversation.started] + [turn.time for turn in conversation.turns[-1:]])
+            age = now - last_active
+            if age > self.retention_seconds:
+                self.delete(conversation_id)
+                continue
+            if age > self.audio_retention_seconds and any(turn.audio is not None for turn in conversation.turns):
+                self.compact(conversation_id, keep_audio=False)
+            elif conversation.dead_bytes >= COMPACT_MIN_DEAD_BYTES:
+                self.compact(conversation_id)
+            sizes[conversation_id] = (last_active, sum(os.path.getsize(path) for path in self._files(conversation_id)))
+        total = sum(size for _, size in sizes.values())
+        for conversation_id, (_, size) in sorted(sizes.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            self.delete(conversation_id)
+            total -= size
+        log.info(f"Conversation store: {len(sizes)} conversations, {total / 1024 / 1024:.1f} MB")
+
+
+class ConversationClips:
+    """ Stored audio of a conversation's turns from `start` on, for play_history and save_history:
+    `get(i)` is the clip of turn start + i or None, `put(i, audio)` stores a freshly synthesized one. """
+
+    def __init__(self, store: ConversationStore, conversation_id: str, output_format: str, start: int = 0):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.output_format = output_format
+        self.start = start
+
+    def get(self, index: int) -> Union[bytes, None]:
+        return self.store.read_audio(self.conversation_id, self.start + index, self.output_format)
+
+    def put(self, index: int, audio_bytes: bytes):
+        self.store.append_audio(self.conversation_id, self.start + index, audio_bytes, self.output_format)
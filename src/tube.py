@@ -9,9 +9,15 @@ import subprocess
 from pathlib import Path
 import datetime
 import argparse
+import logging
 import os
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
 from pytube import YouTube
 
+log = logging.getLogger(__name__)
+
 # Define argparse arguments
 parser = argparse.ArgumentParser(description='Extract audio from a YouTube video')
 parser.add_argument('url', type=str, help='the YouTube video URL')
@@ -20,41 +26,177 @@ parser.add_argument('-s', '--start-time', type=float, default=0, help='the start
 parser.add_argument('-d', '--duration', type=int, help='the duration in seconds for the extracted audio (default: 60)')
 
 
-# 200 seconds seems to be max duration for single clips
-def extract_audio(url: str, label: str, start_minute: float = 0, duration: int = 200):
-    
-    # Download the YouTube video
+SOURCE_CACHE_DIR: str = os.environ.get(
+    "SPEECH2SPEECH_SOURCE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audio_cache', 'sources'))
+
+
+def video_id(url: str) -> str:
+    # Handles youtu.be/<id>, youtube.com/watch?v=<id> and youtube.com/live/<id>
+    parsed = urlparse(url)
+    if parsed.hostname and parsed.hostname.endswith("youtu.be"):
+        return parsed.path.lstrip("/").split("/")[0]
+    query = parse_qs(parsed.query)
+    if "v" in query:
+        return query["v"][0]
+    return parsed.path.rstrip("/").split("/")[-1]
+
+
+# Extracted reference segments, kept so a failed or repeated batch does not fetch them again
+REFERENCE_DIR: str = os.environ.get(
+    "SPEECH2SPEECH_REFERENCE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audio_cache', 'references'))
+
+# "range" streams only the requested segments straight into ffmpeg, "download" caches whole videos
+FETCH_MODE: str = os.environ.get("SPEECH2SPEECH_FETCH_MODE", "range")
+
+
+def _timestamp(seconds: float) -> str:
+    # Format in HH:MM:SS.mmm format
+    formatted = str(datetime.timedelta(seconds=seconds))
+    return formatted[:11] + formatted[12:]
+
+
+def _abr_kbps(stream) -> int:
+    # pytube reports bitrates as strings like "48kbps"
+    try:
+        return int(str(stream.abr).rstrip("kbps"))
+    except ValueError:
+        return 0
+
+
+def select_audio_stream(streams, min_abr_kbps: int = 48):
+    """ Smallest audio-only stream with at least `min_abr_kbps`, voice cloning gains nothing from more. """
+    audio_streams = sorted(streams.filter(only_audio=True), key=_abr_kbps)
+    suitable = [stream for stream in audio_streams if _abr_kbps(stream) >= min_abr_kbps]
+    return (suitable or audio_streams or [streams.first()])[0]
+
+
+def audio_source_url(url: str) -> str:
+    host = urlparse(url).hostname or ''
+    if not (host.endswith("youtube.com") or host.endswith("youtu.be")):
+        # Direct media URLs, e.g. a locally served file, are fetched as they are
+        return url
+    return select_audio_stream(YouTube(url).streams).url
+
+
+def _partial_path(output_path: Path) -> Path:
+    # Keeps the extension, ffmpeg picks the output format from it
+    return output_path.with_name(f"{output_path.stem}.part{output_path.suffix}")
+
+
+def _run_ffmpeg(cmd: List[str], segments: List[Tuple[Path, float, int]]) -> List[Path]:
+    # ffmpeg writes temporary names, renamed only once it exited cleanly, so a failed or interrupted run
+    # never leaves an empty or partial file that looks like an extracted segment
+    try:
+        subprocess.run(cmd, check=True)
+        for output_path, _, _ in segments:
+            os.replace(_partial_path(output_path), output_path)
+    finally:
+        for output_path, _, _ in segments:
+            _partial_path(output_path).unlink(missing_ok=True)
+    return [output_path for output_path, _, _ in segments]
+
+
+def fetch_segments(url: str, segments: List[Tuple[Path, float, int]]) -> List[Path]:
+    """ Extracts every (output_path, start_minute, duration) segment without downloading the whole video.
+
+    Each segment is a separate ffmpeg input with input-side seeking, so ffmpeg only requests the
+    byte ranges around it and bytes transferred scale with segment length, not video length.
+    """
+    source = audio_source_url(url)
+    cmd = ['ffmpeg', '-y']
+    for _, start_minute, duration in segments:
+        cmd += ['-ss', _timestamp(int(start_minute * 60))]
+        if duration is not None:
+            cmd += ['-t', _timestamp(duration)]
+        cmd += ['-i', source]
+    for i, (output_path, _, _) in enumerate(segments):
+        cmd += ['-map', f'{i}:a', '-q:a', '0', str(_partial_path(output_path))]
+    return _run_ffmpeg(cmd, segments)
+
+
+def download_video(url: str, cache_dir: str = SOURCE_CACHE_DIR) -> Path:
+    # Downloads are kept by video id, so every later reference to the same video is free
+    os.makedirs(cache_dir, exist_ok=True)
+    _id = video_id(url)
+    for existing in Path(cache_dir).glob(f"{_id}.*"):
+        if not existing.name.endswith(".part"):
+            return existing
     youtube_object = YouTube(url)
-    stream = youtube_object.streams.first()
-    video_path = Path(stream.download(skip_existing=True))
-    
-    # Convert start time to seconds
-    start_time_seconds = int(start_minute * 60)
-
-    # Format the start time in HH:MM:SS.mmm format
-    start_time_formatted = str(datetime.timedelta(seconds=start_time_seconds))
-    start_time_formatted = start_time_formatted[:11] + start_time_formatted[12:]
-
-    # Set the output path using the audio file name
-    output_path = video_path.parent / f"{label}.wav"
-
-    # Run ffmpeg to extract the audio
-    cmd = ['ffmpeg', '-y', '-i', str(video_path), '-ss', start_time_formatted]
-    if duration is not None:
-        # Format the duration in HH:MM:SS.mmm format
-        duration_formatted = str(datetime.timedelta(seconds=duration))
-        duration_formatted = duration_formatted[:11] + duration_formatted[12:]
-        cmd += ['-t', duration_formatted]
-    cmd += ['-q:a', '0', '-map', 'a', str(output_path)]
-    subprocess.run(cmd)
-
-    # remove the extra .3gpp file that is created:
-    for file in os.listdir(video_path.parent):
-        if file.endswith(".3gpp"):
-            os.remove(os.path.join(video_path.parent, file))
+    stream = select_audio_stream(youtube_object.streams)
+    filename = f"{_id}.{stream.subtype}"
+    # Download under a temporary name so an interrupted download is never mistaken for a cached one
+    partial = Path(stream.download(output_path=cache_dir, filename=f"{filename}.part"))
+    video_path = partial.with_name(filename)
+    os.replace(partial, video_path)
+    return video_path
+
+
+def cut_segments(video_path: Path, segments: List[Tuple[Path, float, int]]) -> List[Path]:
+    """ Extracts every (output_path, start_minute, duration) segment of a video in a single ffmpeg run. """
+    cmd = ['ffmpeg', '-y', '-i', str(video_path)]
+    for output_path, start_minute, duration in segments:
+        cmd += ['-ss', _timestamp(int(start_minute * 60))]
+        if duration is not None:
+            cmd += ['-t', _timestamp(duration)]
+        cmd += ['-q:a', '0', '-map', 'a', str(_partial_path(output_path))]
+    return _run_ffmpeg(cmd, segments)
 
+
+# 200 seconds seems to be max duration for single clips
+def extract_audio(url: str, label: str, start_minute: float = 0, duration: int = 200):
+    output_path = Path(f"{label}.wav")
+    if FETCH_MODE == "range":
+        fetch_segments(url, [(output_path, start_minute, duration)])
+    else:
+        cut_segments(download_video(url), [(output_path, start_minute, duration)])
     return output_path
 
+
+def plan_references(characters: Dict[str, List[Dict]], output_dir: str) -> Tuple[
+        Dict[str, str], Dict[str, List[Tuple[Path, float, int]]], Dict[str, List[Path]]]:
+    """ Groups the references of every character by video.
+
+    `characters` maps a name to its `references` list from voices.yaml. Returns the url of every
+    video id, the segments to extract from each video, and the reference audio paths of each character.
+    """
+    urls: Dict[str, str] = {}
+    by_video: Dict[str, List[Tuple[Path, float, int]]] = defaultdict(list)
+    paths: Dict[str, List[Path]] = {}
+    for name, references in characters.items():
+        paths[name] = []
+        for video in references:
+            _id = video_id(video['url'])
+            start_minute = video.get('start_minute', 0)
+            duration = video.get('duration_seconds', 120)
+            urls[_id] = video['url']
+            # Named after the segment itself, so an interrupted batch can reuse what it already fetched
+            output_path = Path(output_dir) / f"audio.{name}.{_id}.{start_minute}.{duration}.wav"
+            by_video[_id].append((output_path, start_minute, duration))
+            paths[name].append(output_path)
+    return urls, by_video, paths
+
+
+def _extracted(output_path: Path) -> bool:
+    return output_path.exists() and output_path.stat().st_size > 0
+
+
+def ingest_video(url: str, segments: List[Tuple[Path, float, int]]) -> List[Path]:
+    """ Extracts the segments of one video that are not on disk yet, raising if any could not be produced. """
+    todo = [segment for segment in segments if not _extracted(segment[0])]
+    if todo:
+        os.makedirs(todo[0][0].parent, exist_ok=True)
+        if FETCH_MODE == "range":
+            fetch_segments(url, todo)
+        else:
+            cut_segments(download_video(url), todo)
+    missing = [str(output_path) for output_path, _, _ in todo if not _extracted(output_path)]
+    if missing:
+        raise RuntimeError(f"Could not extract {', '.join(missing)} from {url}")
+    return [output_path for output_path, _, _ in segments]
+
+
 if __name__ == '__main__':
 
     # Parse the arguments